@@ -0,0 +1,113 @@
+# Групповая фиксация записей. Изменения из database.py ставятся в очередь,
+# одна фоновая задача забирает их пачкой (до max_batch штук) и выполняет в
+# одной транзакции. Запись начинается сразу: пачку составляет то, что
+# накопилось, пока шла предыдущая, так что одиночная запись не ждёт. Только
+# если предыдущая пачка была полной (очередь не успевает), задача ждёт
+# max_delay секунд, чтобы следующая тоже набралась.
+# Каждое изменение идёт в своей точке сохранения: ошибка одного откатывает
+# только его. Вызывающий ждёт фиксации своей записи, поэтому следующее
+# чтение её уже видит. Обновления индексов в памяти (after_commit)
+# выполняются той же задачей после фиксации, по порядку постановки.
+import asyncio
+import logging
+
+from metrics import registry
+
+log = logging.getLogger(__name__)
+
+BATCH_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500)
+
+write_batch_size = registry.histogram(
+    "bot_db_write_batch_size", "Изменений в одной транзакции пакетной записи", buckets=BATCH_BUCKETS)
+write_errors = registry.counter(
+    "bot_db_write_errors_total", "Изменения, откатившиеся при пакетной записи", ("error",))
+
+
+class WriteBatcher:
+    # connect - контекстный менеджер соединения на запись (database.get_db)
+    def __init__(self, connect, max_batch: int = 200, max_delay: float = 0.002):
+        self.connect = connect
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = asyncio.Queue()
+        self._task = None
+
+    # apply(db) выполняет запросы без commit и возвращает результат,
+    # after_commit(result) вызывается после фиксации пачки
+    async def submit(self, apply, after_commit=None):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((apply, after_commit, future))
+        return await future
+
+    async def _run(self):
+        full = False
+        while True:
+            batch = [await self._queue.get()]
+            if full and self.max_delay:
+                await asyncio.sleep(self.max_delay)
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            full = len(batch) == self.max_batch
+            try:
+                await self._flush(batch)
+            except Exception:
+                log.exception("write_batch_failed size=%s", len(batch))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _flush(self, batch):
+        write_batch_size.observe(len(batch))
+        done = []
+        try:
+            async with self.connect() as db:
+                await db.execute("BEGIN")
+                for apply, after_commit, future in batch:
+                    await db.execute("SAVEPOINT write_op")
+                    try:
+                        result = await apply(db)
+                    except Exception as e:
+                        await db.execute("ROLLBACK TO write_op")
+                        await db.execute("RELEASE write_op")
+                        write_errors.inc(type(e).__name__)
+                        if not future.done():
+                            future.set_exception(e)
+                        continue
+                    await db.execute("RELEASE write_op")
+                    done.append((after_commit, future, result))
+                await db.commit()
+                # Под блокировкой записи: индексы обновляются в том же порядке, что и база
+                for after_commit, future, result in done:
+                    if after_commit is not None:
+                        try:
+                            after_commit(result)
+                        except Exception:
+                            log.exception("write_after_commit_failed")
+        except BaseException as e:
+            # Пачка не зафиксирована - ошибку получают все, кто ещё ждёт
+            for _, _, future in batch:
+                if future.done():
+                    continue
+                if isinstance(e, asyncio.CancelledError):
+                    future.cancel()
+                else:
+                    future.set_exception(e)
+            raise
+        for _, future, result in done:
+            if not future.done():
+                future.set_result(result)
+
+    # Дождаться записи всего, что уже в очереди, и остановить задачу
+    async def close(self):
+        if self._task is None:
+            return
+        await self._queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        # Очередь привязывается к циклу событий; после закрытия начинаем с новой
+        self._task, self._queue = None, asyncio.Queue()
@@ -0,0 +1,239 @@
+# Микробенчмарки слоя данных и форматирования.
+# Заполняет временную базу синтетическими данными и замеряет функции
+# database.py, core.format_cashbacks, core.determine_period и
+# keyboards.py. Отчёт пишется в JSON, два отчёта
+# можно сравнить между собой:
+#   python bench.py --users 100000 --periods 3 --output before.json
+#   python bench.py --users 100000 --periods 3 --output after.json --compare before.json
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# settings создаёт Bot при импорте, а ему нужен токен правильного формата
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+
+import core  # noqa: E402
+import database  # noqa: E402
+import keyboards  # noqa: E402
+import transfer  # noqa: E402
+from units import current_period  # noqa: E402
+
+
+def _periods(count):
+    current = current_period()
+    return list(range(current - count + 1, current + 1))
+
+
+async def seed(users, periods, entries_per_user, group_size, seed_value):
+    rnd = random.Random(seed_value)
+    banks = [bank_id for bank_id, _ in await database.get_banks()]
+    categories = [category_id for category_id, _ in await database.get_categories()]
+    pairs = [(bank_id, category_id) for bank_id in banks for category_id in categories]
+    per_period = min(entries_per_user, len(pairs))
+    rows = 0
+    async with database.get_db() as db:
+        await db.executemany("INSERT OR IGNORE INTO users (user_id) VALUES (?)",
+                             ((user_id,) for user_id in range(1, users + 1)))
+        # Группы по group_size соседних пользователей
+        if group_size > 1:
+            for owner_id in range(1, users + 1, group_size):
+                cursor = await db.execute("INSERT INTO sharing_groups (owner_id) VALUES (?)", (owner_id,))
+                await db.executemany("INSERT INTO group_members (user_id, group_id) VALUES (?, ?)",
+                                     [(user_id, cursor.lastrowid)
+                                      for user_id in range(owner_id, min(owner_id + group_size, users + 1))])
+        batch = []
+        for user_id in range(1, users + 1):
+            for period in periods:
+                for bank_id, category_id in rnd.sample(pairs, per_period):
+                    batch.append((user_id, period, bank_id, category_id, rnd.choice((1, 2, 3, 5, 7, 10)) * 100))
+            if len(batch) >= 50000:
+                await db.executemany('''
+                    INSERT INTO cashback (user_id, period, bank_id, category_id, percent)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', batch)
+                rows += len(batch)
+                batch = []
+        if batch:
+            await db.executemany('''
+                INSERT INTO cashback (user_id, period, bank_id, category_id, percent)
+                VALUES (?, ?, ?, ?, ?)
+            ''', batch)
+            rows += len(batch)
+        await db.commit()
+        await db.execute_fetchall("ANALYZE")
+    return rows
+
+
+async def measure(func, repeat):
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func(i)
+        if asyncio.iscoroutine(result):
+            await result
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    mean = statistics.fmean(timings)
+    return {
+        "repeat": repeat,
+        "min_us": timings[0] * 1e6,
+        "median_us": statistics.median(timings) * 1e6,
+        "mean_us": mean * 1e6,
+        "p95_us": timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1e6,
+        "ops_per_sec": 1 / mean if mean else None,
+    }
+
+
+def benchmarks(users, periods, rnd):
+    def user(_):
+        return rnd.randint(1, users)
+
+    def bank_category():
+        return rnd.choice((1, 2)), rnd.randint(1, 12)
+
+    async def my_entry_keys(user_id):
+        return [row[:3] for row in await database.get_user_entries(user_id)]
+
+    async def delete_some_entries(i):
+        user_id = user(i)
+        keys = await my_entry_keys(user_id)
+        await database.delete_cashback_entries(user_id, keys[:2])
+
+    async def add_and_delete_category(i):
+        await database.add_categories(f"bench-{time.time_ns()}")
+        category_id = (await database.get_categories())[-1][0]
+        await database.delete_category(category_id)
+
+    entries_sample = [(periods[-1], 1, i, "Т-банк", f"Категория {i}", 500) for i in range(1, 25)]
+
+    # Сначала чтение, затем запись: удаления уменьшают данные для следующих замеров
+    return [
+        ("get_banks", lambda i: database.get_banks()),
+        ("get_categories", lambda i: database.get_categories()),
+        ("get_cashbacks", lambda i: database.get_cashbacks(user(i))),
+        ("get_user_categories", lambda i: database.get_user_categories(user(i))),
+        ("get_user_entries", lambda i: database.get_user_entries(user(i))),
+        ("get_user_all_periods", lambda i: database.get_user_all_periods(user(i), *bank_category())),
+        ("get_user_periods", lambda i: database.get_user_periods(user(i), *bank_category(), periods[-2:])),
+        ("get_user_group", lambda i: database.get_user_group(user(i))),
+        ("get_group_cashbacks", lambda i: database.get_group_cashbacks(user(i), periods[-2:])),
+        ("get_fsm_record", lambda i: database.get_fsm_record(user(i), user(i))),
+        ("core.determine_period", lambda i: core.determine_period(user(i), *bank_category())),
+        ("core.format_cashbacks", lambda i: core.format_cashbacks(user(i))),
+        ("core.format_cashbacks_cached", lambda i: core.format_cashbacks(1)),
+        ("core.format_best_cashbacks", lambda i: core.format_best_cashbacks(user(i))),
+        ("transfer.parse_quick_add", lambda i: transfer.parse_quick_add("тбанк апт 5")),
+        ("keyboards.categories_keyboard", lambda i: keyboards.categories_keyboard(i % 2)),
+        ("keyboards.delete_selection_keyboard", lambda i: keyboards.delete_selection_keyboard(
+            entries_sample, selected_ids={1, 5, 9})),
+        ("register_user", lambda i: database.register_user(users + i + 1)),
+        ("add_group_member", lambda i: database.add_group_member(user(i), user(i))),
+        ("leave_group", lambda i: database.leave_group(user(i))),
+        ("insert_cashback", lambda i: database.insert_cashback(user(i), *bank_category(), 500, periods[-1])),
+        ("insert_cashback_first_free_period", lambda i: database.insert_cashback_first_free_period(
+            user(i), *bank_category(), 500, periods[-2:])),
+        ("import_cashbacks", lambda i: database.import_cashbacks(
+            user(i), [(bank_category()[0], category_id, 500, periods[-1]) for category_id in range(1, 9)])),
+        ("save_fsm_records", lambda i: database.save_fsm_records(
+            [(user(i), user(i), "MenuState:selecting_bank", "{}", "{}", time.time())], [])),
+        ("delete_fsm_records_before", lambda i: database.delete_fsm_records_before(0)),
+        ("add_categories+delete_category", add_and_delete_category),
+        ("delete_cashback_entries", delete_some_entries),
+        ("delete_user_categories", lambda i: database.delete_user_categories(user(i), [bank_category()[1]])),
+        ("delete_all_cashbacks", lambda i: database.delete_all_cashbacks(user(i))),
+    ]
+
+
+def compare(report, baseline, threshold):
+    regressions = []
+    print(f"{'benchmark':45} {'base us':>12} {'new us':>12} {'ratio':>8}")
+    for name, result in report["results"].items():
+        base = baseline["results"].get(name)
+        if not base:
+            print(f"{name:45} {'-':>12} {result['median_us']:12.1f} {'new':>8}")
+            continue
+        ratio = result["median_us"] / base["median_us"] if base["median_us"] else float("inf")
+        mark = " !" if ratio > 1 + threshold else ""
+        print(f"{name:45} {base['median_us']:12.1f} {result['median_us']:12.1f} {ratio:8.2f}{mark}")
+        if mark:
+            regressions.append(name)
+    return regressions
+
+
+async def run(args):
+    periods = _periods(args.periods)
+    with tempfile.TemporaryDirectory() as tmp:
+        await database.open_db(os.path.join(tmp, "bench.db"))
+        await database.init_db()
+        start = time.perf_counter()
+        rows = await seed(args.users, periods, args.entries, args.group_size, args.seed)
+        seed_seconds = time.perf_counter() - start
+
+        rnd = random.Random(args.seed)
+        results = {}
+        for name, func in benchmarks(args.users, periods, rnd):
+            if args.only and not any(part in name for part in args.only):
+                continue
+            results[name] = await measure(func, args.repeat)
+            print(f"{name:45} median {results[name]['median_us']:10.1f} us", file=sys.stderr)
+        await database.close_db()
+
+    return {
+        "meta": {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "users": args.users,
+            "periods": periods,
+            "entries_per_user_period": args.entries,
+            "group_size": args.group_size,
+            "cashback_rows": rows,
+            "seed_seconds": seed_seconds,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарки database.py и core.py")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--periods", type=int, default=3, help="число месяцев с данными, считая текущий")
+    parser.add_argument("--entries", type=int, default=6, help="записей на пользователя в каждом периоде")
+    parser.add_argument("--group-size", type=int, default=3, help="участников в группе (1 - без групп)")
+    parser.add_argument("--repeat", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--only", nargs="*", help="запустить только бенчмарки, в имени которых есть подстрока")
+    parser.add_argument("--output", help="куда записать JSON-отчёт (по умолчанию stdout)")
+    parser.add_argument("--compare", help="JSON-отчёт предыдущего запуска для сравнения")
+    parser.add_argument("--threshold", type=float, default=0.2, help="допустимое замедление медианы, доля")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print("Регрессии: " + ", ".join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
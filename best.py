@@ -0,0 +1,142 @@
+# Индекс "чем платить": для каждого пользователя (или его группы) и категории
+# лучший банк, процент и владелец карты в текущем периоде. Внутри периода
+# запись пользователя однозначно задаётся парой (bank_id, category_id).
+# Живёт целиком в памяти и обновляется точечно из функций записи database.py,
+# поэтому поиск не обращается к базе.
+
+
+class BestIndex:
+    def __init__(self):
+        self.period = None
+        self._entries = {}   # user_id -> {(bank_id, category_id): (bank_id, category_id, percent)}
+        self._group_of = {}  # user_id -> group_id
+        self._members = {}   # group_id -> {user_id, ...}
+        self._names = {}     # user_id -> имя для подписи владельца карты
+        self._best = {}      # scope -> {category_id: (bank_id, percent, owner_id)}
+        self._changes = {}   # scope -> число изменений _best, см. state()
+        self._generation = 0
+
+    # entries - (user_id, bank_id, category_id, percent) за period,
+    # memberships - (user_id, group_id), names - (user_id, name)
+    def load(self, period, entries, memberships, names):
+        self.period = period
+        self._generation += 1
+        self._entries, self._group_of, self._members, self._best, self._changes = {}, {}, {}, {}, {}
+        for user_id, bank_id, category_id, percent in entries:
+            self._entries.setdefault(user_id, {})[(bank_id, category_id)] = (bank_id, category_id, percent)
+        for user_id, group_id in memberships:
+            self._group_of[user_id] = group_id
+            self._members.setdefault(group_id, set()).add(user_id)
+        # Имена, записанные через set_name до загрузки, сохраняются
+        self._names.update(names)
+        for scope in {self._scope(user_id) for user_id in self._entries}:
+            self._recompute(scope)
+
+    def _scope(self, user_id):
+        group_id = self._group_of.get(user_id)
+        return ("group", group_id) if group_id is not None else ("user", user_id)
+
+    def _scope_users(self, scope):
+        kind, key = scope
+        return self._members.get(key, ()) if kind == "group" else (key,)
+
+    def _touch(self, scope):
+        self._changes[scope] = self._changes.get(scope, 0) + 1
+
+    # Пересчёт лучших значений области по указанным категориям (или по всем)
+    def _recompute(self, scope, categories=None):
+        self._touch(scope)
+        if categories is None:
+            best = self._best[scope] = {}
+        else:
+            best = self._best.setdefault(scope, {})
+            for category_id in categories:
+                best.pop(category_id, None)
+        for user_id in self._scope_users(scope):
+            for bank_id, category_id, percent in self._entries.get(user_id, {}).values():
+                if categories is not None and category_id not in categories:
+                    continue
+                current = best.get(category_id)
+                if current is None or percent > current[1]:
+                    best[category_id] = (bank_id, percent, user_id)
+        if not best:
+            del self._best[scope]
+
+    def lookup(self, user_id) -> dict:
+        return self._best.get(self._scope(user_id), {})
+
+    def name(self, user_id):
+        return self._names.get(user_id)
+
+    # Метка состояния ответа lookup(user_id): меняется при любом изменении
+    # лучших значений его области - годится как часть ключа кеша
+    def state(self, user_id):
+        scope = self._scope(user_id)
+        return self._generation, scope, self._changes.get(scope, 0)
+
+    def upsert(self, user_id, bank_id, category_id, percent, period):
+        if period != self.period:
+            return
+        entries = self._entries.setdefault(user_id, {})
+        old = entries.get((bank_id, category_id))
+        entries[(bank_id, category_id)] = (bank_id, category_id, percent)
+        scope = self._scope(user_id)
+        best = self._best.get(scope, {}).get(category_id)
+        if old is None and (best is None or percent > best[1]):
+            # Новая запись лучше текущей - достаточно заменить значение
+            self._best.setdefault(scope, {})[category_id] = (bank_id, percent, user_id)
+            self._touch(scope)
+        else:
+            self._recompute(scope, {category_id})
+
+    # Удаление записей пользователя: по ключам (bank_id, category_id), по категориям или все сразу
+    def remove(self, user_id, keys=None, category_ids=None):
+        entries = self._entries.get(user_id)
+        if not entries:
+            return
+        if keys is None and category_ids is None:
+            removed = list(entries)
+        elif keys is not None:
+            removed = [key for key in keys if key in entries]
+        else:
+            removed = [key for key, entry in entries.items() if entry[1] in category_ids]
+        categories = {entries.pop(key)[1] for key in removed}
+        if not entries:
+            del self._entries[user_id]
+        if categories:
+            self._recompute(self._scope(user_id), categories)
+
+    def remove_category(self, category_id):
+        for user_id in list(self._entries):
+            self.remove(user_id, category_ids={category_id})
+
+    def set_group(self, user_id, group_id):
+        old_scope = self._scope(user_id)
+        old_group = self._group_of.pop(user_id, None)
+        if old_group is not None:
+            self._members[old_group].discard(user_id)
+            if not self._members[old_group]:
+                del self._members[old_group]
+        if group_id is not None:
+            self._group_of[user_id] = group_id
+            self._members.setdefault(group_id, set()).add(user_id)
+        for scope in {old_scope, self._scope(user_id)}:
+            self._recompute(scope)
+
+    def set_name(self, user_id, name):
+        if name:
+            self._names[user_id] = name
+
+
+# Лучшие значения по готовому списку записей (bank_id, category_id, percent, owner_id)
+# без индекса - для групп, чьи участники в разных шардах (shards.py)
+def best_of(entries) -> dict:
+    best = {}
+    for bank_id, category_id, percent, owner_id in entries:
+        current = best.get(category_id)
+        if current is None or percent > current[1]:
+            best[category_id] = (bank_id, percent, owner_id)
+    return best
+
+
+best_index = BestIndex()
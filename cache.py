@@ -0,0 +1,98 @@
+# Кеши в памяти процесса
+import asyncio
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+
+# Снимок справочников: списки для клавиатур и словари id -> name для
+# разрешения названий без JOIN-ов
+class ReferenceData(NamedTuple):
+    banks: list
+    categories: list
+    bank_names: dict
+    category_names: dict
+
+    @classmethod
+    def build(cls, banks, categories):
+        banks, categories = list(banks), list(categories)
+        return cls(banks, categories, dict(banks), dict(categories))
+
+
+# Справочники загружаются один раз и живут в памяти до invalidate().
+# version растёт при каждой инвалидации - по нему можно строить
+# зависимые кеши (клавиатуры, индексы поиска).
+# Если справочники меняют и другие процессы (шарды, см. shards.py), check()
+# раз в check_interval сек возвращает метку состояния базы; при её смене
+# снимок сбрасывается.
+class ReferenceCache:
+    def __init__(self, loader, check=None, check_interval: float = 5.0):
+        self._loader = loader
+        self._data = None
+        self._lock = asyncio.Lock()
+        self.version = 0
+        self._check = check
+        self._check_interval = check_interval
+        self._next_check = 0.0
+        self._token = None
+
+    async def get(self) -> ReferenceData:
+        if self._check is not None and time.monotonic() >= self._next_check:
+            self._next_check = time.monotonic() + self._check_interval
+            token = await self._check()
+            if self._token is not None and token != self._token:
+                self.invalidate()
+            self._token = token
+        if self._data is not None:
+            return self._data
+        async with self._lock:
+            if self._data is None:
+                version = self.version
+                data = await self._loader()
+                # Пока грузили, справочник могли изменить - такой снимок не сохраняем
+                if version != self.version:
+                    return data
+                self._data = data
+        return self._data
+
+    def invalidate(self):
+        self._data = None
+        self.version += 1
+
+
+# Ограниченный LRU-кеш со счётчиками попаданий и промахов
+class LRUCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
@@ -1,8 +1,15 @@
 # --- core.py ---
-from datetime import datetime
+import asyncio
 
-from database import get_cashbacks, get_user_all_periods
-from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from aiogram.utils.markdown import quote_html
+
+from database import get_cashbacks, get_user_all_periods, get_data_version, insert_cashback_first_free_period, \
+    get_group_cashbacks, get_group_entries, load_best_index, reference, SHARDED
+from best import best_index, best_of
+from cache import LRUCache
+from metrics import registry
+from settings import SUMMARY_CACHE_SIZE, RETENTION_KEEP_MONTHS
+from units import current_period, period_month, format_percent
 
 
 MONTHS_RU = {
@@ -11,12 +18,16 @@ MONTHS_RU = {
 }
 
 
+# Периоды - номера месяцев (см. units.py), соседние месяцы отличаются на 1
 def get_next_two_periods():
-    now = datetime.now()
-    current = now.strftime("%Y-%m")
-    year, month = (now.year + 1, 1) if now.month == 12 else (now.year, now.month + 1)
-    next_ = datetime(year, month, 1).strftime("%Y-%m")
-    return current, next_
+    current = current_period()
+    return current, current + 1
+
+
+# Первый активный период: текущий месяц минус RETENTION_KEEP_MONTHS.
+# Всё, что раньше, переносится в архив и в сводках не показывается.
+def active_since(keep_months=RETENTION_KEEP_MONTHS):
+    return current_period() - keep_months
 
 
 async def determine_period(user_id, bank_id, category_id):
@@ -27,8 +38,30 @@ async def determine_period(user_id, bank_id, category_id):
     return next_ if current in periods else current
 
 
+# Запись в текущий период, а если он занят - в следующий. None, если заняты оба.
+async def add_cashback_to_free_period(user_id, bank_id, category_id, percent):
+    return await insert_cashback_first_free_period(user_id, bank_id, category_id, percent,
+                                                   list(get_next_two_periods()))
+
+
+# Готовые тексты сводок. Ключ включает версию данных пользователя,
+# так что любое изменение его кешбеков делает старую запись недостижимой.
+summary_cache = LRUCache(SUMMARY_CACHE_SIZE)
+registry.callback("bot_summary_cache_hits_total", "Попадания в кеш сводок", lambda: summary_cache.hits, "counter")
+registry.callback("bot_summary_cache_misses_total", "Промахи кеша сводок", lambda: summary_cache.misses, "counter")
+
+
 async def format_cashbacks(user_id):
-    rows = await get_cashbacks(user_id)
+    since = active_since()
+    key = (user_id, get_data_version(user_id), since)
+    text = summary_cache.get(key)
+    if text is None:
+        text = render_cashbacks(await get_cashbacks(user_id, since))
+        summary_cache.set(key, text)
+    return text
+
+
+def render_cashbacks(rows):
     if not rows:
         return "Кешбеков нет."
 
@@ -38,8 +71,7 @@ async def format_cashbacks(user_id):
 
     lines = []
     for period in sorted(grouped):
-        y, m = map(int, period.split('-'))
-        lines.append(f"Кешбеки на {MONTHS_RU.get(m, str(m))}:\n")
+        lines.append(f"Кешбеки на {MONTHS_RU[period_month(period)]}:\n")
 
         bank_lines = {}
         for bank, cat, pct in grouped[period]:
@@ -49,38 +81,87 @@ async def format_cashbacks(user_id):
             lines.append(f"🏦 {bank}")
             lines.append("------------------------")
             for cat, pct in cats:
-                formatted_pct = f"{int(pct)}%" if pct == int(pct) else f"{pct:.1f}%"
-                lines.append(f"{cat}: {formatted_pct}")
+                lines.append(f"{cat}: {format_percent(pct)}")
             lines.append("")
 
     return "\n".join(lines).strip()
 
 
+# Сводка группы: по каждой категории лучший банк среди всех участников.
+# None, если пользователь не состоит в группе.
+async def format_group_cashbacks(user_id):
+    rows = await get_group_cashbacks(user_id, list(get_next_two_periods()))
+    if rows is None:
+        return None
+    return render_group_cashbacks(rows, user_id)
 
 
-def delete_menu_keyboard():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton("🗂 Удалить по категориям", callback_data="delete_by_categories")],
-        [InlineKeyboardButton("💣 Удалить все кешбеки", callback_data="delete_all_cashbacks")],
-        [InlineKeyboardButton("✖️ Выход", callback_data="exit")]
-    ])
-
-
-def bank_category_selection_keyboard(pairs, selected_ids=None):
-    if selected_ids is None:
-        selected_ids = []
-    markup = InlineKeyboardMarkup(row_width=1)
-    for entry_id, bank_name, cat_name, percent in pairs:
-        prefix = "✅ " if entry_id in selected_ids else ""
-        text = f"{prefix}{bank_name} → {cat_name}: {percent:.0f}%"
-        markup.add(InlineKeyboardButton(text, callback_data=f"delpair_{entry_id}"))
-    markup.add(InlineKeyboardButton("⁉️ Удалить выбранные", callback_data="delpair_done"))
-    markup.add(InlineKeyboardButton("✖️ Отмена", callback_data="exit"))
-    return markup
-
+def render_group_cashbacks(rows, user_id):
+    best = {}
+    for period, bank, category, percent, owner_id, owner_name in rows:
+        current = best.get((period, category))
+        if current is None or percent > current[1]:
+            best[(period, category)] = (bank, percent, owner_id, owner_name)
 
-def confirm_all_deletion_keyboard():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton("✅ Подтвердить", callback_data="confirm_delete_all")],
-        [InlineKeyboardButton("✖️ Отмена", callback_data="cancel_delete_all")]
-    ])
\ No newline at end of file
+    lines = []
+    last_period = None
+    for (period, category), (bank, percent, owner_id, owner_name) in sorted(best.items()):
+        if period != last_period:
+            if last_period is not None:
+                lines.append("")
+            lines.append(f"Лучший кешбек группы на {MONTHS_RU[period_month(period)]}:\n")
+            last_period = period
+        # Имя - full_name из Telegram, а сообщение уходит с parse_mode=HTML
+        owner = "вы" if owner_id == user_id else quote_html(owner_name or str(owner_id))
+        lines.append(f"{category}: {format_percent(percent)} — {bank} ({owner})")
+    return "\n".join(lines) if lines else "Кешбеков в группе нет."
+
+
+
+# "Чем платить": лучший банк по каждой категории в текущем периоде среди
+# карт пользователя и его группы. Ответ берётся из индекса в памяти, база
+# читается только при первом обращении и при смене месяца.
+_best_lock = asyncio.Lock()
+
+
+# (period, {category_id: (bank_id, percent, owner_id)}, имена владельцев или None -
+# тогда имена берутся из индекса). Используется и inline-поиском (inline.py).
+async def get_best_cashbacks(user_id):
+    current, _ = get_next_two_periods()
+    if SHARDED:
+        # Участники группы могут жить в других шардах - их записи читаются из баз шардов
+        entries = await get_group_entries(user_id, [current])
+        if entries is not None:
+            best = best_of((bank_id, category_id, percent, owner_id)
+                           for period, bank_id, category_id, percent, owner_id, _ in entries if period is not None)
+            names = {owner_id: name for *_, owner_id, name in entries if name}
+            return current, best, names
+    if best_index.period != current:
+        async with _best_lock:
+            if best_index.period != current:
+                await load_best_index(current)
+    return current, best_index.lookup(user_id), None
+
+
+async def format_best_cashbacks(user_id):
+    period, best, names = await get_best_cashbacks(user_id)
+    return render_best_cashbacks(best, await reference.get(), user_id, period, names)
+
+
+# names - имена владельцев карт; по умолчанию из индекса
+def render_best_cashbacks(best, ref, user_id, period, names=None):
+    rows = sorted(
+        (ref.category_names[category_id], ref.bank_names.get(bank_id, "?"), percent, owner_id)
+        for category_id, (bank_id, percent, owner_id) in best.items()
+        if category_id in ref.category_names
+    )
+    if not rows:
+        return "На этот месяц кешбеков нет. Добавьте: /add"
+    lines = [f"Чем платить ({MONTHS_RU[period_month(period)]}):\n"]
+    for category, bank, percent, owner_id in rows:
+        line = f"{category}: {bank}, {format_percent(percent)}"
+        if owner_id != user_id:
+            name = names.get(owner_id) if names is not None else best_index.name(owner_id)
+            line += f" ({quote_html(name or str(owner_id))})"
+        lines.append(line)
+    return "\n".join(lines)
@@ -1,140 +1,388 @@
+import asyncio
+import logging
+import time
+
 import aiosqlite
 from contextlib import asynccontextmanager
-from settings import DB_NAME
-
-
+from settings import DB_NAME, DB_READ_POOL_SIZE, MIGRATION_BATCH, WRITE_BATCH_SIZE, WRITE_BATCH_DELAY, \
+    SHARD_COUNT, SHARD_INDEX, SHARD_DB_TEMPLATE, SHARED_DB_NAME, SHARED_CHECK_INTERVAL
+from migrations import migrate, migrate_shared, copy_legacy_batch
+from cache import ReferenceCache, ReferenceData
+from best import best_index
+from batcher import WriteBatcher
+from metrics import timed_query
+from units import period_text
+
+log = logging.getLogger(__name__)
+
+# Общие настройки для всех соединений
+PRAGMAS = (
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",  # ~16 МБ страниц на соединение
+    "PRAGMA mmap_size = 268435456",  # 256 МБ
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+)
+
+# Одно соединение на запись (sqlite всё равно пускает только одного писателя)
+# и небольшой пул соединений на чтение. Открываются один раз в init_db().
+_writer = None
+_write_lock = asyncio.Lock()
+_readers = None
+_open_lock = asyncio.Lock()
+
+# Шардирование (shards.py): у процесса своя база пользователей (DB_NAME),
+# справочники и группы - в общей базе, к ней одно соединение на процесс.
+# Базы других шардов открываются только на чтение - для групп, чьи
+# участники живут в разных шардах.
+SHARDED = SHARD_COUNT > 1
+_shared = None
+_shared_lock = asyncio.Lock()
+_peers = {}  # номер шарда -> соединение на чтение
+
+
+def shard_of(user_id: int, count: int = SHARD_COUNT) -> int:
+    return user_id % count
+
+
+async def _connect(path, readonly=False):
+    if readonly:
+        # mode=ro: отсутствующий файл - ошибка, а не новая пустая база
+        db = await aiosqlite.connect(f"file:{path}?mode=ro", uri=True)
+    else:
+        db = await aiosqlite.connect(path)
+    # execute_fetchall: незакрытый курсор от PRAGMA держал бы блокировку
+    for pragma in PRAGMAS:
+        await db.execute_fetchall(pragma)
+    if readonly:
+        await db.execute_fetchall("PRAGMA query_only = ON")
+    return db
+
+
+async def open_db(path: str = DB_NAME):
+    global _writer, _readers, _shared
+    async with _open_lock:
+        if _writer is not None:
+            return
+        writer = await _connect(path)
+        # Новая база сразу создаётся с auto_vacuum = INCREMENTAL: пока файл пуст, режим
+        # меняется без VACUUM (до перехода в WAL). Старые базы - python retention.py vacuum
+        await writer.execute_fetchall("PRAGMA auto_vacuum = INCREMENTAL")
+        # WAL сохраняется в файле БД, читатели не блокируют писателя
+        await writer.execute_fetchall("PRAGMA journal_mode = WAL")
+        readers = asyncio.Queue()
+        for _ in range(DB_READ_POOL_SIZE):
+            readers.put_nowait(await _connect(path, readonly=True))
+        if SHARDED:
+            _shared = await _connect(SHARED_DB_NAME)
+            await _shared.execute_fetchall("PRAGMA journal_mode = WAL")
+        _writer, _readers = writer, readers
+
+
+async def close_db():
+    global _writer, _readers, _shared
+    await batcher.close()
+    async with _open_lock:
+        if _writer is None:
+            return
+        async with _write_lock:
+            await _writer.close()
+        while not _readers.empty():
+            await _readers.get_nowait().close()
+        if _shared is not None:
+            async with _shared_lock:
+                await _shared.close()
+        for peer in _peers.values():
+            await peer.close()
+        _peers.clear()
+        _writer, _readers, _shared = None, None, None
+
+
+# Соединение на запись. Захватывается эксклюзивно, чтобы транзакции
+# разных хендлеров не перемешивались на одном соединении.
 @asynccontextmanager
 async def get_db():
-    db = await aiosqlite.connect(DB_NAME)
+    if _writer is None:
+        await open_db()
+    async with _write_lock:
+        try:
+            yield _writer
+        except BaseException:
+            await _writer.rollback()
+            raise
+
+
+# Соединение на чтение из пула. Курсоры нужно дочитывать до конца,
+# иначе соединение так и останется на старом снимке WAL.
+@asynccontextmanager
+async def get_read_db():
+    if _readers is None:
+        await open_db()
+    readers = _readers
+    db = await readers.get()
     try:
         yield db
     finally:
-        await db.close()
+        readers.put_nowait(db)
+
+
+# Соединение с общей базой (справочники, группы). Без шардирования это
+# обычное соединение на запись. Используется и для чтения: общих данных мало.
+@asynccontextmanager
+async def get_shared_db():
+    if not SHARDED:
+        async with get_db() as db:
+            yield db
+        return
+    if _shared is None:
+        await open_db()
+    async with _shared_lock:
+        try:
+            yield _shared
+        except BaseException:
+            await _shared.rollback()
+            raise
+
+
+# Чтение из базы шарда shard: своей - через пул, чужой - через соединение
+# только на чтение, открываемое при первом обращении
+@asynccontextmanager
+async def get_shard_read_db(shard: int):
+    if shard == SHARD_INDEX:
+        async with get_read_db() as db:
+            yield db
+        return
+    if shard not in _peers:
+        async with _open_lock:
+            if shard not in _peers:
+                _peers[shard] = await _connect(SHARD_DB_TEMPLATE.format(shard), readonly=True)
+    yield _peers[shard]
+
+
+# Частые изменения от хендлеров (регистрация, кешбеки, группы) фиксируются пачками,
+# см. batcher.py. Функции ниже передают запросы без commit и обновление индексов в памяти.
+batcher = WriteBatcher(get_db, WRITE_BATCH_SIZE, WRITE_BATCH_DELAY)
+
+
+# Изменение общих данных (групп). Без шардирования - через batcher, как остальные
+# записи; с шардированием - сразу в общую базу, за её блокировку спорят все шарды.
+async def _submit_shared(apply, after_commit=None):
+    if not SHARDED:
+        return await batcher.submit(apply, after_commit)
+    async with get_shared_db() as db:
+        await db.execute("BEGIN IMMEDIATE")
+        result = await apply(db)
+        await db.commit()
+    if after_commit is not None:
+        after_commit(result)
+    return result
 
 
-# Инициализация базы данных
+# Инициализация базы данных: применяем недостающие миграции схемы.
+# Строки таблиц до миграции 8 переносятся пачками, между пачками
+# блокировка на запись отпускается.
 async def init_db():
+    await open_db()
     async with get_db() as db:
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                friend_id INTEGER
-            )
-        ''')
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS banks (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL UNIQUE
-            )
-        ''')
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS categories (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL UNIQUE
-            )
-        ''')
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS cashback (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                bank_id INTEGER,
-                category_id INTEGER,
-                percent REAL,
-                period TEXT,
-                FOREIGN KEY (user_id) REFERENCES users(user_id),
-                FOREIGN KEY (bank_id) REFERENCES banks(id),
-                FOREIGN KEY (category_id) REFERENCES categories(id)
-            )
-        ''')
+        await migrate(db)
+    if SHARDED:
+        async with get_shared_db() as db:
+            await migrate_shared(db)
+    moved = 0
+    while True:
+        async with get_db() as db:
+            count = await copy_legacy_batch(db, MIGRATION_BATCH)
+        if not count:
+            break
+        moved += count
+    if moved:
+        log.info("legacy_cashback_copied rows=%s", moved)
 
-        # Предзаполнение банков
-        await db.executemany('INSERT OR IGNORE INTO banks (name) VALUES (?)', [
-            ('Т-банк',),
-            ('ВТБ',)
-        ])
-
-        # Предзаполнение категорий
-        await db.executemany('INSERT OR IGNORE INTO categories (name) VALUES (?)', [
-            ('🛍 Все покупки',),
-            ('⚽️ Спорттовары',),
-            ('🐶 Животные',),
-            ('💊 Аптеки',),
-            ('⛽️ Заправки',),
-            ('🛒 Супермаркеты',),
-            ('💐 Цветы',),
-            ('💋 Красота',),
-            ('🎮 Развлечения',),
-            ('🎭 Искусство',),
-            ('🍔 Фаст-фуд',),
-            ('🍽 Рестораны',)
-        ])
 
-        await db.commit()
+# Версии данных пользователей: растут при каждом изменении его кешбеков.
+# Вместе с версией справочников по ним проверяется актуальность кешей.
+_user_versions = {}
+
+
+def get_data_version(user_id: int):
+    return reference.version, _user_versions.get(user_id, 0)
+
+
+def _bump_user_version(user_id: int):
+    _user_versions[user_id] = _user_versions.get(user_id, 0) + 1
 
 
 # Методы доступа к данным
 
-async def register_user(user_id: int):
-    async with get_db() as db:
-        await db.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
-        await db.commit()
+@timed_query
+async def register_user(user_id: int, name: str = None):
+    async def apply(db):
+        await db.execute('''
+            INSERT INTO users (user_id, name) VALUES (?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET name = COALESCE(excluded.name, name)
+        ''', (user_id, name))
+
+    await batcher.submit(apply, lambda _: best_index.set_name(user_id, name))
+
+
+# Зарегистрирован ли пользователь (запускал бота). С шардированием - в базе его шарда
+@timed_query
+async def user_exists(user_id: int) -> bool:
+    async with get_shard_read_db(shard_of(user_id)) as db:
+        rows = await db.execute_fetchall("SELECT 1 FROM users WHERE user_id = ?", (user_id,))
+    return bool(rows)
+
 
+# Справочники банков и категорий меняются только из админки,
+# поэтому читаются из базы один раз и дальше отдаются из памяти
+@timed_query
+async def _load_reference():
+    async with get_shared_db() if SHARDED else get_read_db() as db:
+        banks = await db.execute_fetchall("SELECT id, name FROM banks")
+        categories = await db.execute_fetchall("SELECT id, name FROM categories")
+    return ReferenceData.build(banks, categories)
 
+
+# data_version меняется, когда общую базу изменило другое соединение (другой шард)
+async def _shared_data_version():
+    async with get_shared_db() as db:
+        rows = await db.execute_fetchall("PRAGMA data_version")
+    return rows[0][0]
+
+
+reference = ReferenceCache(_load_reference, _shared_data_version if SHARDED else None, SHARED_CHECK_INTERVAL)
+
+
+@timed_query
 async def get_banks():
-    async with get_db() as db:
-        cursor = await db.execute("SELECT id, name FROM banks")
-        return await cursor.fetchall()
+    return (await reference.get()).banks
 
 
+@timed_query
 async def get_categories():
-    async with get_db() as db:
-        cursor = await db.execute("SELECT id, name FROM categories")
-        return await cursor.fetchall()
+    return (await reference.get()).categories
 
 
+@timed_query
 async def add_categories(new_cat):
-    async with get_db() as db:
+    async with get_shared_db() as db:
         await db.execute("INSERT INTO categories (name) VALUES (?)", (new_cat,))
         await db.commit()
+    reference.invalidate()
 
 
+# Затрагивает всех пользователей, поэтому сбрасывается версия справочников
+@timed_query
 async def delete_category(cat_id: int):
-    async with get_db() as db:
+    async with get_shared_db() as db:
         await db.execute("DELETE FROM categories WHERE id = ?", (cat_id,))
         await db.commit()
-
-async def insert_cashback(user_id: int, bank_id: int, category_id: int, percent: float, period: str):
-    async with get_db() as db:
+        best_index.remove_category(cat_id)
+    reference.invalidate()
+
+# Периоды - номера месяцев (units.make_period), проценты - базисные пункты.
+# Повторная запись в тот же период обновляет процент
+@timed_query
+async def insert_cashback(user_id: int, bank_id: int, category_id: int, percent: int, period: int):
+    async def apply(db):
         await db.execute('''
-            INSERT INTO cashback (user_id, bank_id, category_id, percent, period)
+            INSERT INTO cashback (user_id, period, bank_id, category_id, percent)
             VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, bank_id, category_id, percent, period))
-        await db.commit()
+            ON CONFLICT (user_id, period, bank_id, category_id) DO UPDATE SET percent = excluded.percent
+        ''', (user_id, period, bank_id, category_id, percent))
 
+    def applied(_):
+        best_index.upsert(user_id, bank_id, category_id, percent, period)
+        _bump_user_version(user_id)
 
-async def get_user_friend(user_id: int):
-    async with get_db() as db:
-        cursor = await db.execute("SELECT friend_id FROM users WHERE user_id = ?", (user_id,))
-        result = await cursor.fetchone()
-        return result[0] if result else None
+    await batcher.submit(apply, applied)
 
 
-async def get_cashbacks(user_id: int):
-    async with get_db() as db:
-        cursor = await db.execute('''
-            SELECT cashback.period, banks.name, categories.name, cashback.percent
+# Пакетная запись кешбеков одной транзакцией: rows - (bank_id, category_id, percent, period).
+# Повторы в тот же период обновляют процент, как в insert_cashback. Возвращает число строк.
+@timed_query
+async def import_cashbacks(user_id: int, rows: list) -> int:
+    if not rows:
+        return 0
+    async def apply(db):
+        await db.executemany('''
+            INSERT INTO cashback (user_id, period, bank_id, category_id, percent)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, period, bank_id, category_id) DO UPDATE SET percent = excluded.percent
+        ''', [(user_id, period, bank_id, category_id, percent) for bank_id, category_id, percent, period in rows])
+
+    def applied(_):
+        for bank_id, category_id, percent, period in rows:
+            best_index.upsert(user_id, bank_id, category_id, percent, period)
+        _bump_user_version(user_id)
+
+    await batcher.submit(apply, applied)
+    return len(rows)
+
+
+# Добавить кешбек в первый свободный из периодов (в порядке списка) одним запросом.
+# Возвращает период, в который попала запись, или None, если заняты все.
+@timed_query
+async def insert_cashback_first_free_period(user_id: int, bank_id: int, category_id: int, percent: int,
+                                            periods: list) -> int | None:
+    candidates = ', '.join('(?, ?)' for _ in periods)
+    params = [value for ordinal, period in enumerate(periods) for value in (ordinal, period)]
+
+    async def apply(db):
+        rows = await db.execute_fetchall(f'''
+            WITH candidate (ordinal, period) AS (VALUES {candidates})
+            INSERT INTO cashback (user_id, period, bank_id, category_id, percent)
+            SELECT ?, candidate.period, ?, ?, ?
+            FROM candidate
+            WHERE NOT EXISTS (
+                SELECT 1 FROM cashback
+                WHERE user_id = ? AND period = candidate.period AND bank_id = ? AND category_id = ?
+            )
+            ORDER BY candidate.ordinal
+            LIMIT 1
+            RETURNING period
+        ''', (*params, user_id, bank_id, category_id, percent, user_id, bank_id, category_id))
+        return rows[0][0] if rows else None
+
+    def applied(period):
+        if period is not None:
+            best_index.upsert(user_id, bank_id, category_id, percent, period)
+            _bump_user_version(user_id)
+
+    return await batcher.submit(apply, applied)
+
+
+# Названия банков и категорий подставляются из справочника в памяти.
+# Записи с удалёнными категориями пропускаются, как раньше делал JOIN.
+# По умолчанию только периоды начиная с since; history=True добавляет архив.
+@timed_query
+async def get_cashbacks(user_id: int, since: int = 0, history: bool = False):
+    ref = await reference.get()
+    archive = '''
+        UNION ALL
+        SELECT period, bank_id, category_id, percent FROM cashback_archive WHERE user_id = ?
+    ''' if history else ''
+    async with get_read_db() as db:
+        rows = await db.execute_fetchall(f'''
+            SELECT period, bank_id, category_id, percent
             FROM cashback
-            JOIN banks ON cashback.bank_id = banks.id
-            JOIN categories ON cashback.category_id = categories.id
-            WHERE cashback.user_id = ?
-            ORDER BY cashback.period, banks.name
-        ''', (user_id,))
-        return await cursor.fetchall()
-
-
+            WHERE user_id = ? AND period >= ?
+            {archive}
+        ''', (user_id, since, user_id) if history else (user_id, since))
+    banks, categories = ref.bank_names, ref.category_names
+    result = [
+        (period, banks[bank_id], categories[category_id], percent)
+        for period, bank_id, category_id, percent in rows
+        if bank_id in banks and category_id in categories
+    ]
+    result.sort(key=lambda row: (row[0], row[1]))  # ORDER BY period, bank name
+    return result
+
+
+@timed_query
 async def get_user_periods(user_id: int, bank_id: int, category_id: int, periods: list):
     placeholders = ', '.join('?' for _ in periods)
-    async with get_db() as db:
+    async with get_read_db() as db:
         cursor = await db.execute(f'''
             SELECT DISTINCT period FROM cashback
             WHERE user_id = ? AND bank_id = ? AND category_id = ? AND period IN ({placeholders})
@@ -142,8 +390,9 @@ async def get_user_periods(user_id: int, bank_id: int, category_id: int, periods
         return [row[0] async for row in cursor]
 
 
+@timed_query
 async def get_user_all_periods(user_id: int, bank_id: int, category_id: int):
-    async with get_db() as db:
+    async with get_read_db() as db:
         cursor = await db.execute('''
             SELECT DISTINCT period FROM cashback
             WHERE user_id = ? AND bank_id = ? AND category_id = ?
@@ -151,66 +400,460 @@ async def get_user_all_periods(user_id: int, bank_id: int, category_id: int):
         return [row[0] async for row in cursor]
 
 
-async def set_user_friend(user_id: int, friend_id: int):
-    async with get_db() as db:
+# Вся история кешбеков пользователя, включая архив, порциями по size строк:
+# (period, bank_name, category_name, percent) в порядке периодов
+async def iter_user_cashbacks(user_id: int, size: int = 500):
+    ref = await reference.get()
+    async with get_read_db() as db:
+        async with db.execute('''
+            SELECT period, bank_id, category_id, percent FROM cashback WHERE user_id = ?
+            UNION ALL
+            SELECT period, bank_id, category_id, percent FROM cashback_archive WHERE user_id = ?
+            ORDER BY 1, 2, 3
+        ''', (user_id, user_id)) as cursor:
+            while True:
+                rows = await cursor.fetchmany(size)
+                if not rows:
+                    break
+                yield [
+                    (period, ref.bank_names.get(bank_id, "?"), ref.category_names.get(category_id, "?"), percent)
+                    for period, bank_id, category_id, percent in rows
+                ]
+
+
+# Группы
+
+@timed_query
+async def get_user_group(user_id: int):
+    async with get_shared_db() if SHARDED else get_read_db() as db:
+        rows = await db.execute_fetchall("SELECT group_id FROM group_members WHERE user_id = ?", (user_id,))
+    return rows[0][0] if rows else None
+
+
+# Перевести member_id в группу user_id (группа создаётся при первом добавлении).
+# Прежняя группа участника, оставшаяся без участников, удаляется. Возвращает id группы.
+async def _join_group(db, user_id: int, member_id: int) -> int:
+    rows = await db.execute_fetchall("SELECT group_id FROM group_members WHERE user_id = ?", (user_id,))
+    if rows:
+        group_id = rows[0][0]
+    else:
+        cursor = await db.execute("INSERT INTO sharing_groups (owner_id) VALUES (?)", (user_id,))
+        group_id = cursor.lastrowid
+        await db.execute("INSERT INTO group_members (user_id, group_id) VALUES (?, ?)", (user_id, group_id))
+    old = await db.execute_fetchall("SELECT group_id FROM group_members WHERE user_id = ?", (member_id,))
+    await db.execute('''
+        INSERT INTO group_members (user_id, group_id) VALUES (?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET group_id = excluded.group_id
+    ''', (member_id, group_id))
+    if old and old[0][0] != group_id:
         await db.execute('''
-            INSERT INTO users (user_id, friend_id)
-            VALUES (?, ?)
-            ON CONFLICT(user_id) DO UPDATE SET friend_id=excluded.friend_id
-        ''', (user_id, friend_id))
-        await db.commit()
+            DELETE FROM sharing_groups
+            WHERE id = ? AND NOT EXISTS (SELECT 1 FROM group_members WHERE group_id = ?)
+        ''', (old[0][0], old[0][0]))
+    return group_id
+
+
+# Добавить участника в группу пользователя без его согласия - только для
+# служебных скриптов (bench.py); бот добавляет участников через приглашения.
+# Если участник состоял в другой группе, он переходит в эту. Возвращает id группы.
+@timed_query
+async def add_group_member(user_id: int, member_id: int) -> int:
+    async def apply(db):
+        return await _join_group(db, user_id, member_id)
+
+    def applied(group_id):
+        best_index.set_group(user_id, group_id)
+        best_index.set_group(member_id, group_id)
+
+    return await _submit_shared(apply, applied)
+
+
+# Приглашения в группу. Участник попадает в группу пригласившего, только приняв
+# приглашение; повторное приглашение от того же пользователя обновляет время.
+@timed_query
+async def create_group_invite(inviter_id: int, member_id: int):
+    async def apply(db):
+        await db.execute('''
+            INSERT INTO group_invites (member_id, inviter_id, created_at) VALUES (?, ?, ?)
+            ON CONFLICT (member_id, inviter_id) DO UPDATE SET created_at = excluded.created_at
+        ''', (member_id, inviter_id, time.time()))
+
+    await _submit_shared(apply)
+
+
+# Принять приглашение: участник переходит в группу пригласившего.
+# Возвращает id группы или None, если приглашения нет (отклонено или уже принято).
+@timed_query
+async def accept_group_invite(member_id: int, inviter_id: int):
+    async def apply(db):
+        rows = await db.execute_fetchall(
+            "DELETE FROM group_invites WHERE member_id = ? AND inviter_id = ? RETURNING inviter_id",
+            (member_id, inviter_id))
+        if not rows:
+            return None
+        return await _join_group(db, inviter_id, member_id)
+
+    def applied(group_id):
+        if group_id is not None:
+            best_index.set_group(inviter_id, group_id)
+            best_index.set_group(member_id, group_id)
+
+    return await _submit_shared(apply, applied)
+
+
+# Отклонить приглашение; False, если его уже нет
+@timed_query
+async def decline_group_invite(member_id: int, inviter_id: int) -> bool:
+    async def apply(db):
+        rows = await db.execute_fetchall(
+            "DELETE FROM group_invites WHERE member_id = ? AND inviter_id = ? RETURNING inviter_id",
+            (member_id, inviter_id))
+        return bool(rows)
+
+    return await _submit_shared(apply)
+
+
+# Выйти из группы; группа без участников удаляется
+@timed_query
+async def leave_group(user_id: int):
+    async def apply(db):
+        rows = await db.execute_fetchall("SELECT group_id FROM group_members WHERE user_id = ?", (user_id,))
+        if not rows:
+            return False
+        await db.execute("DELETE FROM group_members WHERE user_id = ?", (user_id,))
+        await db.execute('''
+            DELETE FROM sharing_groups
+            WHERE id = ? AND NOT EXISTS (SELECT 1 FROM group_members WHERE group_id = ?)
+        ''', (rows[0][0], rows[0][0]))
+        return True
+
+    def applied(left):
+        if left:
+            best_index.set_group(user_id, None)
+
+    await _submit_shared(apply, applied)
+
+
+# Записи всех участников группы пользователя за указанные периоды:
+# (period, bank_id, category_id, percent, owner_id, owner_name); period None -
+# участник без записей. None, если пользователь не состоит в группе.
+@timed_query
+async def get_group_entries(user_id: int, periods: list):
+    placeholders = ', '.join('?' for _ in periods)
+    if not SHARDED:
+        async with get_read_db() as db:
+            # LEFT JOIN: участники без записей тоже дают строку, так видно, что группа есть
+            rows = await db.execute_fetchall(f'''
+                SELECT c.period, c.bank_id, c.category_id, c.percent, m.user_id, u.name
+                FROM group_members me
+                JOIN group_members m ON m.group_id = me.group_id
+                LEFT JOIN cashback c ON c.user_id = m.user_id AND c.period IN ({placeholders})
+                LEFT JOIN users u ON u.user_id = m.user_id
+                WHERE me.user_id = ?
+            ''', (*periods, user_id))
+        return rows or None
+
+    # Участники - из общей базы, их записи - из баз их шардов, параллельно
+    async with get_shared_db() as db:
+        members = await db.execute_fetchall('''
+            SELECT m.user_id FROM group_members me
+            JOIN group_members m ON m.group_id = me.group_id
+            WHERE me.user_id = ?
+        ''', (user_id,))
+    if not members:
+        return None
+    by_shard = {}
+    for (member_id,) in members:
+        by_shard.setdefault(shard_of(member_id), []).append(member_id)
+
+    async def fetch(shard, member_ids):
+        async with get_shard_read_db(shard) as db:
+            return await db.execute_fetchall(f'''
+                SELECT c.period, c.bank_id, c.category_id, c.percent, c.user_id, u.name
+                FROM cashback c
+                LEFT JOIN users u ON u.user_id = c.user_id
+                WHERE c.user_id IN ({', '.join('?' for _ in member_ids)}) AND c.period IN ({placeholders})
+            ''', (*member_ids, *periods))
+
+    results = await asyncio.gather(*(fetch(shard, member_ids) for shard, member_ids in by_shard.items()))
+    return [row for rows in results for row in rows]
+
+
+# Кешбеки всех участников группы пользователя за указанные периоды:
+# (period, bank_name, category_name, percent, owner_id, owner_name).
+# None, если пользователь не состоит в группе.
+@timed_query
+async def get_group_cashbacks(user_id: int, periods: list):
+    rows = await get_group_entries(user_id, periods)
+    if rows is None:
+        return None
+    ref = await reference.get()
+    banks, categories = ref.bank_names, ref.category_names
+    return [
+        (period, banks[bank_id], categories[category_id], percent, owner_id, owner_name)
+        for period, bank_id, category_id, percent, owner_id, owner_name in rows
+        if period is not None and bank_id in banks and category_id in categories
+    ]
+
+
+# Индекс "чем платить" за период. Читается через соединение на запись:
+# пока держится блокировка, ни одна запись не проскочит между чтением и загрузкой,
+# а все последующие обновят индекс сами. С шардированием в индексе только
+# пользователи шарда без групп: группы считаются по get_group_entries (core.py).
+@timed_query
+async def load_best_index(period: int):
+    async with get_db() as db:
+        entries = await db.execute_fetchall('''
+            SELECT user_id, bank_id, category_id, percent FROM cashback WHERE period = ?
+        ''', (period,))
+        if SHARDED:
+            best_index.load(period, entries, [], [])
+            return
+        memberships = await db.execute_fetchall("SELECT user_id, group_id FROM group_members")
+        names = await db.execute_fetchall('''
+            SELECT m.user_id, u.name FROM group_members m
+            JOIN users u ON u.user_id = m.user_id
+            WHERE u.name IS NOT NULL
+        ''')
+        best_index.load(period, entries, memberships, names)
+
 
 # Получить категории, по которым есть кешбэки у пользователя
+@timed_query
 async def get_user_categories(user_id: int) -> list[tuple[int, str]]:
-    async with get_db() as db:
-        cursor = await db.execute('''
-            SELECT DISTINCT categories.id, categories.name
-            FROM cashback
-            JOIN categories ON cashback.category_id = categories.id
-            WHERE cashback.user_id = ?
-            ORDER BY categories.name
+    ref = await reference.get()
+    async with get_read_db() as db:
+        rows = await db.execute_fetchall('''
+            SELECT DISTINCT category_id FROM cashback WHERE user_id = ?
         ''', (user_id,))
-        return await cursor.fetchall()
+    names = ref.category_names
+    return sorted(((category_id, names[category_id]) for (category_id,) in rows if category_id in names),
+                  key=lambda row: row[1])
 
 # Удалить кешбэки по списку категорий
+@timed_query
 async def delete_user_categories(user_id: int, category_ids: list[int]):
     if not category_ids:
         return
     placeholders = ','.join('?' for _ in category_ids)
-    async with get_db() as db:
+
+    async def apply(db):
         await db.execute(f'''
             DELETE FROM cashback
             WHERE user_id = ? AND category_id IN ({placeholders})
         ''', (user_id, *category_ids))
-        await db.commit()
+
+    def applied(_):
+        best_index.remove(user_id, category_ids=set(category_ids))
+        _bump_user_version(user_id)
+
+    await batcher.submit(apply, applied)
 
 # Удалить все кешбэки пользователя
+@timed_query
 async def delete_all_cashbacks(user_id: int):
-    async with get_db() as db:
+    async def apply(db):
         await db.execute('DELETE FROM cashback WHERE user_id = ?', (user_id,))
-        await db.commit()
 
+    def applied(_):
+        best_index.remove(user_id)
+        _bump_user_version(user_id)
 
-async def get_user_bank_category_pairs(user_id):
-    async with get_db() as db:
-        cursor = await db.execute('''
-            SELECT id, 
-                   (SELECT name FROM banks WHERE banks.id = cashback.bank_id) AS bank_name,
-                   (SELECT name FROM categories WHERE categories.id = cashback.category_id) AS cat_name,
-                   percent
+    await batcher.submit(apply, applied)
+
+
+# Все записи пользователя для меню удаления: (period, bank_id, category_id, bank_name, category_name, percent),
+# по периодам и названиям банков. Записи удалённых категорий тоже попадают - их можно удалить.
+@timed_query
+async def get_user_entries(user_id: int):
+    ref = await reference.get()
+    async with get_read_db() as db:
+        rows = await db.execute_fetchall('''
+            SELECT period, bank_id, category_id, percent
             FROM cashback
             WHERE user_id = ?
         ''', (user_id,))
-        return await cursor.fetchall()
+    result = [
+        (period, bank_id, category_id, ref.bank_names.get(bank_id, "?"), ref.category_names.get(category_id, "?"),
+         percent)
+        for period, bank_id, category_id, percent in rows
+    ]
+    result.sort(key=lambda row: (row[0], row[3], row[4]))
+    return result
+
+
+# keys - ключи записей (period, bank_id, category_id); удаляются одним запросом
+@timed_query
+async def delete_cashback_entries(user_id, keys):
+    if not keys:
+        return
+    async def apply(db):
+        values = ", ".join("(?, ?, ?)" for _ in keys)
+        await db.execute(f'''
+            DELETE FROM cashback
+            WHERE user_id = ? AND (period, bank_id, category_id) IN (VALUES {values})
+        ''', (user_id, *(value for key in keys for value in key)))
 
+    def applied(_):
+        best_index.remove(user_id, keys=[(bank_id, category_id) for period, bank_id, category_id in keys
+                                         if period == best_index.period])
+        _bump_user_version(user_id)
 
-async def delete_cashback_entries(user_id, entry_ids):
-    if not entry_ids:
-        return
-    placeholders = ','.join('?' for _ in entry_ids)
+    await batcher.submit(apply, applied)
+
+
+# Архив и обслуживание
+
+# Перенести в архив до limit строк с периодом раньше before одной транзакцией.
+# Возвращает число перенесённых строк (0 - переносить больше нечего).
+@timed_query
+async def archive_cashback_batch(before: int, limit: int) -> int:
     async with get_db() as db:
-        await db.execute(f'''
+        rows = await db.execute_fetchall('''
             DELETE FROM cashback
-            WHERE user_id = ? AND id IN ({placeholders})
-        ''', (user_id, *entry_ids))
-        await db.commit()
\ No newline at end of file
+            WHERE (user_id, period, bank_id, category_id) IN (
+                SELECT user_id, period, bank_id, category_id FROM cashback WHERE period < ? LIMIT ?
+            )
+            RETURNING user_id, period, bank_id, category_id, percent
+        ''', (before, limit))
+        if rows:
+            archived_at = time.time()
+            await db.executemany('''
+                INSERT OR REPLACE INTO cashback_archive (user_id, period, bank_id, category_id, percent, archived_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', [(*row, archived_at) for row in rows])
+        await db.commit()
+    for user_id in {row[0] for row in rows}:
+        _bump_user_version(user_id)
+    return len(rows)
+
+
+# Включён ли auto_vacuum = INCREMENTAL; без него incremental_vacuum ничего не освобождает
+async def incremental_vacuum_enabled() -> bool:
+    async with get_read_db() as db:
+        rows = await db.execute_fetchall("PRAGMA auto_vacuum")
+    return rows[0][0] == 2
+
+
+# Включить auto_vacuum = INCREMENTAL на базе, созданной без него. Режим меняется
+# только полным VACUUM, который держит блокировку на запись всё время работы,
+# поэтому это ручное обслуживание при остановленном боте (python retention.py vacuum).
+# Возвращает True, если VACUUM был.
+async def enable_incremental_vacuum() -> bool:
+    async with get_db() as db:
+        rows = await db.execute_fetchall("PRAGMA auto_vacuum")
+        if rows[0][0] == 2:
+            return False
+        await db.execute_fetchall("PRAGMA auto_vacuum = INCREMENTAL")
+        await db.execute_fetchall("VACUUM")
+    return True
+
+
+# Вернуть файлу до pages свободных страниц; возвращает, сколько свободных осталось
+@timed_query
+async def incremental_vacuum(pages: int) -> int:
+    async with get_db() as db:
+        await db.execute_fetchall(f"PRAGMA incremental_vacuum({int(pages)})")
+        rows = await db.execute_fetchall("PRAGMA freelist_count")
+    return rows[0][0]
+
+
+# Напоминания о новом месяце. period - номер месяца, в журнале рассылок
+# хранится текстом ГГГГ-ММ
+
+@timed_query
+async def get_reminder_run(period: int):
+    async with get_read_db() as db:
+        rows = await db.execute_fetchall('''
+            SELECT started_at, finished_at, sent, failed FROM reminder_runs WHERE period = ?
+        ''', (period_text(period),))
+    return rows[0] if rows else None
+
+
+@timed_query
+async def start_reminder_run(period: int):
+    async with get_db() as db:
+        await db.execute('''
+            INSERT OR IGNORE INTO reminder_runs (period, started_at) VALUES (?, ?)
+        ''', (period_text(period), time.time()))
+        await db.commit()
+
+
+@timed_query
+async def finish_reminder_run(period: int):
+    async with get_db() as db:
+        await db.execute("UPDATE reminder_runs SET finished_at = ? WHERE period = ?",
+                         (time.time(), period_text(period)))
+        await db.commit()
+
+
+# Следующие limit получателей после after_user_id одним запросом: пользователи
+# без записей за period, которым напоминание за period ещё не отправлялось
+@timed_query
+async def get_reminder_recipients(period: int, after_user_id: int, limit: int) -> list[int]:
+    async with get_read_db() as db:
+        rows = await db.execute_fetchall('''
+            SELECT u.user_id FROM users u
+            WHERE u.user_id > ?
+              AND NOT EXISTS (SELECT 1 FROM cashback c WHERE c.user_id = u.user_id AND c.period = ?)
+              AND NOT EXISTS (SELECT 1 FROM reminder_log r WHERE r.period = ? AND r.user_id = u.user_id)
+            ORDER BY u.user_id
+            LIMIT ?
+        ''', (after_user_id, period, period_text(period), limit))
+    return [row[0] for row in rows]
+
+
+# results - (user_id, status), status 'sent' или причина неудачи
+@timed_query
+async def save_reminder_results(period: int, results: list):
+    if not results:
+        return
+    now = time.time()
+    period = period_text(period)
+    sent = sum(1 for _, status in results if status == 'sent')
+    async with get_db() as db:
+        await db.executemany('''
+            INSERT OR REPLACE INTO reminder_log (period, user_id, status, sent_at) VALUES (?, ?, ?, ?)
+        ''', [(period, user_id, status, now) for user_id, status in results])
+        await db.execute('''
+            UPDATE reminder_runs SET sent = sent + ?, failed = failed + ? WHERE period = ?
+        ''', (sent, len(results) - sent, period))
+        await db.commit()
+
+
+# Состояния FSM
+
+@timed_query
+async def get_fsm_record(chat_id: int, user_id: int):
+    async with get_read_db() as db:
+        rows = await db.execute_fetchall('''
+            SELECT state, data, bucket, updated_at FROM fsm_state
+            WHERE chat_id = ? AND user_id = ?
+        ''', (chat_id, user_id))
+    return rows[0] if rows else None
+
+
+# Пачка изменений одной транзакцией: upserts - (chat_id, user_id, state, data, bucket, updated_at),
+# deletes - (chat_id, user_id)
+@timed_query
+async def save_fsm_records(upserts: list, deletes: list):
+    async with get_db() as db:
+        if upserts:
+            await db.executemany('''
+                INSERT INTO fsm_state (chat_id, user_id, state, data, bucket, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (chat_id, user_id) DO UPDATE SET
+                    state = excluded.state, data = excluded.data,
+                    bucket = excluded.bucket, updated_at = excluded.updated_at
+            ''', upserts)
+        if deletes:
+            await db.executemany('DELETE FROM fsm_state WHERE chat_id = ? AND user_id = ?', deletes)
+        await db.commit()
+
+
+@timed_query
+async def delete_fsm_records_before(updated_before: float):
+    async with get_db() as db:
+        cursor = await db.execute('DELETE FROM fsm_state WHERE updated_at < ?', (updated_before,))
+        await db.commit()
+        return cursor.rowcount
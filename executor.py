@@ -0,0 +1,202 @@
+# Параллельная обработка апдейтов с сохранением порядка внутри чата.
+# У каждого чата своя очередь: пока его апдейт обрабатывается, следующие
+# ждут, поэтому шаги FSM (банк -> категория -> процент -> период) не
+# переставляются. Разные чаты обрабатываются одновременно ограниченным
+# пулом воркеров; чат после каждого апдейта встаёт в конец общей очереди,
+# так что медленный пользователь не задерживает остальных. Не больше
+# max_pending апдейтов в работе - дальше submit() ждёт (backpressure).
+# Пачка апдейтов ставится в очереди целиком, не перемешиваясь с другими
+# пачками, а polling не запрашивает следующую, пока не поставлена текущая.
+import asyncio
+import contextvars
+import logging
+import time
+from collections import deque
+
+import aiohttp
+from aiohttp.helpers import sentinel
+from aiogram import Bot, Dispatcher, types
+
+from metrics import registry
+
+log = logging.getLogger(__name__)
+
+update_queue_wait = registry.histogram(
+    "bot_update_queue_wait_seconds", "Время ожидания апдейта в очереди чата до начала обработки")
+
+_executors = []  # для метрик очередей
+registry.callback("bot_update_queue_depth", "Апдейты в очередях чатов, включая обрабатываемые",
+                  lambda: sum(executor.pending for executor in _executors))
+registry.callback("bot_update_active_chats", "Чаты с апдейтами в очереди или в обработке",
+                  lambda: sum(len(executor._chats) for executor in _executors))
+
+
+# Ключ очереди: чат, а если его нет (inline-запросы) - пользователь
+def update_key(update: types.Update):
+    if update.message:
+        return update.message.chat.id
+    if update.edited_message:
+        return update.edited_message.chat.id
+    if update.callback_query:
+        call = update.callback_query
+        return call.message.chat.id if call.message else call.from_user.id
+    if update.inline_query:
+        return update.inline_query.from_user.id
+    if update.chosen_inline_result:
+        return update.chosen_inline_result.from_user.id
+    # Остальное порядка не требует
+    return ("update", update.update_id)
+
+
+class UpdateExecutor:
+    def __init__(self, dp: Dispatcher, workers: int = 16, max_pending: int = 1000):
+        self.dp = dp
+        self.workers = workers
+        self._slots = asyncio.Semaphore(max_pending)
+        self._submit_lock = asyncio.Lock()  # пачка занимает места подряд, без чужих апдейтов между
+        self._chats = {}  # ключ -> deque[(update, future, время постановки)]
+        self._ready = asyncio.Queue()  # ключи чатов, у которых есть апдейт к обработке
+        self._tasks = []
+        self._context = None
+        self.pending = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        _executors.append(self)
+
+    # Поставить апдейт в очередь его чата. Возвращает future с результатом обработки
+    async def submit(self, update: types.Update) -> asyncio.Future:
+        return (await self.submit_batch([update]))[0]
+
+    # Поставить апдейты в очереди по порядку. Пока пачка ждёт мест, другие пачки
+    # ждут её, иначе апдейты одного чата из двух пачек перемешались бы
+    async def submit_batch(self, updates) -> list:
+        self.start()
+        async with self._submit_lock:
+            futures = []
+            for update in updates:
+                await self._slots.acquire()
+                futures.append(self._enqueue(update))
+        return futures
+
+    def _enqueue(self, update: types.Update) -> asyncio.Future:
+        self.pending += 1
+        self._idle.clear()
+        future = asyncio.get_running_loop().create_future()
+        key = update_key(update)
+        queue = self._chats.get(key)
+        if queue is None:
+            self._chats[key] = deque([(update, future, time.perf_counter())])
+            self._ready.put_nowait(key)
+        else:
+            queue.append((update, future, time.perf_counter()))
+        return future
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            # Апдейт остаётся в очереди до конца обработки: новые апдейты чата
+            # встают за ним и не попадают к другому воркеру
+            queue = self._chats[key]
+            update, future, enqueued_at = queue[0]
+            update_queue_wait.observe(time.perf_counter() - enqueued_at)
+            try:
+                # Каждый апдейт - в свежей копии контекста: aiogram кеширует в ContextVar
+                # состояние FSM (StateFilter.ctx_state), и в общем контексте воркера
+                # оно досталось бы следующему апдейту, возможно, другого пользователя
+                result = await asyncio.create_task(self.dp.updates_handler.notify(update),
+                                                   context=self._context.copy())
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                queue.popleft()
+                if queue:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._chats[key]
+                self.pending -= 1
+                self._slots.release()
+                if not self.pending:
+                    self._idle.set()
+
+    def start(self):
+        if self._tasks:
+            return
+        # Апдейты обрабатываются в копиях контекста, в котором выставлены текущие бот и диспетчер
+        Dispatcher.set_current(self.dp)
+        Bot.set_current(self.dp.bot)
+        self._context = contextvars.copy_context()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    # Дождаться обработки всего, что уже принято, и остановить воркеров
+    async def close(self):
+        if not self._tasks:
+            return
+        await self._idle.wait()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+def _log_failure(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is not None:
+        log.error("polling_update_failed", exc_info=future.exception())
+
+
+# Диспетчер, который обрабатывает апдейты через UpdateExecutor. process_updates
+# вызывают polling (start_polling) и нагрузочный тест; вебхук ставит апдейты
+# в executor напрямую и не ждёт их обработки.
+class OrderedDispatcher(Dispatcher):
+    def __init__(self, *args, workers: int = 16, max_pending: int = 1000, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.executor = UpdateExecutor(self, workers=workers, max_pending=max_pending)
+
+    async def process_updates(self, updates, fast: bool = True):
+        futures = await self.executor.submit_batch(updates)
+        return await asyncio.gather(*futures)
+
+    # Как Dispatcher.start_polling, но следующий getUpdates - только после того, как
+    # пачка поставлена в очереди: при заполненном executor опрос ждёт, а не копит задачи.
+    # Обработку пачки не ждём; хендлеры отвечают сами (sender.py), а не возвратом ответа.
+    async def start_polling(self, timeout=20, relax=0.1, limit=None, reset_webhook=None, fast: bool = True,
+                            error_sleep: int = 5, allowed_updates=None):
+        if self._polling:
+            raise RuntimeError("Polling already started")
+        log.info("polling_started")
+        Dispatcher.set_current(self)
+        Bot.set_current(self.bot)
+        if reset_webhook is None:
+            await self.reset_webhook(check=False)
+        if reset_webhook:
+            await self.reset_webhook(check=True)
+
+        self._polling = True
+        offset = None
+        try:
+            request_timeout = None
+            if self.bot.timeout is not sentinel and timeout is not None:
+                request_timeout = aiohttp.ClientTimeout(total=self.bot.timeout.total + timeout or 1)
+            while self._polling:
+                try:
+                    with self.bot.request_timeout(request_timeout):
+                        updates = await self.bot.get_updates(limit=limit, offset=offset, timeout=timeout,
+                                                             allowed_updates=allowed_updates)
+                except asyncio.CancelledError:
+                    break
+                except Exception:
+                    log.exception("polling_get_updates_failed")
+                    await asyncio.sleep(error_sleep)
+                    continue
+                if updates:
+                    offset = updates[-1].update_id + 1
+                    for future in await self.executor.submit_batch(updates):
+                        future.add_done_callback(_log_failure)
+                if relax:
+                    await asyncio.sleep(relax)
+        finally:
+            self._close_waiter.set_result(None)
+            log.warning("polling_stopped")
@@ -0,0 +1,91 @@
+# Локальная заглушка Telegram Bot API для нагрузочных тестов и проверки рассылок.
+# Бот направляется на неё через TELEGRAM_API_SERVER=http://host:port.
+# Отвечает на sendMessage / sendDocument / editMessageText / editMessageReplyMarkup /
+# answerCallbackQuery и прочие методы, запоминает последнюю клавиатуру в
+# каждом чате и с заданной вероятностью отвечает 429 с retry_after.
+import json
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+
+class FakeBotAPI:
+    def __init__(self, flood_rate: float = 0.0, retry_after: int = 1, seed: int = None):
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.floods = Counter()
+        self.last_markup = {}
+        self.sent = []  # (chat_id, method, text) для проверок
+        self._message_ids = Counter()
+        self._random = random.Random(seed)
+        self._runner = None
+
+    def _message(self, chat_id, message_id, text, reply_markup):
+        message = {"message_id": message_id, "date": int(time.time()),
+                   "chat": {"id": chat_id, "type": "private"}, "text": text or ""}
+        if reply_markup:
+            message["reply_markup"] = reply_markup
+        return message
+
+    async def handle(self, request: web.Request):
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] += 1
+
+        if self.flood_rate and self._random.random() < self.flood_rate:
+            self.floods[method] += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+
+        chat_id = int(params["chat_id"]) if "chat_id" in params else None
+        reply_markup = json.loads(params["reply_markup"]) if params.get("reply_markup") else None
+
+        if method in ("sendMessage", "sendDocument"):
+            self._message_ids[chat_id] += 1
+            self.last_markup[chat_id] = reply_markup
+            self.sent.append((chat_id, method, params.get("text") or params.get("caption")))
+            result = self._message(chat_id, self._message_ids[chat_id], params.get("text"), reply_markup)
+        elif method in ("editMessageText", "editMessageReplyMarkup") and chat_id is not None:
+            self.last_markup[chat_id] = reply_markup
+            self.sent.append((chat_id, method, params.get("text")))
+            result = self._message(chat_id, int(params.get("message_id", 0)), params.get("text"), reply_markup)
+        elif method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def last_message_id(self, chat_id) -> int:
+        return self._message_ids[chat_id]
+
+    # callback_data инлайн-кнопок последней клавиатуры в чате
+    def buttons(self, chat_id, prefix: str = "") -> list:
+        markup = self.last_markup.get(chat_id) or {}
+        return [button["callback_data"]
+                for row in markup.get("inline_keyboard", ())
+                for button in row
+                if button.get("callback_data", "").startswith(prefix)]
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8081) -> str:
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
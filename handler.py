@@ -1,14 +1,30 @@
 # --- handler.py ---
+import io
+import logging
+
 from aiogram import types
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
+from aiogram.utils.markdown import quote_html
+from aiogram.utils.exceptions import BotBlocked, ChatNotFound, UserDeactivated, CantInitiateConversation
 
-from database import register_user, get_banks, get_categories, insert_cashback, get_user_friend, set_user_friend, \
-    delete_all_cashbacks, get_user_bank_category_pairs, \
+from database import register_user, get_banks, get_categories, insert_cashback, leave_group, user_exists, \
+    get_user_group, create_group_invite, accept_group_invite, decline_group_invite, \
+    delete_all_cashbacks, get_user_entries, \
     delete_cashback_entries, add_categories, delete_category
-from core import determine_period, format_cashbacks, get_next_two_periods, delete_menu_keyboard, \
-    confirm_all_deletion_keyboard, bank_category_selection_keyboard
+from core import add_cashback_to_free_period, format_cashbacks, format_group_cashbacks, format_best_cashbacks, \
+    get_next_two_periods, MONTHS_RU
+from units import format_percent, period_month, period_year, period_text, to_basis_points
+from keyboards import get_exit_button, banks_keyboard, categories_keyboard, admin_delete_categories_keyboard, \
+    delete_selection_keyboard, PERCENT_KEYBOARD, ADMIN_MENU_KEYBOARD, DELETE_MENU_KEYBOARD, \
+    CONFIRM_ALL_DELETION_KEYBOARD, group_invite_keyboard
+from transfer import import_lines, export_csv, parse_quick_add
+from settings import IMPORT_MAX_ROWS, IMPORT_MAX_BYTES
+from sender import sender, answer, edit_text, edit_reply_markup, answer_callback
+
+
+log = logging.getLogger(__name__)
 
 
 class MenuState(StatesGroup):
@@ -27,6 +43,10 @@ class DeleteStates(StatesGroup):
     confirming_all = State()
 
 
+class ImportState(StatesGroup):
+    waiting_for_data = State()
+
+
 class AdminState(StatesGroup):
     menu = State()
     add_cashback_category = State()
@@ -37,59 +57,47 @@ def main_menu_keyboard():
     return ReplyKeyboardMarkup(resize_keyboard=True).add(
         KeyboardButton("📊 Показать мой кешбек"),
         KeyboardButton("🤝 Показать наш кешбек")
-    )
-
-
-def get_exit_button():
-    return InlineKeyboardButton("✖️ Выход", callback_data="exit")
+    ).add(KeyboardButton("💳 Чем платить"))
 
 
 def register_handlers(dp):
     @dp.message_handler(commands="start")
     async def start_cmd(msg: types.Message):
-        print(f"{msg.from_user.username}, commands='start'")
-        await register_user(msg.from_user.id)
-        await msg.answer("Добро пожаловать!", reply_markup=main_menu_keyboard())
+        log.info("command=start user_id=%s username=%s", msg.from_user.id, msg.from_user.username)
+        await register_user(msg.from_user.id, msg.from_user.full_name)
+        await answer(msg, "Добро пожаловать!", reply_markup=main_menu_keyboard())
 
 
     # Обработка выхода через кнопку
     @dp.callback_query_handler(lambda c: c.data == "exit", state='*')
     async def exit_process(call: types.CallbackQuery, state: FSMContext):
         await state.finish()
-        await call.message.edit_text("Отменено", reply_markup=None)
-        await call.answer()  # чтобы убрать "часики" у кнопки
+        await edit_text(call.message, "Отменено", reply_markup=None)
+        await answer_callback(call)  # чтобы убрать "часики" у кнопки
 
+    # Номер страницы в навигации - просто убрать "часики"
+    @dp.callback_query_handler(text="noop", state="*")
+    async def noop(call: types.CallbackQuery):
+        await answer_callback(call)
 
     @dp.message_handler(commands="admin")
     async def add_cashback_category(msg: types.Message, state: FSMContext):
-        print(f"{msg.from_user.username}, commands='admin'")
-        markup = InlineKeyboardMarkup(row_width=1)
-        markup.add(InlineKeyboardButton("Добавить категорию", callback_data="add_cashback_category"))
-        markup.add(InlineKeyboardButton("Удалить категорию", callback_data="delete_cashback_category"))
-        markup.add(get_exit_button())
-
-        print(f"Клавиатура: {markup}")  # Отладка
-
-        await msg.answer("Выберите действие:", reply_markup=markup)
+        log.info("command=admin user_id=%s username=%s", msg.from_user.id, msg.from_user.username)
+        await answer(msg, "Выберите действие:", reply_markup=ADMIN_MENU_KEYBOARD)
         await state.set_state(AdminState.menu)
 
     @dp.callback_query_handler(text="back_to_admin", state="*")
     async def back_to_admin_menu(call: types.CallbackQuery, state: FSMContext):
-        markup = InlineKeyboardMarkup(row_width=1)
-        markup.add(InlineKeyboardButton("Добавить категорию", callback_data="add_cashback_category"))
-        markup.add(InlineKeyboardButton("Удалить категорию", callback_data="delete_cashback_category"))
-        markup.add(get_exit_button())
-
-        await call.message.answer("Выберите действие:", reply_markup=markup)
+        await answer(call.message, "Выберите действие:", reply_markup=ADMIN_MENU_KEYBOARD)
         await state.set_state(AdminState.menu)
-        await call.answer()
+        await answer_callback(call)
 
     @dp.callback_query_handler(text="add_cashback_category", state=AdminState.menu)
     async def add_category_handler(call: types.CallbackQuery, state: FSMContext):
-        print("DEBUG: нажата кнопка", call.data)
+        log.debug("callback=%s user_id=%s", call.data, call.from_user.id)
         markup = InlineKeyboardMarkup()
         markup.add(InlineKeyboardButton("🔙 Назад", callback_data="back_to_admin"))
-        await call.message.answer("Добавление категории\nВведите название категории:", reply_markup=markup)
+        await answer(call.message, "Добавление категории\nВведите название категории:", reply_markup=markup)
         await state.set_state(AdminState.add_cashback_category)
 
     @dp.message_handler(state=AdminState.add_cashback_category)
@@ -99,30 +107,32 @@ def register_handlers(dp):
         try:
             await add_categories(text)
         except ValueError:
-            await msg.answer("Ошибка")
+            await answer(msg, "Ошибка")
             return
 
         await state.finish()
-        await msg.answer("Категория успешно добавлена!", reply_markup=main_menu_keyboard())
+        await answer(msg, "Категория успешно добавлена!", reply_markup=main_menu_keyboard())
 
 
     @dp.callback_query_handler(text="delete_cashback_category", state=AdminState.menu)
     async def delete_category_handler(call: types.CallbackQuery, state: FSMContext):
-        print("DEBUG: нажата кнопка", call.data)
+        log.debug("callback=%s user_id=%s", call.data, call.from_user.id)
         cats = await get_categories()
         if not cats:
-            await call.message.answer("Нет доступных категорий для удаления.")
-            await call.answer()
+            await answer(call.message, "Нет доступных категорий для удаления.")
+            await answer_callback(call)
             return
 
-        markup = InlineKeyboardMarkup(row_width=1)
-        for cat_id, name in cats:
-            markup.add(InlineKeyboardButton(f"❌ {name}", callback_data=f"delete_cat_{cat_id}"))
-        markup.add(InlineKeyboardButton("🔙 Назад", callback_data="back_to_admin"))
-
-        await call.message.answer("Выберите категорию для удаления:", reply_markup=markup)
+        await answer(call.message, "Выберите категорию для удаления:",
+                     reply_markup=await admin_delete_categories_keyboard())
         await state.set_state(AdminState.delete_cashback_category)
 
+    @dp.callback_query_handler(lambda c: c.data.startswith("delcatpage_"), state=AdminState.delete_cashback_category)
+    async def delete_category_page(call: types.CallbackQuery):
+        page = int(call.data.split("_")[1])
+        await edit_reply_markup(call.message, reply_markup=await admin_delete_categories_keyboard(page))
+        await answer_callback(call)
+
 
     @dp.callback_query_handler(lambda c: c.data.startswith("delete_cat_"), state=AdminState.delete_cashback_category)
     async def confirm_delete_category(call: types.CallbackQuery, state: FSMContext):
@@ -130,153 +140,157 @@ def register_handlers(dp):
 
         try:
             await delete_category(cat_id)
-            await call.message.answer("Категория успешно удалена.")
+            await answer(call.message, "Категория успешно удалена.")
             await state.finish()
         except Exception as e:
-            await call.message.answer(f"Ошибка при удалении: {e}")
+            await answer(call.message, f"Ошибка при удалении: {e}")
 
             await state.set_state(AdminState.menu)
 
             # Покажем снова админ-меню
-            markup = InlineKeyboardMarkup(row_width=1)
-            markup.add(InlineKeyboardButton("Добавить категорию", callback_data="add_cashback_category"))
-            markup.add(InlineKeyboardButton("Удалить категорию", callback_data="delete_cashback_category"))
-            markup.add(get_exit_button())
-
-            await call.message.answer("Выберите действие:", reply_markup=markup)
-            await call.answer()
+            await answer(call.message, "Выберите действие:", reply_markup=ADMIN_MENU_KEYBOARD)
+            await answer_callback(call)
 
 
 
 
     @dp.message_handler(commands="add")
     async def add_cashback(msg: types.Message, state: FSMContext):
-        print(f"{msg.from_user.username}, commands='add'")
-        banks = await get_banks()
-        markup = InlineKeyboardMarkup(row_width=1)
-        for bid, name in banks:
-            markup.add(InlineKeyboardButton(name, callback_data=f"bank_{bid}"))
-        markup.add(get_exit_button())
-        await msg.answer("Выберите банк:", reply_markup=markup)
+        log.info("command=add user_id=%s username=%s", msg.from_user.id, msg.from_user.username)
+        if msg.get_args():
+            return await quick_add(msg)
+        await answer(msg, "Выберите банк:", reply_markup=await banks_keyboard())
         await state.set_state(MenuState.selecting_bank)
 
+    # "/add тбанк аптеки 5 [2026-11]" - запись одним сообщением, без клавиатур.
+    # Без периода запись идёт в первый свободный месяц. Если заняты оба, ничего не меняем:
+    # как и в /add с клавиатурой, месяц для замены выбирает пользователь (командой с периодом).
+    async def quick_add(msg: types.Message):
+        parsed = await parse_quick_add(msg.get_args())
+        if parsed is None:
+            await answer(msg, "Не понял. Пример: <code>/add Т-банк аптеки 5</code> или "
+                             "<code>/add втб заправки 3,5 2026-11</code>")
+            return
+        bank_id, category_id, percent, period = parsed
+        if period is not None:
+            await insert_cashback(msg.from_user.id, bank_id, category_id, percent, period)
+        else:
+            period = await add_cashback_to_free_period(msg.from_user.id, bank_id, category_id, percent)
+        banks, categories = dict(await get_banks()), dict(await get_categories())
+        if period is None:
+            args = quote_html(msg.get_args())
+            cur, nxt = get_next_two_periods()
+            await answer(msg, f"{banks[bank_id]} → {categories[category_id]} уже есть и на "
+                              f"{MONTHS_RU[period_month(cur)].lower()}, и на {MONTHS_RU[period_month(nxt)].lower()}. "
+                              f"Чтобы заменить процент, укажите месяц:\n"
+                              f"<code>/add {args} {period_text(cur)}</code>\n"
+                              f"<code>/add {args} {period_text(nxt)}</code>")
+            return
+        await answer(msg, f"✅ {banks[bank_id]} → {categories[category_id]}: {format_percent(percent)} "
+                         f"({MONTHS_RU[period_month(period)]} {period_year(period)})")
+
     @dp.callback_query_handler(lambda c: c.data.startswith("bank_"), state=MenuState.selecting_bank)
     async def choose_bank(call: types.CallbackQuery, state: FSMContext):
         bid = int(call.data.split("_")[1])
         await state.update_data(bank_id=bid)
-        cats = await get_categories()
-        markup = InlineKeyboardMarkup(row_width=1)
-        for cid, name in cats:
-            markup.add(InlineKeyboardButton(name, callback_data=f"cat_{cid}"))
-        # Добавляем кнопку "Выход"
-        markup.add(
-            InlineKeyboardButton("🔙 Назад", callback_data="back_to_bank"),
-            get_exit_button()
-        )
-        await call.message.edit_text("Выберите категорию:", reply_markup=markup)
+        await edit_text(call.message, "Выберите категорию:", reply_markup=await categories_keyboard())
         await state.set_state(MenuState.selecting_category)
 
+    @dp.callback_query_handler(lambda c: c.data.startswith("bankpage_"), state=MenuState.selecting_bank)
+    async def banks_page(call: types.CallbackQuery):
+        page = int(call.data.split("_")[1])
+        await edit_reply_markup(call.message, reply_markup=await banks_keyboard(page))
+        await answer_callback(call)
+
+    @dp.callback_query_handler(lambda c: c.data.startswith("catpage_"), state=MenuState.selecting_category)
+    async def categories_page(call: types.CallbackQuery):
+        page = int(call.data.split("_")[1])
+        await edit_reply_markup(call.message, reply_markup=await categories_keyboard(page))
+        await answer_callback(call)
+
     @dp.callback_query_handler(lambda c: c.data == "back_to_bank", state=MenuState.selecting_category)
     async def back_to_bank(call: types.CallbackQuery, state: FSMContext):
-        banks = await get_banks()
-        markup = InlineKeyboardMarkup(row_width=1)
-        for bid, name in banks:
-            markup.add(InlineKeyboardButton(name, callback_data=f"bank_{bid}"))
-        markup.add(get_exit_button())
-        await call.message.edit_text("Выберите банк:", reply_markup=markup)
+        await edit_text(call.message, "Выберите банк:", reply_markup=await banks_keyboard())
         await state.set_state(MenuState.selecting_bank)
-        await call.answer()
+        await answer_callback(call)
 
     @dp.callback_query_handler(lambda c: c.data.startswith("cat_"), state=MenuState.selecting_category)
     async def choose_category(call: types.CallbackQuery, state: FSMContext):
         cid = int(call.data.split("_")[1])
         await state.update_data(category_id=cid)
-        markup = InlineKeyboardMarkup()
-        for row in [[1, 2, 3], [4, 5, 6], [7, 8, 9], [10, 15]]:
-            markup.row(*[InlineKeyboardButton(f"{p}%", callback_data=f"percent_{p}") for p in row])
-        # Кнопки назад и выход
-        markup.row(
-            InlineKeyboardButton("🔙 Назад", callback_data="back_to_category"),
-            get_exit_button()
-        )
-        await call.message.edit_text("Выберите процент:", reply_markup=markup)
+        await edit_text(call.message, "Выберите процент:", reply_markup=PERCENT_KEYBOARD)
         await state.set_state(MenuState.selecting_percent)
-        await call.answer()
+        await answer_callback(call)
 
     @dp.callback_query_handler(lambda c: c.data == "back_to_category", state=MenuState.selecting_percent)
     async def back_to_category(call: types.CallbackQuery, state: FSMContext):
-        cats = await get_categories()
-        markup = InlineKeyboardMarkup(row_width=1)
-        for cid, name in cats:
-            markup.add(InlineKeyboardButton(name, callback_data=f"cat_{cid}"))
-        markup.add(
-            InlineKeyboardButton("🔙 Назад", callback_data="back_to_bank"),
-            get_exit_button()
-        )
-        await call.message.edit_text("Выберите категорию:", reply_markup=markup)
+        await edit_text(call.message, "Выберите категорию:", reply_markup=await categories_keyboard())
         await state.set_state(MenuState.selecting_category)
-        await call.answer()
+        await answer_callback(call)
 
     @dp.callback_query_handler(lambda c: c.data.startswith("percent_"), state=MenuState.selecting_percent)
     async def choose_percent(call: types.CallbackQuery, state: FSMContext):
-        pct = float(call.data.split("_")[1])
+        pct = to_basis_points(float(call.data.split("_")[1]))
         await state.update_data(percent=pct)
         data = await state.get_data()
-        period = await determine_period(call.from_user.id, data['bank_id'], data['category_id'])
+        period = await add_cashback_to_free_period(call.from_user.id, data['bank_id'], data['category_id'], pct)
         if period:
-            await insert_cashback(call.from_user.id, data['bank_id'], data['category_id'], pct, period)
-            await call.message.edit_text("Кешбек добавлен!", reply_markup=None)
+            await edit_text(call.message, "Кешбек добавлен!", reply_markup=None)
             await state.finish()
         else:
             cur, nxt = get_next_two_periods()
             markup = InlineKeyboardMarkup().add(
-                InlineKeyboardButton(f"Текущий ({cur})", callback_data=f"period_{cur}"),
-                InlineKeyboardButton(f"Следующий ({nxt})", callback_data=f"period_{nxt}"),
+                InlineKeyboardButton(f"Текущий ({period_text(cur)})", callback_data=f"period_{cur}"),
+                InlineKeyboardButton(f"Следующий ({period_text(nxt)})", callback_data=f"period_{nxt}"),
                 get_exit_button()
             )
-            await call.message.edit_text("Выберите период:", reply_markup=markup)
+            await edit_text(call.message, "Выберите период:", reply_markup=markup)
             await state.set_state(MenuState.selecting_period)
-        await call.answer()
+        await answer_callback(call)
 
     @dp.callback_query_handler(lambda c: c.data.startswith("period_"), state=MenuState.selecting_period)
     async def choose_period(call: types.CallbackQuery, state: FSMContext):
-        period = call.data.split("_")[1]
+        period = int(call.data.split("_")[1])
         data = await state.get_data()
         await insert_cashback(call.from_user.id, data['bank_id'], data['category_id'], data['percent'], period)
-        await call.message.edit_text("Кешбек добавлен!", reply_markup=None)
+        await edit_text(call.message, "Кешбек добавлен!", reply_markup=None)
         await state.finish()
-        await call.answer()
+        await answer_callback(call)
 
     @dp.message_handler(lambda m: m.text == "📊 Показать мой кешбек")
     async def my_cashbacks(msg: types.Message):
-        print(f"{msg.from_user.username}, commands='📊 Показать мой кешбек'")
+        log.info("command=my_cashbacks user_id=%s username=%s", msg.from_user.id, msg.from_user.username)
         text = await format_cashbacks(msg.from_user.id)
-        await msg.answer(text)
+        await answer(msg, text)
 
     @dp.message_handler(lambda m: m.text == "🤝 Показать наш кешбек")
     async def shared_cashbacks(msg: types.Message):
-        print(f"{msg.from_user.username}, commands='🤝 Показать наш кешбек'")
-        uid = msg.from_user.id
-        fid = await get_user_friend(uid)
-        if not fid:
-            return await msg.answer("У вас нет друга.")
-        utext = await format_cashbacks(uid)
-        ftext = await format_cashbacks(fid)
-        await msg.answer(f"Ваш кешбек:\n{utext}")
-        await msg.answer(f"Кешбек друга:\n{ftext}")
+        log.info("command=shared_cashbacks user_id=%s username=%s", msg.from_user.id, msg.from_user.username)
+        text = await format_group_cashbacks(msg.from_user.id)
+        if text is None:
+            return await answer(msg, "Вы не состоите в группе. Добавьте участника: /addfriend")
+        await answer(msg, text)
+
+    @dp.message_handler(commands=["best"])
+    @dp.message_handler(lambda m: m.text == "💳 Чем платить")
+    async def best_cashbacks(msg: types.Message):
+        log.info("command=best_cashbacks user_id=%s username=%s", msg.from_user.id, msg.from_user.username)
+        await answer(msg, await format_best_cashbacks(msg.from_user.id))
 
     @dp.message_handler(commands=["addfriend"])
     async def add_friend_start(msg: types.Message, state: FSMContext):
         markup = InlineKeyboardMarkup().add(get_exit_button())
-        await msg.answer(
-            "Введите Telegram ID вашего друга (число) или нажмите кнопку 'Выход', чтобы отменить.",
+        await answer(
+            msg,
+            "Введите Telegram ID участника группы (число) или нажмите кнопку 'Выход', чтобы отменить.\n"
+            "Участник получит приглашение и попадёт в группу, когда примет его.",
             reply_markup=markup
         )
         await state.set_state(FriendState.waiting_for_friend)
 
     @dp.message_handler(lambda m: m.text == "➕ Добавить друга")
-    async def add_friend_from_menu(msg: types.Message):
-        await add_friend_start(msg, None)
+    async def add_friend_from_menu(msg: types.Message, state: FSMContext):
+        await add_friend_start(msg, state)
 
     @dp.message_handler(state=FriendState.waiting_for_friend)
     async def add_friend_process(msg: types.Message, state: FSMContext):
@@ -285,68 +299,180 @@ def register_handlers(dp):
         try:
             friend_id = int(text)
         except ValueError:
-            await msg.answer("Неверный формат. Введите числовой Telegram ID.")
+            await answer(msg, "Неверный формат. Введите числовой Telegram ID.")
             return
 
         if friend_id == msg.from_user.id:
-            await msg.answer("Нельзя добавить самого себя.")
+            await answer(msg, "Нельзя добавить самого себя.")
+            return
+
+        if not await user_exists(friend_id):
+            await answer(msg, "Этот пользователь не зарегистрирован в боте. Попросите его отправить /start.")
             return
 
-        await set_user_friend(msg.from_user.id, friend_id)
+        # Участник вступает в группу только сам, приняв приглашение: иначе любой
+        # мог бы добавить к себе чужой ID и видеть его кешбеки
+        await create_group_invite(msg.from_user.id, friend_id)
+        text = (f"{quote_html(msg.from_user.full_name)} (ID {msg.from_user.id}) приглашает вас в группу: "
+                f"участники группы видят кешбеки друг друга.")
+        if await get_user_group(friend_id) is not None:
+            text += "\nЕсли примете приглашение, вы выйдете из своей текущей группы."
+        try:
+            await sender.send_message(friend_id, text, reply_markup=group_invite_keyboard(msg.from_user.id))
+        except (BotBlocked, ChatNotFound, UserDeactivated, CantInitiateConversation):
+            await decline_group_invite(friend_id, msg.from_user.id)
+            await state.finish()
+            await answer(msg, "Не удалось отправить приглашение: пользователь недоступен.",
+                         reply_markup=main_menu_keyboard())
+            return
         await state.finish()
-        await msg.answer("Друг успешно добавлен!", reply_markup=main_menu_keyboard())
+        await answer(msg, "Приглашение отправлено. Участник появится в группе, когда примет его.",
+                     reply_markup=main_menu_keyboard())
+
+    # Ответ на приглашение. Принять можно только существующее приглашение,
+    # адресованное нажавшему, поэтому подделанный callback_data ничего не даст
+    @dp.callback_query_handler(lambda c: c.data.startswith("ginv_"), state="*")
+    async def group_invite_answer(call: types.CallbackQuery):
+        _, action, inviter = call.data.split("_")
+        inviter_id = int(inviter)
+        log.info("callback=group_invite action=%s user_id=%s inviter_id=%s", action, call.from_user.id, inviter_id)
+        if action == "accept":
+            if await accept_group_invite(call.from_user.id, inviter_id) is None:
+                await edit_text(call.message, "Приглашение уже недействительно.", reply_markup=None)
+                return await answer_callback(call)
+            await edit_text(call.message, "Вы вступили в группу.", reply_markup=None)
+            reply = f"{quote_html(call.from_user.full_name)} принял(а) приглашение в группу."
+        else:
+            await decline_group_invite(call.from_user.id, inviter_id)
+            await edit_text(call.message, "Приглашение отклонено.", reply_markup=None)
+            reply = f"{quote_html(call.from_user.full_name)} отклонил(а) приглашение в группу."
+        await answer_callback(call)
+        try:
+            await sender.send_message(inviter_id, reply)
+        except (BotBlocked, ChatNotFound, UserDeactivated, CantInitiateConversation):
+            log.info("group_invite_notify_failed inviter_id=%s", inviter_id)
+
+    @dp.message_handler(commands=["leavegroup"])
+    async def leave_group_cmd(msg: types.Message):
+        await leave_group(msg.from_user.id)
+        await answer(msg, "Вы вышли из группы.", reply_markup=main_menu_keyboard())
+
+    @dp.message_handler(commands=["import"])
+    async def import_start(msg: types.Message, state: FSMContext):
+        log.info("command=import user_id=%s username=%s", msg.from_user.id, msg.from_user.username)
+        # Данные можно прислать сразу после команды в том же сообщении
+        if msg.get_args():
+            text = await import_lines(msg.from_user.id, msg.get_args().splitlines(),
+                                      get_next_two_periods()[0], IMPORT_MAX_ROWS)
+            return await answer(msg, quote_html(text), reply_markup=main_menu_keyboard())
+        await answer(
+            msg,
+            "Пришлите файл CSV/JSON или сообщение, по строке на кешбек:\n"
+            "<code>Т-банк; Аптеки; 5</code>\n"
+            "<code>ВТБ; Заправки; 3,5; 2026-11</code>\n"
+            "Период необязателен, по умолчанию текущий месяц.",
+            reply_markup=InlineKeyboardMarkup().add(get_exit_button())
+        )
+        await state.set_state(ImportState.waiting_for_data)
+
+    @dp.message_handler(content_types=[types.ContentType.TEXT, types.ContentType.DOCUMENT],
+                        state=ImportState.waiting_for_data)
+    async def import_process(msg: types.Message, state: FSMContext):
+        if msg.document:
+            if msg.document.file_size and msg.document.file_size > IMPORT_MAX_BYTES:
+                await answer(msg, f"Файл слишком большой, максимум {IMPORT_MAX_BYTES // 1024} КБ.")
+                return
+            buffer = await msg.document.download(destination_file=io.BytesIO())
+            buffer.seek(0)
+            lines = io.TextIOWrapper(buffer, encoding="utf-8-sig", errors="replace")
+        else:
+            lines = msg.text.splitlines()
+        text = await import_lines(msg.from_user.id, lines, get_next_two_periods()[0], IMPORT_MAX_ROWS)
+        await state.finish()
+        await answer(msg, quote_html(text), reply_markup=main_menu_keyboard())
+
+    @dp.message_handler(commands=["export"])
+    async def export_cmd(msg: types.Message):
+        log.info("command=export user_id=%s username=%s", msg.from_user.id, msg.from_user.username)
+        buffer = await export_csv(msg.from_user.id)
+        await sender.call(msg.answer_document, types.InputFile(buffer, filename="cashback.csv"),
+                          caption="История кешбеков")
 
     @dp.message_handler(commands=["delete"])
     async def delete_menu(msg: types.Message):
-        await msg.answer("Что вы хотите удалить?", reply_markup=delete_menu_keyboard())
+        await answer(msg, "Что вы хотите удалить?", reply_markup=DELETE_MENU_KEYBOARD)
 
+    # Записи снимаются один раз при открытии меню; дальше выбор (множество номеров
+    # записей в снимке) и страница живут в данных FSM, а клавиатура строится из снимка
     @dp.callback_query_handler(lambda c: c.data == "delete_by_categories")
     async def delete_by_bank_category(call: types.CallbackQuery, state: FSMContext):
-        pairs = await get_user_bank_category_pairs(call.from_user.id)
-        if not pairs:
-            await call.answer("Нет кешбеков для удаления", show_alert=True)
+        entries = await get_user_entries(call.from_user.id)
+        if not entries:
+            await answer_callback(call, "Нет кешбеков для удаления", show_alert=True)
             return
-        await state.update_data(selected=[])
+        await state.update_data(entries=entries, selected=set(), page=0)
         await state.set_state(DeleteStates.choosing_category)
-        await call.message.edit_text("Выберите кешбеки для удаления:",
-                                     reply_markup=bank_category_selection_keyboard(pairs))
+        await edit_text(call.message, "Выберите кешбеки для удаления:",
+                        reply_markup=delete_selection_keyboard(entries))
+
+    async def render_selection(call: types.CallbackQuery, state: FSMContext, data: dict, **changes):
+        await state.update_data(**changes)
+        data.update(changes)
+        await edit_reply_markup(
+            call.message,
+            reply_markup=delete_selection_keyboard(data["entries"], data["selected"], data["page"]))
+        await answer_callback(call)
+
+    # Если все записи группы уже выбраны - снять выбор, иначе выбрать все
+    def toggle(selected: set, ids: set) -> set:
+        return selected - ids if ids <= selected else selected | ids
 
     @dp.callback_query_handler(lambda c: c.data.startswith("delpair_"), state=DeleteStates.choosing_category)
     async def select_pair_to_delete(call: types.CallbackQuery, state: FSMContext):
         data = await state.get_data()
-        selected = data.get("selected", [])
-        entry_id_str = call.data.split("_")[1]
+        index_str = call.data.split("_")[1]
 
-        if entry_id_str == "done":
-            await delete_cashback_entries(call.from_user.id, selected)
+        if index_str == "done":
+            entries = data["entries"]
+            await delete_cashback_entries(call.from_user.id, [entries[i][:3] for i in data["selected"]])
             await state.finish()
-            await call.message.edit_text("Выбранные кешбеки удалены.")
+            await edit_text(call.message, "Выбранные кешбеки удалены.")
             return
 
-        entry_id = int(entry_id_str)
-        if entry_id in selected:
-            selected.remove(entry_id)
-        else:
-            selected.append(entry_id)
+        await render_selection(call, state, data, selected=toggle(data["selected"], {int(index_str)}))
 
-        await state.update_data(selected=selected)
-        pairs = await get_user_bank_category_pairs(call.from_user.id)
-        await call.message.edit_reply_markup(reply_markup=bank_category_selection_keyboard(pairs, selected))
-        await call.answer()
+    @dp.callback_query_handler(lambda c: c.data.startswith("delbank_"), state=DeleteStates.choosing_category)
+    async def select_bank_to_delete(call: types.CallbackQuery, state: FSMContext):
+        data = await state.get_data()
+        bank_id = int(call.data.split("_")[1])
+        ids = {i for i, entry in enumerate(data["entries"]) if entry[1] == bank_id}
+        await render_selection(call, state, data, selected=toggle(data["selected"], ids))
+
+    @dp.callback_query_handler(lambda c: c.data.startswith("delperiod_"), state=DeleteStates.choosing_category)
+    async def select_period_to_delete(call: types.CallbackQuery, state: FSMContext):
+        data = await state.get_data()
+        period = int(call.data.split("_")[1])
+        ids = {i for i, entry in enumerate(data["entries"]) if entry[0] == period}
+        await render_selection(call, state, data, selected=toggle(data["selected"], ids))
+
+    @dp.callback_query_handler(lambda c: c.data.startswith("delpage_"), state=DeleteStates.choosing_category)
+    async def select_pair_page(call: types.CallbackQuery, state: FSMContext):
+        data = await state.get_data()
+        await render_selection(call, state, data, page=int(call.data.split("_")[1]))
 
     @dp.callback_query_handler(lambda c: c.data == "delete_all_cashbacks")
     async def confirm_delete_all_menu(call: types.CallbackQuery, state: FSMContext):
         await state.set_state(DeleteStates.confirming_all)
-        await call.message.edit_text("Вы уверены, что хотите удалить все кешбеки?",
-                                     reply_markup=confirm_all_deletion_keyboard())
+        await edit_text(call.message, "Вы уверены, что хотите удалить все кешбеки?",
+                        reply_markup=CONFIRM_ALL_DELETION_KEYBOARD)
 
     @dp.callback_query_handler(lambda c: c.data == "confirm_delete_all", state=DeleteStates.confirming_all)
     async def confirm_delete_all(call: types.CallbackQuery, state: FSMContext):
         await delete_all_cashbacks(call.from_user.id)
         await state.finish()
-        await call.message.edit_text("✅ Все кешбеки удалены.")
+        await edit_text(call.message, "✅ Все кешбеки удалены.")
 
     @dp.callback_query_handler(lambda c: c.data == "cancel_delete_all", state=DeleteStates.confirming_all)
     async def cancel_delete_all(call: types.CallbackQuery, state: FSMContext):
         await state.finish()
-        await call.message.edit_text("Удаление отменено.")
+        await edit_text(call.message, "Удаление отменено.")
@@ -0,0 +1,80 @@
+# Inline-режим: "@bot апт" в любом чате показывает, какой картой платить в
+# подходящих категориях в текущем месяце. Категории ищутся по префиксному
+# индексу (matcher.PrefixIndex), лучшие карты берутся из индекса "чем платить"
+# (core.get_best_cashbacks) - таблица cashback на каждое нажатие не читается.
+# Готовые ответы кешируются в памяти по пользователю и запросу, а Telegram
+# дополнительно хранит персональный ответ INLINE_CACHE_TIME секунд.
+import hashlib
+import time
+
+from aiogram import types
+from aiogram.utils.markdown import quote_html
+
+from best import best_index
+from cache import LRUCache
+from core import get_best_cashbacks, MONTHS_RU
+from database import reference
+from matcher import get_category_index, normalize_name
+from metrics import registry
+from sender import answer_inline
+from settings import INLINE_CACHE_TIME, INLINE_CACHE_SIZE, INLINE_MAX_RESULTS
+from units import format_percent, period_month
+
+# Ключ включает версию справочников и состояние индекса для пользователя, так что
+# его изменения видны сразу. Записи живут не дольше кеша Telegram: с шардированием
+# изменения участников группы из других шардов состояние индекса не меняют.
+inline_cache = LRUCache(INLINE_CACHE_SIZE)
+registry.callback("bot_inline_cache_hits_total", "Попадания в кеш inline-ответов", lambda: inline_cache.hits,
+                  "counter")
+registry.callback("bot_inline_cache_misses_total", "Промахи кеша inline-ответов", lambda: inline_cache.misses,
+                  "counter")
+
+
+def _result_id(category_id, bank_id, percent, owner_id) -> str:
+    return hashlib.md5(f"{category_id}:{bank_id}:{percent}:{owner_id}".encode()).hexdigest()
+
+
+async def inline_results(user_id: int, query: str) -> list:
+    query = normalize_name(query)
+    key = (user_id, query, reference.version, best_index.state(user_id))
+    cached = inline_cache.get(key)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+
+    period, best, names = await get_best_cashbacks(user_id)
+    ref = await reference.get()
+    index = await get_category_index()
+    # Ищем среди всех категорий, но показываем только те, где есть кешбек
+    results = []
+    for category_id in index.search(query, len(ref.category_names)):
+        if category_id not in best:
+            continue
+        bank_id, percent, owner_id = best[category_id]
+        category, bank = ref.category_names[category_id], ref.bank_names.get(bank_id, "?")
+        owner = ""
+        if owner_id != user_id:
+            name = names.get(owner_id) if names is not None else best_index.name(owner_id)
+            owner = f" ({name or owner_id})"
+        results.append(types.InlineQueryResultArticle(
+            id=_result_id(category_id, bank_id, percent, owner_id),
+            title=f"{category}: {format_percent(percent)}",
+            description=f"{bank}{owner}, {MONTHS_RU[period_month(period)]}",
+            # Текст отправляется с parse_mode бота (HTML), а имя владельца - full_name из Telegram
+            input_message_content=types.InputTextMessageContent(
+                quote_html(f"{category}: {bank}, {format_percent(percent)}{owner}")),
+        ))
+        if len(results) == INLINE_MAX_RESULTS:
+            break
+    inline_cache.set(key, (time.monotonic() + INLINE_CACHE_TIME, results))
+    return results
+
+
+def register_inline_handlers(dp):
+    @dp.inline_handler()
+    async def inline_lookup(query: types.InlineQuery):
+        results = await inline_results(query.from_user.id, query.query)
+        if results:
+            await answer_inline(query, results, cache_time=INLINE_CACHE_TIME, is_personal=True)
+        else:
+            await answer_inline(query, [], cache_time=INLINE_CACHE_TIME, is_personal=True,
+                                switch_pm_text="Кешбеков нет — добавить", switch_pm_parameter="add")
@@ -0,0 +1,162 @@
+# Инлайн-клавиатуры. Меню из справочников (банки, категории) собираются один раз
+# на версию справочников и дальше отдаются готовыми; длинные списки
+# разбиваются на страницы по несколько кнопок в ряд.
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+from database import reference
+from units import format_percent, period_month, period_year
+
+COLUMNS = 2  # кнопок в ряд в меню банков и категорий
+PAGE_ROWS = 6  # рядов на странице
+SELECTION_PAGE_SIZE = 10  # записей на странице выбора для удаления (по одной в ряд)
+PERCENTS = [[1, 2, 3], [4, 5, 6], [7, 8, 9], [10, 15]]
+
+
+def get_exit_button():
+    return InlineKeyboardButton("✖️ Выход", callback_data="exit")
+
+
+def _page_bounds(total, page, per_page):
+    pages = max(1, -(-total // per_page))
+    page = min(max(page, 0), pages - 1)
+    return page, pages, page * per_page
+
+
+# Ряд навигации "◀️ 2/5 ▶️"; страницы листаются по кругу
+def _nav_row(page, pages, nav_prefix):
+    return [
+        InlineKeyboardButton("◀️", callback_data=f"{nav_prefix}{(page - 1) % pages}"),
+        InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="noop"),
+        InlineKeyboardButton("▶️", callback_data=f"{nav_prefix}{(page + 1) % pages}"),
+    ]
+
+
+# Ряды страницы page по columns кнопок и, если страниц несколько, навигация
+def paginate(buttons, page, nav_prefix, columns=COLUMNS, rows=PAGE_ROWS):
+    page, pages, start = _page_bounds(len(buttons), page, columns * rows)
+    chunk = buttons[start:start + columns * rows]
+    keyboard = [chunk[i:i + columns] for i in range(0, len(chunk), columns)]
+    if pages > 1:
+        keyboard.append(_nav_row(page, pages, nav_prefix))
+    return keyboard
+
+
+# Готовые клавиатуры по ключу; сбрасываются при смене версии справочников
+_cache = {}
+_cache_version = None
+
+
+# Номер страницы из callback_data приводится к существующему, чтобы не плодить ключи кеша
+def _clamp(page, count):
+    return _page_bounds(count, page, COLUMNS * PAGE_ROWS)[0]
+
+
+async def _cached(key, build):
+    global _cache_version
+    version = reference.version
+    ref = await reference.get()
+    if _cache_version != version:
+        _cache.clear()
+        _cache_version = version
+    markup = _cache.get(key)
+    if markup is None:
+        markup = _cache[key] = build(ref)
+    return markup
+
+
+async def banks_keyboard(page: int = 0):
+    def build(ref):
+        buttons = [InlineKeyboardButton(name, callback_data=f"bank_{bank_id}") for bank_id, name in ref.banks]
+        return InlineKeyboardMarkup(inline_keyboard=[
+            *paginate(buttons, page, "bankpage_"),
+            [get_exit_button()],
+        ])
+    page = _clamp(page, len((await reference.get()).banks))
+    return await _cached(("banks", page), build)
+
+
+async def categories_keyboard(page: int = 0):
+    def build(ref):
+        buttons = [InlineKeyboardButton(name, callback_data=f"cat_{category_id}")
+                   for category_id, name in ref.categories]
+        return InlineKeyboardMarkup(inline_keyboard=[
+            *paginate(buttons, page, "catpage_"),
+            [InlineKeyboardButton("🔙 Назад", callback_data="back_to_bank"), get_exit_button()],
+        ])
+    page = _clamp(page, len((await reference.get()).categories))
+    return await _cached(("categories", page), build)
+
+
+async def admin_delete_categories_keyboard(page: int = 0):
+    def build(ref):
+        buttons = [InlineKeyboardButton(f"❌ {name}", callback_data=f"delete_cat_{category_id}")
+                   for category_id, name in ref.categories]
+        return InlineKeyboardMarkup(inline_keyboard=[
+            *paginate(buttons, page, "delcatpage_"),
+            [InlineKeyboardButton("🔙 Назад", callback_data="back_to_admin")],
+        ])
+    page = _clamp(page, len((await reference.get()).categories))
+    return await _cached(("admin_delete_categories", page), build)
+
+
+# Статические меню собираются один раз при импорте
+PERCENT_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    *[[InlineKeyboardButton(f"{p}%", callback_data=f"percent_{p}") for p in row] for row in PERCENTS],
+    [InlineKeyboardButton("🔙 Назад", callback_data="back_to_category"), get_exit_button()],
+])
+
+ADMIN_MENU_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton("Добавить категорию", callback_data="add_cashback_category")],
+    [InlineKeyboardButton("Удалить категорию", callback_data="delete_cashback_category")],
+    [get_exit_button()],
+])
+
+DELETE_MENU_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton("🗂 Удалить по категориям", callback_data="delete_by_categories")],
+    [InlineKeyboardButton("💣 Удалить все кешбеки", callback_data="delete_all_cashbacks")],
+    [get_exit_button()],
+])
+
+CONFIRM_ALL_DELETION_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton("✅ Подтвердить", callback_data="confirm_delete_all")],
+    [InlineKeyboardButton("✖️ Отмена", callback_data="cancel_delete_all")],
+])
+
+
+# Приглашение в группу: кнопки получает приглашённый, в callback_data - id пригласившего
+def group_invite_keyboard(inviter_id: int):
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton("✅ Принять", callback_data=f"ginv_accept_{inviter_id}"),
+        InlineKeyboardButton("✖️ Отклонить", callback_data=f"ginv_decline_{inviter_id}"),
+    ]])
+
+
+def _period_label(period):
+    return f"{period_month(period):02d}.{period_year(period) % 100:02d}"
+
+
+# Страница выбора записей для удаления. entries - снимок из get_user_entries,
+# записи обозначаются номером в снимке; собирается только текущая страница.
+# Ниже - массовый выбор по банку и по периоду.
+def delete_selection_keyboard(entries, selected_ids=None, page: int = 0):
+    selected_ids = selected_ids or ()
+    page, pages, start = _page_bounds(len(entries), page, SELECTION_PAGE_SIZE)
+    keyboard = []
+    for index, (period, _, _, bank_name, cat_name, percent) in enumerate(
+            entries[start:start + SELECTION_PAGE_SIZE], start):
+        prefix = "✅ " if index in selected_ids else ""
+        keyboard.append([InlineKeyboardButton(
+            f"{prefix}{bank_name} → {cat_name}: {format_percent(percent)} · {_period_label(period)}",
+            callback_data=f"delpair_{index}")])
+    if pages > 1:
+        keyboard.append(_nav_row(page, pages, "delpage_"))
+    if len(entries) > 1:
+        banks = {bank_id: bank_name for _, bank_id, _, bank_name, _, _ in entries}
+        periods = sorted({period for period, *_ in entries})
+        bulk = [InlineKeyboardButton(f"🏦 {name}", callback_data=f"delbank_{bank_id}") for bank_id, name in banks.items()]
+        bulk += [InlineKeyboardButton(f"📅 {_period_label(period)}", callback_data=f"delperiod_{period}")
+                 for period in periods]
+        keyboard += [bulk[i:i + 3] for i in range(0, len(bulk), 3)]
+    keyboard.append([InlineKeyboardButton("⁉️ Удалить выбранные", callback_data="delpair_done")])
+    keyboard.append([InlineKeyboardButton("✖️ Отмена", callback_data="exit")])
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
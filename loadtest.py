@@ -0,0 +1,303 @@
+# Нагрузочный тест: прогоняет апдейты через настоящий Dispatcher из settings.py
+# с хендлерами handler.register_handlers. Бот ходит в локальную заглушку
+# Bot API (fake_api.py), которая может отвечать 429.
+#
+# Синтетические сценарии (/start, /add целиком, показ кешбека, удаление):
+#   python loadtest.py --users 500 --concurrency 50 --iterations 5
+# Проверка изоляции FSM между чатами, идущими по /add одновременно (ненулевой код при сбое):
+#   python loadtest.py --check-fsm --users 2
+# Записанные апдейты (JSONL: апдейт или {"flow": "...", "update": {...}} в строке):
+#   python loadtest.py --replay updates.jsonl --concurrency 50
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+# settings создаёт Bot при импорте, а ему нужен токен правильного формата
+os.environ.setdefault("BOT_TOKEN", "123456:loadtest")
+# Виртуальные пользователи жмут кнопки без пауз - ограничитель частоты
+# (middlewares.py) отключается, если не задан явно
+os.environ.setdefault("THROTTLE_RATE", "1000000")
+os.environ.setdefault("THROTTLE_BURST", "1000000")
+
+from aiogram import Bot, Dispatcher, types  # noqa: E402
+from aiogram.bot.api import TelegramAPIServer  # noqa: E402
+
+import database  # noqa: E402
+from executor import update_key  # noqa: E402
+from fake_api import FakeBotAPI  # noqa: E402
+from run import setup_dispatcher  # noqa: E402
+from settings import dp  # noqa: E402
+
+BASE_USER_ID = 10_000_000
+
+
+class VirtualUser:
+    def __init__(self, user_id, api: FakeBotAPI):
+        self.user_id = user_id
+        self.api = api
+        self._update_id = user_id * 1000
+
+    def _next_update_id(self):
+        self._update_id += 1
+        return self._update_id
+
+    def _user(self):
+        return {"id": self.user_id, "is_bot": False, "first_name": "Load", "username": f"load{self.user_id}"}
+
+    def message(self, text):
+        entities = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}] if text.startswith("/") else []
+        return types.Update(**{
+            "update_id": self._next_update_id(),
+            "message": {"message_id": self._update_id, "date": int(time.time()), "text": text, "entities": entities,
+                        "chat": {"id": self.user_id, "type": "private"}, "from": self._user()},
+        })
+
+    # Нажатие кнопки под последним сообщением бота в чате
+    def callback(self, data):
+        return types.Update(**{
+            "update_id": self._next_update_id(),
+            "callback_query": {
+                "id": str(self._update_id), "chat_instance": str(self.user_id), "data": data, "from": self._user(),
+                "message": {"message_id": self.api.last_message_id(self.user_id), "date": int(time.time()),
+                            "chat": {"id": self.user_id, "type": "private"},
+                            "from": {"id": 1, "is_bot": True, "first_name": "Fake"}},
+            },
+        })
+
+
+# Сценарии - асинхронные генераторы апдейтов. Следующий шаг выбирается
+# по клавиатуре, которую бот на самом деле прислал в заглушку. Если нужной
+# кнопки нет, сценарий прерывается FlowAborted - это считается сбоем.
+class FlowAborted(Exception):
+    pass
+
+
+async def flow_start(user, rnd):
+    yield user.message("/start")
+
+
+async def flow_add(user, rnd):
+    yield user.message("/add")
+    banks = user.api.buttons(user.user_id, "bank_")
+    if not banks:
+        raise FlowAborted("no_bank_buttons")
+    yield user.callback(rnd.choice(banks))
+    categories = user.api.buttons(user.user_id, "cat_")
+    if not categories:
+        raise FlowAborted("no_category_buttons")
+    yield user.callback(rnd.choice(categories))
+    percents = user.api.buttons(user.user_id, "percent_")
+    if not percents:
+        raise FlowAborted("no_percent_buttons")
+    yield user.callback(rnd.choice(percents))
+    periods = user.api.buttons(user.user_id, "period_")
+    if periods:
+        yield user.callback(rnd.choice(periods))
+
+
+async def flow_show(user, rnd):
+    yield user.message("📊 Показать мой кешбек")
+
+
+async def flow_delete(user, rnd):
+    yield user.message("/delete")
+    yield user.callback("delete_by_categories")
+    entries = [data for data in user.api.buttons(user.user_id, "delpair_") if data != "delpair_done"]
+    if not entries:
+        # Удалять нечего, только если записей у пользователя действительно нет
+        if await database.get_user_entries(user.user_id):
+            raise FlowAborted("no_entry_buttons")
+        return
+    for data in rnd.sample(entries, min(2, len(entries))):
+        yield user.callback(data)
+    yield user.callback("delpair_done")
+
+
+FLOWS = {"start": flow_start, "add": flow_add, "show": flow_show, "delete": flow_delete}
+DEFAULT_MIX = {"add": 5, "show": 10, "delete": 1}
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.aborted = defaultdict(int)  # "сценарий:причина" -> число прерванных
+        self.updates = 0
+
+    async def process(self, flow, update):
+        start = time.perf_counter()
+        try:
+            await dp.process_updates([update])
+        except Exception as e:
+            self.errors[f"{flow}:{type(e).__name__}"] += 1
+        self.latencies[flow].append(time.perf_counter() - start)
+        self.updates += 1
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] * 1000
+
+
+async def run_synthetic(args, api, stats):
+    rnd = random.Random(args.seed)
+    mix = DEFAULT_MIX if not args.mix else {name: int(weight) for name, weight in
+                                            (item.split("=") for item in args.mix)}
+    names, weights = list(mix), list(mix.values())
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def session(index):
+        user = VirtualUser(BASE_USER_ID + index, api)
+        user_rnd = random.Random(rnd.random())
+        plan = ["start"] + user_rnd.choices(names, weights, k=args.iterations)
+        async with semaphore:
+            for flow in plan:
+                try:
+                    async for update in FLOWS[flow](user, user_rnd):
+                        await stats.process(flow, update)
+                except FlowAborted as e:
+                    stats.aborted[f"{flow}:{e}"] += 1
+
+    await asyncio.gather(*(session(i) for i in range(args.users)))
+
+
+# Все пользователи проходят /add шаг в шаг, --iterations раз подряд, каждый раз
+# в новой категории: апдейты разных чатов одного шага обрабатываются параллельно
+# разными воркерами (executor.py), воркеры переиспользуются между раундами, и
+# состояние FSM одного чата не должно повлиять на другой. В конце у каждого
+# пользователя по записи на раунд.
+async def run_fsm_check(args, api, stats):
+    users = [VirtualUser(BASE_USER_ID + index, api) for index in range(max(2, args.users))]
+
+    async def step(updates):
+        await asyncio.gather(*(stats.process("fsm_check", update) for update in updates))
+
+    await step([user.message("/start") for user in users])
+    for round_no in range(args.iterations):
+        await step([user.message("/add") for user in users])
+        for prefix in ("bank_", "cat_", "percent_", "period_"):
+            updates = []
+            for user in users:
+                buttons = api.buttons(user.user_id, prefix)
+                if buttons:
+                    choice = buttons[round_no % len(buttons)] if prefix == "cat_" else buttons[0]
+                    updates.append(user.callback(choice))
+                elif prefix != "period_":  # выбор периода бывает не всегда
+                    stats.errors[f"fsm_check:no_{prefix.rstrip('_')}_buttons"] += 1
+            await step(updates)
+    for user in users:
+        if len(await database.get_user_entries(user.user_id)) != args.iterations:
+            stats.errors["fsm_check:not_saved"] += 1
+
+
+async def run_replay(args, stats):
+    per_chat = defaultdict(list)
+    with open(args.replay, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            flow, raw = (record["flow"], record["update"]) if "update" in record else ("replay", record)
+            update = types.Update(**raw)
+            per_chat[update_key(update)].append((flow, update))
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    # Апдейты одного чата идут строго по порядку (ключ тот же, что у очередей executor),
+    # разные чаты - параллельно
+    async def session(items):
+        async with semaphore:
+            for flow, update in items:
+                await stats.process(flow, update)
+
+    await asyncio.gather(*(session(items) for items in per_chat.values()))
+
+
+def report(stats, api, elapsed):
+    flows = {}
+    for flow, values in sorted(stats.latencies.items()):
+        flows[flow] = {
+            "updates": len(values),
+            "p50_ms": _percentile(values, 0.50),
+            "p95_ms": _percentile(values, 0.95),
+            "p99_ms": _percentile(values, 0.99),
+        }
+    return {
+        "updates": stats.updates,
+        "seconds": elapsed,
+        "updates_per_sec": stats.updates / elapsed if elapsed else None,
+        "flows": flows,
+        "errors": dict(stats.errors),
+        "aborted_flows": dict(stats.aborted),
+        "api_calls": dict(api.calls),
+        "api_floods": dict(api.floods),
+    }
+
+
+async def main(args):
+    api = FakeBotAPI(flood_rate=args.flood_rate, retry_after=args.retry_after, seed=args.seed)
+    url = await api.start(port=args.api_port)
+    dp.bot.server = TelegramAPIServer.from_base(url)
+    Dispatcher.set_current(dp)
+    Bot.set_current(dp.bot)
+    setup_dispatcher(dp)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        await database.open_db(args.db or os.path.join(tmp, "loadtest.db"))
+        await database.init_db()
+        stats = Stats()
+        start = time.perf_counter()
+        try:
+            if args.check_fsm:
+                await run_fsm_check(args, api, stats)
+            elif args.replay:
+                await run_replay(args, stats)
+            else:
+                await run_synthetic(args, api, stats)
+        finally:
+            elapsed = time.perf_counter() - start
+            await dp.executor.close()
+            await dp.storage.close()
+            await database.close_db()
+            await (await dp.bot.get_session()).close()
+            await api.stop()
+    return report(stats, api, elapsed)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на заглушке Bot API")
+    parser.add_argument("--users", type=int, default=200, help="число виртуальных пользователей")
+    parser.add_argument("--iterations", type=int, default=5, help="сценариев на пользователя после /start")
+    parser.add_argument("--concurrency", type=int, default=50, help="одновременно активных пользователей")
+    parser.add_argument("--mix", nargs="*", help="веса сценариев, например add=5 show=10 delete=1")
+    parser.add_argument("--check-fsm", action="store_true",
+                        help="проверить /add в нескольких чатах одновременно (--users чатов)")
+    parser.add_argument("--replay", help="JSONL с записанными апдейтами вместо синтетики")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="доля ответов 429 от заглушки")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--api-port", type=int, default=0, help="порт заглушки (0 - любой свободный)")
+    parser.add_argument("--db", help="файл базы (по умолчанию временный)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="куда записать JSON-отчёт (по умолчанию stdout)")
+    parser.add_argument("--log-level", default="WARNING")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.getLogger().setLevel(args.log_level)
+    result = asyncio.run(main(args))
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+    # Ошибки при --flood-rate ожидаемы, прерванные сценарии - нет
+    sys.exit(1 if result["aborted_flows"] or (result["errors"] and not args.flood_rate) else 0)
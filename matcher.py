@@ -0,0 +1,135 @@
+# Нечёткий поиск банков и категорий по названию: без эмодзи и регистра,
+# "ё" = "е", по префиксу и с опечатками. Индексы строятся по справочникам
+# и пересобираются при смене reference.version (add_categories / delete_category).
+import re
+
+from database import reference
+
+
+def normalize_name(name: str) -> str:
+    return " ".join(re.sub(r"[^\w%+ ]+", " ", name.casefold().replace("ё", "е")).split())
+
+
+# Расстояние Левенштейна с отсечкой: больше limit не считаем
+def edit_distance(a: str, b: str, limit: int) -> int:
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+class Matcher:
+    def __init__(self, items):
+        # (id, полное имя, имя без пробелов, отдельные слова)
+        self._items = []
+        self._exact = {}
+        for item_id, name in items:
+            normalized = normalize_name(name)
+            compact = normalized.replace(" ", "")
+            self._items.append((item_id, normalized, compact, normalized.split()))
+            self._exact.setdefault(normalized, item_id)
+            self._exact.setdefault(compact, item_id)
+
+    # Лучшее совпадение: (id, штраф) или None. 0 - точное, 0.5 - префикс,
+    # 1..N - число опечаток. При равных штрафах у разных id ответа нет.
+    def match(self, query: str):
+        query = normalize_name(query)
+        compact = query.replace(" ", "")
+        if not compact:
+            return None
+        item_id = self._exact.get(query, self._exact.get(compact))
+        if item_id is not None:
+            return item_id, 0
+
+        limit = max(1, len(compact) // 4)
+        best, best_score, ambiguous = None, None, False
+        for item_id, normalized, name_compact, words in self._items:
+            if name_compact.startswith(compact) or any(word.startswith(compact) for word in words):
+                score = 0.5
+            elif len(compact) < 3:
+                continue
+            else:
+                score = min(edit_distance(compact, candidate, limit) for candidate in (name_compact, *words))
+                if score > limit:
+                    continue
+            if best_score is None or score < best_score:
+                best, best_score, ambiguous = item_id, score, False
+            elif score == best_score and item_id != best:
+                ambiguous = True
+        if best is None or ambiguous:
+            return None
+        return best, best_score
+
+
+def _trigrams(word: str) -> set:
+    padded = f" {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+# Поиск категорий по началу слова для inline-режима: на каждое нажатие клавиши
+# приходит новый запрос, поэтому всё считается заранее. Префиксы слов и имени
+# без пробелов -> id; триграммы слов -> id для запросов с опечатками.
+class PrefixIndex:
+    def __init__(self, items, min_similarity: float = 0.5):
+        self.min_similarity = min_similarity
+        self._names = {}     # id -> нормализованное имя, для сортировки
+        self._prefixes = {}  # префикс -> {id, ...}
+        self._trigrams = {}  # триграмма -> {id, ...}
+        for item_id, name in items:
+            normalized = normalize_name(name)
+            self._names[item_id] = normalized
+            for word in {*normalized.split(), normalized.replace(" ", "")}:
+                for end in range(1, len(word) + 1):
+                    self._prefixes.setdefault(word[:end], set()).add(item_id)
+                for trigram in _trigrams(word):
+                    self._trigrams.setdefault(trigram, set()).add(item_id)
+
+    # id до limit штук: сначала те, где каждое слово запроса - начало слова
+    # названия (по алфавиту), затем похожие по триграммам. Пустой запрос - все.
+    def search(self, query: str, limit: int) -> list:
+        words = normalize_name(query).split()
+        if not words:
+            return sorted(self._names, key=self._names.get)[:limit]
+        found = set.intersection(*(self._prefixes.get(word, set()) for word in words))
+        result = sorted(found, key=self._names.get)
+        if len(result) < limit:
+            trigrams = set().union(*(_trigrams(word) for word in words))
+            shared = {}
+            for trigram in trigrams:
+                for item_id in self._trigrams.get(trigram, ()):
+                    if item_id not in found:
+                        shared[item_id] = shared.get(item_id, 0) + 1
+            similar = [(count / len(trigrams), item_id) for item_id, count in shared.items()
+                       if count / len(trigrams) >= self.min_similarity]
+            similar.sort(key=lambda pair: (-pair[0], self._names[pair[1]]))
+            result += [item_id for _, item_id in similar]
+        return result[:limit]
+
+
+_matchers = None  # (версия справочников, банки, категории)
+_category_index = None  # (версия справочников, PrefixIndex)
+
+
+async def get_matchers():
+    global _matchers
+    version = reference.version
+    if _matchers is None or _matchers[0] != version:
+        ref = await reference.get()
+        _matchers = (version, Matcher(ref.banks), Matcher(ref.categories))
+    return _matchers[1], _matchers[2]
+
+
+async def get_category_index() -> PrefixIndex:
+    global _category_index
+    version = reference.version
+    if _category_index is None or _category_index[0] != version:
+        ref = await reference.get()
+        _category_index = (version, PrefixIndex(ref.categories))
+    return _category_index[1]
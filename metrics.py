@@ -0,0 +1,202 @@
+# Метрики бота в текстовом формате Prometheus:
+# время обработки апдейтов по хендлерам, ошибки, число вызовов Bot API
+# на апдейт и время запросов к базе. Отдаются по HTTP на /metrics.
+import functools
+import logging
+import time
+from contextvars import ContextVar
+
+from aiohttp import web
+from aiogram import Bot
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+log = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield self.name + _format_labels(self.labels, labels), value
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        # labels -> [счётчики по бакетам..., сумма, количество]
+        self._values = {}
+
+    def observe(self, value, *labels):
+        state = self._values.get(labels)
+        if state is None:
+            state = self._values[labels] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[i] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    def samples(self):
+        for labels, state in self._values.items():
+            for bound, count in zip(self.buckets, state):
+                yield self.name + "_bucket" + _format_labels(self.labels, labels, [("le", bound)]), count
+            yield self.name + "_bucket" + _format_labels(self.labels, labels, [("le", "+Inf")]), state[-1]
+            yield self.name + "_sum" + _format_labels(self.labels, labels), state[-2]
+            yield self.name + "_count" + _format_labels(self.labels, labels), state[-1]
+
+
+# Значение снимается функцией в момент выгрузки (размеры очередей, счётчики кешей)
+class CallbackMetric:
+    def __init__(self, name, help, func, type="gauge"):
+        self.name, self.help, self.type = name, help, type
+        self._func = func
+
+    def samples(self):
+        yield self.name, self._func()
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def callback(self, name, help, func, type="gauge"):
+        return self.register(CallbackMetric(name, help, func, type))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(f"{name} {value}" for name, value in metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+update_latency = registry.histogram(
+    "bot_update_duration_seconds", "Время обработки апдейта по хендлерам", ["handler"])
+update_errors = registry.counter(
+    "bot_update_errors_total", "Необработанные исключения в хендлерах", ["handler", "error"])
+api_calls_per_update = registry.histogram(
+    "bot_api_calls_per_update", "Число вызовов Bot API на один апдейт", ["handler"], buckets=COUNT_BUCKETS)
+api_calls = registry.counter(
+    "bot_api_calls_total", "Вызовы Bot API по методам", ["method"])
+db_query_latency = registry.histogram(
+    "bot_db_query_duration_seconds", "Время выполнения функций database.py", ["query"])
+db_query_rows = registry.counter(
+    "bot_db_query_rows_total", "Число строк, возвращённых функциями database.py", ["query"])
+
+
+# Состояние текущего апдейта: хендлер и число вызовов Bot API
+_update_ctx: ContextVar[dict] = ContextVar("metrics_update_ctx")
+
+
+# Все вызовы Bot API проходят через request()
+class MetricsBot(Bot):
+    async def request(self, method, data=None, files=None, **kwargs):
+        api_calls.inc(method)
+        ctx = _update_ctx.get(None)
+        if ctx is not None:
+            ctx["api_calls"] += 1
+        return await super().request(method, data, files, **kwargs)
+
+
+def _handler_name():
+    handler = current_handler.get(None)
+    return getattr(handler, "__name__", "unknown")
+
+
+class MetricsMiddleware(BaseMiddleware):
+    async def on_pre_process_update(self, update, data):
+        _update_ctx.set({"start": time.perf_counter(), "handler": "unhandled", "api_calls": 0})
+
+    async def on_post_process_update(self, update, results, data):
+        ctx = _update_ctx.get(None)
+        if ctx is None:
+            return
+        update_latency.observe(time.perf_counter() - ctx["start"], ctx["handler"])
+        api_calls_per_update.observe(ctx["api_calls"], ctx["handler"])
+
+    async def _remember_handler(self, *args):
+        ctx = _update_ctx.get(None)
+        if ctx is not None:
+            ctx["handler"] = _handler_name()
+
+    on_process_message = _remember_handler
+    on_process_callback_query = _remember_handler
+    on_process_inline_query = _remember_handler
+
+
+def setup_metrics(dp):
+    dp.middleware.setup(MetricsMiddleware())
+
+    # Только считает ошибку: None означает, что исключение не подавлено
+    @dp.errors_handler()
+    async def count_errors(update, exception):
+        ctx = _update_ctx.get(None)
+        update_errors.inc(ctx["handler"] if ctx else "unknown", type(exception).__name__)
+
+
+# Обёртка для функций доступа к данным: время и число строк результата
+def timed_query(func):
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = await func(*args, **kwargs)
+        finally:
+            db_query_latency.observe(time.perf_counter() - start, name)
+        if isinstance(result, list):
+            db_query_rows.inc(name, amount=len(result))
+        return result
+
+    return wrapper
+
+
+async def metrics_view(request):
+    return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_view)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info("metrics_started host=%s port=%s", host, port)
+    return runner
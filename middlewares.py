@@ -0,0 +1,61 @@
+# Защита от всплесков: ограничение частоты апдейтов на пользователя
+# (token bucket) и схлопывание повторных нажатий одной и той же кнопки.
+import time
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from cache import LRUCache
+from metrics import registry
+from ratelimit import TokenBucket
+from sender import answer_callback
+
+throttled_updates = registry.counter(
+    "bot_throttled_updates_total", "Апдейты, отброшенные ограничителем", ("kind", "reason"))
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    def __init__(self, rate: float = 2.0, burst: float = 5, coalesce_window: float = 1.0, max_users: int = 10000):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.coalesce_window = coalesce_window
+        self._buckets = LRUCache(max_users)
+        # (user_id, message_id, data) -> время завершения или None, пока хендлер работает
+        self._callbacks = LRUCache(max_users)
+
+    def _allowed(self, user_id: int) -> bool:
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            self._buckets.set(user_id, bucket)
+        return bucket.try_acquire()
+
+    @staticmethod
+    def _callback_key(call: types.CallbackQuery):
+        return call.from_user.id, call.message.message_id if call.message else call.inline_message_id, call.data
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        if not self._allowed(message.from_user.id):
+            throttled_updates.inc("message", "rate")
+            raise CancelHandler()
+
+    # Повтор той же кнопки, пока первое нажатие обрабатывается или сразу после него,
+    # отбрасывается. На отброшенные нажатия сразу отвечаем, чтобы у кнопки пропали "часики".
+    async def on_pre_process_callback_query(self, call: types.CallbackQuery, data: dict):
+        key = self._callback_key(call)
+        now = time.monotonic()
+        finished_at = self._callbacks.get(key, now - self.coalesce_window - 1)
+        if finished_at is None or now - finished_at < self.coalesce_window:
+            throttled_updates.inc("callback_query", "duplicate")
+            await answer_callback(call)
+            raise CancelHandler()
+        if not self._allowed(call.from_user.id):
+            throttled_updates.inc("callback_query", "rate")
+            await answer_callback(call, "Слишком часто, подождите секунду")
+            raise CancelHandler()
+        self._callbacks.set(key, None)
+
+    async def on_post_process_callback_query(self, call: types.CallbackQuery, results, data: dict):
+        self._callbacks.set(self._callback_key(call), time.monotonic())
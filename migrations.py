@@ -0,0 +1,359 @@
+# Миграции схемы базы данных.
+# Номер последней применённой миграции хранится в PRAGMA user_version,
+# поэтому на уже актуальной базе init_db() не выполняет никакого DDL.
+# Новые миграции добавляются только в конец списка MIGRATIONS.
+
+
+# Справочники банков и категорий; seed=False - без предзаполнения
+# (shards.py reshard переносит их из исходной базы)
+async def _reference_tables(db, seed=True):
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS banks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS categories (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE
+        )
+    ''')
+    if not seed:
+        return
+
+    # Предзаполнение банков
+    await db.executemany('INSERT OR IGNORE INTO banks (name) VALUES (?)', [
+        ('Т-банк',),
+        ('ВТБ',)
+    ])
+
+    # Предзаполнение категорий
+    await db.executemany('INSERT OR IGNORE INTO categories (name) VALUES (?)', [
+        ('🛍 Все покупки',),
+        ('⚽️ Спорттовары',),
+        ('🐶 Животные',),
+        ('💊 Аптеки',),
+        ('⛽️ Заправки',),
+        ('🛒 Супермаркеты',),
+        ('💐 Цветы',),
+        ('💋 Красота',),
+        ('🎮 Развлечения',),
+        ('🎭 Искусство',),
+        ('🍔 Фаст-фуд',),
+        ('🍽 Рестораны',)
+    ])
+
+
+# 1. Исходная схема и справочники. IF NOT EXISTS / OR IGNORE нужны для баз,
+# созданных до появления миграций (у них user_version = 0).
+async def _initial_schema(db):
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            friend_id INTEGER
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS cashback (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            bank_id INTEGER,
+            category_id INTEGER,
+            percent REAL,
+            period TEXT,
+            FOREIGN KEY (user_id) REFERENCES users(user_id),
+            FOREIGN KEY (bank_id) REFERENCES banks(id),
+            FOREIGN KEY (category_id) REFERENCES categories(id)
+        )
+    ''')
+    await _reference_tables(db)
+
+
+# 2. Индексы под запросы к cashback:
+#    get_user_all_periods / get_user_entries - (user_id, bank_id, category_id, period)
+#    get_cashbacks                                       - (user_id, period)
+#    get_user_categories                                 - (user_id, category_id)
+async def _cashback_indexes(db):
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_cashback_user_bank_category_period
+        ON cashback (user_id, bank_id, category_id, period)
+    ''')
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_cashback_user_period
+        ON cashback (user_id, period)
+    ''')
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_cashback_user_category
+        ON cashback (user_id, category_id)
+    ''')
+
+
+# 3. Не больше одной записи на (пользователь, банк, категория, период).
+# Уже накопившиеся дубли схлопываются до последней добавленной записи.
+# Уникальный индекс заменяет обычный индекс по тем же колонкам.
+async def _cashback_unique_period(db):
+    await db.execute('''
+        DELETE FROM cashback WHERE id NOT IN (
+            SELECT MAX(id) FROM cashback
+            GROUP BY user_id, bank_id, category_id, period
+        )
+    ''')
+    await db.execute('DROP INDEX IF EXISTS idx_cashback_user_bank_category_period')
+    await db.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_cashback_user_bank_category_period
+        ON cashback (user_id, bank_id, category_id, period)
+    ''')
+
+
+# 4. Состояния FSM (storage.SQLiteStorage). data и bucket хранятся как JSON,
+# updated_at - unix-время последнего изменения для истечения по TTL.
+async def _fsm_state(db):
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS fsm_state (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            state TEXT,
+            data TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (chat_id, user_id)
+        ) WITHOUT ROWID
+    ''')
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_fsm_state_updated_at
+        ON fsm_state (updated_at)
+    ''')
+
+
+# Группы и их участники (миграция 5 и общая база шардов)
+async def _group_tables(db):
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS sharing_groups (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            owner_id INTEGER NOT NULL
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS group_members (
+            user_id INTEGER PRIMARY KEY,
+            group_id INTEGER NOT NULL,
+            FOREIGN KEY (group_id) REFERENCES sharing_groups(id)
+        )
+    ''')
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_group_members_group
+        ON group_members (group_id, user_id)
+    ''')
+
+
+# 5. Группы (семья, домохозяйство) вместо пары users.friend_id.
+# Пользователь состоит не больше чем в одной группе. В группу переносятся
+# только взаимные пары (A.friend_id = B и B.friend_id = A): односторонняя
+# ссылка не означает согласия второго, и цепочки ссылок не склеиваются.
+# Колонка удаляется, в users появляется имя для подписи кешбеков участников.
+async def _sharing_groups(db):
+    await _group_tables(db)
+
+    pairs = await db.execute_fetchall('''
+        SELECT a.user_id, a.friend_id FROM users a
+        JOIN users b ON b.user_id = a.friend_id AND b.friend_id = a.user_id
+        WHERE a.user_id < a.friend_id
+    ''')
+    for user_id, friend_id in pairs:
+        cursor = await db.execute('INSERT INTO sharing_groups (owner_id) VALUES (?)', (user_id,))
+        await db.executemany('INSERT INTO group_members (user_id, group_id) VALUES (?, ?)',
+                             [(user_id, cursor.lastrowid), (friend_id, cursor.lastrowid)])
+
+    await db.execute('ALTER TABLE users DROP COLUMN friend_id')
+    await db.execute('ALTER TABLE users ADD COLUMN name TEXT')
+
+
+# 6. Архив прошедших периодов (переносится фоновой задачей retention.py)
+#    и индекс по period, чтобы выбирать устаревшие строки без полного просмотра
+async def _cashback_archive(db):
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS cashback_archive (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            bank_id INTEGER NOT NULL,
+            category_id INTEGER NOT NULL,
+            percent REAL NOT NULL,
+            period TEXT NOT NULL,
+            archived_at REAL NOT NULL
+        )
+    ''')
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_cashback_archive_user_period
+        ON cashback_archive (user_id, period)
+    ''')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_cashback_period ON cashback (period)')
+
+
+# 7. Рассылка напоминаний о новом месяце (reminder.py): запуск на период
+#    и отметки о доставке, чтобы после перезапуска не отправлять повторно
+async def _reminders(db):
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS reminder_runs (
+            period TEXT PRIMARY KEY,
+            started_at REAL NOT NULL,
+            finished_at REAL,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS reminder_log (
+            period TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            sent_at REAL NOT NULL,
+            PRIMARY KEY (period, user_id)
+        ) WITHOUT ROWID
+    ''')
+
+
+# 8. Компактное хранение кешбеков: период - номер месяца (units.make_period),
+#    процент - базисные пункты. Таблицы без rowid с ключом
+#    (user_id, period, bank_id, category_id): записи пользователя лежат рядом
+#    и упорядочены по периоду, отдельный уникальный индекс больше не нужен.
+#    Здесь только переименование и новые таблицы; строки переносятся пачками
+#    в copy_legacy_batch, прерванный перенос продолжается при следующем запуске.
+async def _compact_cashback(db):
+    for index in ('uq_cashback_user_bank_category_period', 'idx_cashback_user_period',
+                  'idx_cashback_user_category', 'idx_cashback_period', 'idx_cashback_archive_user_period'):
+        await db.execute(f'DROP INDEX IF EXISTS {index}')
+    await db.execute('ALTER TABLE cashback RENAME TO cashback_legacy')
+    await db.execute('ALTER TABLE cashback_archive RENAME TO cashback_archive_legacy')
+    await db.execute('''
+        CREATE TABLE cashback (
+            user_id INTEGER NOT NULL,
+            period INTEGER NOT NULL,
+            bank_id INTEGER NOT NULL,
+            category_id INTEGER NOT NULL,
+            percent INTEGER NOT NULL,
+            PRIMARY KEY (user_id, period, bank_id, category_id)
+        ) WITHOUT ROWID
+    ''')
+    await db.execute('CREATE INDEX idx_cashback_period ON cashback (period)')
+    await db.execute('''
+        CREATE TABLE cashback_archive (
+            user_id INTEGER NOT NULL,
+            period INTEGER NOT NULL,
+            bank_id INTEGER NOT NULL,
+            category_id INTEGER NOT NULL,
+            percent INTEGER NOT NULL,
+            archived_at REAL NOT NULL,
+            PRIMARY KEY (user_id, period, bank_id, category_id)
+        ) WITHOUT ROWID
+    ''')
+
+
+# 9. Приглашения в группу: участник вступает в группу пригласившего,
+#    только приняв приглашение (handler.py, /addfriend)
+async def _group_invites(db):
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS group_invites (
+            member_id INTEGER NOT NULL,
+            inviter_id INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (member_id, inviter_id)
+        ) WITHOUT ROWID
+    ''')
+
+
+MIGRATIONS = [
+    _initial_schema,
+    _cashback_indexes,
+    _cashback_unique_period,
+    _fsm_state,
+    _sharing_groups,
+    _cashback_archive,
+    _reminders,
+    _compact_cashback,
+    _group_invites,
+]
+
+
+async def get_schema_version(db) -> int:
+    rows = await db.execute_fetchall("PRAGMA user_version")
+    return rows[0][0]
+
+
+# Каждая миграция выполняется в своей транзакции вместе с обновлением user_version
+async def migrate(db):
+    version = await get_schema_version(db)
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        await db.execute("BEGIN")
+        try:
+            await migration(db)
+            await db.execute(f"PRAGMA user_version = {number}")
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
+
+
+# Общая база шардов (shards.py): справочники и группы. Своя нумерация версий
+# в user_version; схема создаётся один раз, даже если шарды стартуют одновременно.
+SHARED_VERSION = 2
+
+
+async def migrate_shared(db, seed=True):
+    await db.execute("BEGIN IMMEDIATE")
+    try:
+        version = await get_schema_version(db)
+        if version < 1:
+            await _reference_tables(db, seed)
+            await _group_tables(db)
+        if version < 2:
+            await _group_invites(db)
+        if version < SHARED_VERSION:
+            await db.execute(f"PRAGMA user_version = {SHARED_VERSION}")
+        await db.commit()
+    except BaseException:
+        await db.rollback()
+        raise
+
+
+# Перенос одной пачки строк из таблиц до миграции 8 в компактные, отдельной транзакцией.
+# Строки с пустыми полями (старая схема их допускала) отбрасываются.
+# Возвращает число обработанных строк; когда переносить нечего, старые таблицы удаляются.
+LEGACY_TABLES = (
+    ('cashback_legacy', 'cashback', ''),
+    ('cashback_archive_legacy', 'cashback_archive', ', archived_at'),
+)
+
+
+async def copy_legacy_batch(db, limit: int) -> int:
+    for legacy, target, extra in LEGACY_TABLES:
+        exists = await db.execute_fetchall("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                           (legacy,))
+        if not exists:
+            continue
+        rows = await db.execute_fetchall(
+            f'SELECT MAX(id), COUNT(*) FROM (SELECT id FROM {legacy} ORDER BY id LIMIT ?)', (limit,))
+        last_id, count = rows[0]
+        await db.execute("BEGIN")
+        try:
+            if last_id is None:
+                await db.execute(f'DROP TABLE {legacy}')
+                await db.commit()
+                continue
+            await db.execute(f'''
+                INSERT OR REPLACE INTO {target} (user_id, period, bank_id, category_id, percent{extra})
+                SELECT user_id,
+                       CAST(substr(period, 1, 4) AS INTEGER) * 12 + CAST(substr(period, 6, 2) AS INTEGER) - 1,
+                       bank_id, category_id, CAST(round(percent * 100) AS INTEGER){extra}
+                FROM {legacy}
+                WHERE id <= ? AND user_id IS NOT NULL AND bank_id IS NOT NULL
+                  AND category_id IS NOT NULL AND percent IS NOT NULL AND period IS NOT NULL
+                ORDER BY id
+            ''', (last_id,))
+            await db.execute(f'DELETE FROM {legacy} WHERE id <= ?', (last_id,))
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
+        return count
+    return 0
@@ -0,0 +1,66 @@
+# Ограничители частоты: общий token bucket и минимальный интервал на ключ (чат).
+import asyncio
+import time
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    # Без ожидания: True, если токен был
+    def try_acquire(self) -> bool:
+        now = time.monotonic()
+        if now < self._paused_until:
+            return False
+        self._refill(now)
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    # Дождаться токена; ждущие обслуживаются по очереди
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    # Остановить выдачу на seconds (например, после 429 с retry_after)
+    def pause(self, seconds: float):
+        now = time.monotonic()
+        self._paused_until = max(self._paused_until, now + seconds)
+        self._refill(now)
+        self._tokens = 0
+
+
+class KeyedInterval:
+    def __init__(self, interval: float, max_keys: int = 10000):
+        self.interval = interval
+        self.max_keys = max_keys
+        self._next = {}
+
+    # Дождаться, пока с прошлого раза для key пройдёт interval
+    async def wait(self, key):
+        now = time.monotonic()
+        ready_at = self._next.get(key, 0.0)
+        self._next[key] = max(now, ready_at) + self.interval
+        if ready_at > now:
+            await asyncio.sleep(ready_at - now)
+        if len(self._next) > self.max_keys:
+            self._next = {k: t for k, t in self._next.items() if t > now}
@@ -0,0 +1,141 @@
+# Напоминание о новом месяце: в первые дни месяца всем пользователям без
+# записей за текущий период уходит сообщение. Отправка идёт параллельно,
+# но не быстрее rate сообщений в секунду на всех и одного сообщения в
+# chat_interval секунд на чат. Кроме того, рассылка берёт токены из общего
+# bucket исходящих сообщений (sender.py): вместе с ответами хендлеров она не
+# превышает SENDER_RATE, а 429 с любой стороны останавливает обе. rate - доля
+# рассылки в SENDER_RATE (см. REMINDER_RATE в settings.py), остальное - хендлерам.
+# Результаты пишутся в reminder_log после каждой страницы получателей,
+# поэтому после перезапуска рассылка продолжается, а не начинается заново.
+#
+# Разовый запуск (например, против fake_api.py через TELEGRAM_API_SERVER):
+#   python reminder.py --period 2026-11
+import argparse
+import asyncio
+import logging
+from datetime import datetime
+
+from aiogram.utils.exceptions import RetryAfter, BotBlocked, ChatNotFound, UserDeactivated, \
+    CantInitiateConversation, NetworkError, TelegramAPIError
+
+from core import MONTHS_RU, get_next_two_periods
+from database import get_reminder_run, start_reminder_run, finish_reminder_run, get_reminder_recipients, \
+    save_reminder_results
+from metrics import registry
+from ratelimit import TokenBucket, KeyedInterval
+from sender import sender
+from units import parse_period, period_month, period_text
+
+log = logging.getLogger(__name__)
+
+reminder_messages = registry.counter(
+    "bot_reminder_messages_total", "Напоминания о новом месяце по результату", ("status",))
+reminder_retries = registry.counter(
+    "bot_reminder_retries_total", "Повторы отправки напоминаний", ("reason",))
+
+
+def reminder_text(period: int) -> str:
+    return (f"Наступил {MONTHS_RU[period_month(period)].lower()}! Кешбеков на этот месяц у вас пока нет.\n"
+            f"Добавьте их: /add или списком через /import")
+
+
+class ReminderBroadcaster:
+    def __init__(self, bot, rate: float = 10, chat_interval: float = 1.0, concurrency: int = 10,
+                 page_size: int = 200, max_retries: int = 5, bucket: TokenBucket = None):
+        self.bot = bot
+        self.rate = TokenBucket(rate)
+        self.bucket = bucket or sender.bucket
+        self.chats = KeyedInterval(chat_interval)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.page_size = page_size
+        self.max_retries = max_retries
+
+    # Возвращает 'sent' или причину неудачи
+    async def send(self, chat_id: int, text: str) -> str:
+        for attempt in range(self.max_retries):
+            await self.chats.wait(chat_id)
+            await self.rate.acquire()
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id, text)
+                return "sent"
+            except RetryAfter as e:
+                # Лимит общий для бота - останавливаем всех отправителей
+                reminder_retries.inc("retry_after")
+                self.bucket.pause(e.timeout)
+            except (BotBlocked, ChatNotFound, UserDeactivated, CantInitiateConversation) as e:
+                return type(e).__name__
+            except NetworkError:
+                reminder_retries.inc("network")
+                await asyncio.sleep(2 ** attempt)
+            except TelegramAPIError as e:
+                return type(e).__name__
+        return "retries_exhausted"
+
+    async def _send_limited(self, chat_id: int, text: str) -> str:
+        async with self.semaphore:
+            status = await self.send(chat_id, text)
+        reminder_messages.inc(status)
+        return status
+
+    async def broadcast(self, period: int, text: str) -> int:
+        await start_reminder_run(period)
+        after, total = 0, 0
+        while True:
+            recipients = await get_reminder_recipients(period, after, self.page_size)
+            if not recipients:
+                break
+            tasks = [asyncio.create_task(self._send_limited(user_id, text)) for user_id in recipients]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                # Даже при остановке сохраняем то, что уже ушло, чтобы не отправить повторно
+                await save_reminder_results(period, [
+                    (user_id, task.result()) for user_id, task in zip(recipients, tasks)
+                    if task.done() and not task.cancelled() and task.exception() is None
+                ])
+            after = recipients[-1]
+            total += len(recipients)
+        await finish_reminder_run(period)
+        log.info("reminder_finished period=%s recipients=%s", period_text(period), total)
+        return total
+
+
+# Раз в check_interval секунд: если идут первые window_days дней месяца и рассылки
+# за него ещё не было, или она прервалась - запустить/продолжить
+async def reminder_loop(broadcaster: ReminderBroadcaster, check_interval: float, window_days: int):
+    while True:
+        try:
+            period = get_next_two_periods()[0]
+            run = await get_reminder_run(period)
+            if (run is None and datetime.now().day <= window_days) or (run is not None and run[1] is None):
+                await broadcaster.broadcast(period, reminder_text(period))
+        except Exception:
+            log.exception("reminder_failed")
+        await asyncio.sleep(check_interval)
+
+
+def start_reminders(bot, check_interval: float, window_days: int, **kwargs) -> asyncio.Task:
+    return asyncio.create_task(reminder_loop(ReminderBroadcaster(bot, **kwargs), check_interval, window_days))
+
+
+async def _main(args):
+    from database import init_db, close_db
+    from settings import bot, REMINDER_RATE, REMINDER_CHAT_INTERVAL, REMINDER_CONCURRENCY, REMINDER_PAGE_SIZE
+
+    await init_db()
+    try:
+        broadcaster = ReminderBroadcaster(bot, rate=REMINDER_RATE, chat_interval=REMINDER_CHAT_INTERVAL,
+                                          concurrency=REMINDER_CONCURRENCY, page_size=REMINDER_PAGE_SIZE)
+        await broadcaster.broadcast(args.period, reminder_text(args.period))
+    finally:
+        await close_db()
+        await (await bot.get_session()).close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Разовая рассылка напоминаний о новом месяце")
+    parser.add_argument("--period", type=parse_period, default=get_next_two_periods()[0],
+                        help="ГГГГ-ММ, по умолчанию текущий")
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main(parser.parse_args()))
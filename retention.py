@@ -0,0 +1,77 @@
+# Фоновая архивация прошедших периодов. Раз в interval секунд строки cashback
+# с периодом раньше core.active_since() небольшими пачками переносятся в
+# cashback_archive, после чего освободившиеся страницы возвращаются файлу
+# через incremental_vacuum. Между пачками задача уступает место хендлерам.
+#
+# Базу, созданную до auto_vacuum = INCREMENTAL, один раз переводит полный VACUUM.
+# Он блокирует запись, поэтому запускается вручную при остановленном боте:
+#   python retention.py vacuum
+import argparse
+import asyncio
+import logging
+
+from core import active_since
+from database import archive_cashback_batch, enable_incremental_vacuum, incremental_vacuum, \
+    incremental_vacuum_enabled, close_db
+
+log = logging.getLogger(__name__)
+
+
+async def archive_expired(before: int, batch_size: int, pause: float) -> int:
+    total = 0
+    while True:
+        moved = await archive_cashback_batch(before, batch_size)
+        total += moved
+        if moved < batch_size:
+            return total
+        await asyncio.sleep(pause)
+
+
+async def vacuum(pages: int, pause: float):
+    while await incremental_vacuum(pages):
+        await asyncio.sleep(pause)
+
+
+async def run_retention(batch_size: int, pause: float, vacuum_pages: int):
+    before = active_since()
+    moved = await archive_expired(before, batch_size, pause)
+    if moved:
+        log.info("retention_archived rows=%s before=%s", moved, before)
+        if vacuum_pages:
+            await vacuum(vacuum_pages, pause)
+
+
+async def retention_loop(interval: float, batch_size: int, pause: float, vacuum_pages: int):
+    # Без auto_vacuum = INCREMENTAL свободные страницы не уходят и vacuum() не закончился бы
+    if not await incremental_vacuum_enabled():
+        log.warning("retention_vacuum_disabled auto_vacuum=none hint='python retention.py vacuum'")
+        vacuum_pages = 0
+    while True:
+        try:
+            await run_retention(batch_size, pause, vacuum_pages)
+        except Exception:
+            log.exception("retention_failed")
+        await asyncio.sleep(interval)
+
+
+def start_retention(interval: float, batch_size: int, pause: float, vacuum_pages: int) -> asyncio.Task:
+    return asyncio.create_task(retention_loop(interval, batch_size, pause, vacuum_pages))
+
+
+async def _vacuum_command():
+    try:
+        if await enable_incremental_vacuum():
+            log.info("retention_vacuum auto_vacuum=incremental")
+        else:
+            log.info("retention_vacuum already_incremental")
+    finally:
+        await close_db()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Обслуживание базы")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("vacuum", help="перевести базу на auto_vacuum = INCREMENTAL (бот должен быть остановлен)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s level=%(levelname)s logger=%(name)s %(message)s")
+    asyncio.run(_vacuum_command())
@@ -1,16 +1,56 @@
 import logging
 import asyncio
-from settings import dp
-from database import init_db
+from settings import dp, BOT_MODE, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBAPP_HOST, WEBAPP_PORT, \
+    METRICS_HOST, METRICS_PORT, RETENTION_INTERVAL, RETENTION_BATCH, \
+    RETENTION_PAUSE, RETENTION_VACUUM_PAGES, REMINDER_CHECK_INTERVAL, REMINDER_WINDOW_DAYS, REMINDER_RATE, \
+    REMINDER_CHAT_INTERVAL, REMINDER_CONCURRENCY, REMINDER_PAGE_SIZE, THROTTLE_RATE, THROTTLE_BURST, \
+    CALLBACK_COALESCE_WINDOW, SHARD_COUNT, SHARD_INDEX
+from database import init_db, close_db
+from metrics import setup_metrics, start_metrics_server
+from middlewares import ThrottlingMiddleware
+from webhook import run_webhook
+from retention import start_retention
+from reminder import start_reminders
 import handler  # Импортируем файл с хендлерами
+import inline
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s level=%(levelname)s logger=%(name)s %(message)s")
+log = logging.getLogger(__name__)
+
+# Middleware и хендлеры; используется и нагрузочным тестом (loadtest.py)
+def setup_dispatcher(dp):
+    setup_metrics(dp)
+    dp.middleware.setup(ThrottlingMiddleware(THROTTLE_RATE, THROTTLE_BURST, CALLBACK_COALESCE_WINDOW))
+    handler.register_handlers(dp)   # <-- Важно! Вызвать регистрацию здесь
+    inline.register_inline_handlers(dp)
 
-logging.basicConfig(level=logging.INFO)
 
 async def main():
     await init_db()
-    handler.register_handlers(dp)   # <-- Важно! Вызвать регистрацию здесь
-    print("Бот запущен")
-    await dp.start_polling()
+    setup_dispatcher(dp)
+    metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+    retention_task = start_retention(RETENTION_INTERVAL, RETENTION_BATCH, RETENTION_PAUSE,
+                                     RETENTION_VACUUM_PAGES) if RETENTION_INTERVAL else None
+    reminder_task = start_reminders(dp.bot, REMINDER_CHECK_INTERVAL, REMINDER_WINDOW_DAYS, rate=REMINDER_RATE,
+                                    chat_interval=REMINDER_CHAT_INTERVAL, concurrency=REMINDER_CONCURRENCY,
+                                    page_size=REMINDER_PAGE_SIZE) if REMINDER_CHECK_INTERVAL else None
+    log.info("bot_started mode=%s shard=%s/%s", BOT_MODE, SHARD_INDEX, SHARD_COUNT)
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(dp, WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_PATH, url=WEBHOOK_URL, secret=WEBHOOK_SECRET)
+        else:
+            await dp.start_polling()
+    finally:
+        if retention_task:
+            retention_task.cancel()
+        if reminder_task:
+            reminder_task.cancel()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await dp.executor.close()
+        await dp.storage.close()
+        await dp.storage.wait_closed()
+        await close_db()
 
 if __name__ == "__main__":
     asyncio.run(main())
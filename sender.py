@@ -0,0 +1,136 @@
+# Исходящие сообщения. Длинные тексты делятся по строкам на части не длиннее
+# лимита Telegram, сообщения в один чат уходят строго по порядку, общее число
+# одновременных запросов и их частота ограничены. Тот же bucket расходует
+# рассылка напоминаний (reminder.py). На 429 отправка всех чатов
+# приостанавливается на retry_after и запрос повторяется. Ответы на нажатия
+# и inline-запросы не сообщения и в лимит частоты не входят.
+import asyncio
+from contextlib import asynccontextmanager
+
+from aiogram import Bot, types
+from aiogram.utils.exceptions import RetryAfter, MessageNotModified
+
+from metrics import registry
+from ratelimit import TokenBucket
+from settings import SENDER_RATE, SENDER_CONCURRENCY, SENDER_MAX_RETRIES
+
+MESSAGE_LIMIT = 4096
+
+sender_retries = registry.counter("bot_sender_retries_total", "Повторы исходящих запросов после 429", ("method",))
+sender_parts = registry.counter("bot_sender_parts_total", "Части длинных сообщений сверх первой")
+
+
+# Разбить текст по границам строк; слишком длинная строка режется по лимиту
+def split_text(text: str, limit: int = MESSAGE_LIMIT) -> list:
+    if len(text) <= limit:
+        return [text]
+    parts, current = [], ""
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if current:
+                parts.append(current)
+                current = ""
+            parts.append(line[:limit])
+            line = line[limit:]
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) > limit:
+            parts.append(current)
+            candidate = line
+        current = candidate
+    if current:
+        parts.append(current)
+    return parts
+
+
+class Sender:
+    def __init__(self, rate: float = 30, concurrency: int = 20, max_retries: int = 3):
+        self.bucket = TokenBucket(rate)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.max_retries = max_retries
+        self._chats = {}  # chat_id -> [lock, число ожидающих]
+
+    # Очередь на чат: блокировка живёт, пока её кто-то ждёт
+    @asynccontextmanager
+    async def _chat(self, chat_id):
+        entry = self._chats.get(chat_id)
+        if entry is None:
+            entry = self._chats[chat_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[chat_id]
+
+    # rate_limited=False - без токена из bucket; 429 всё равно повторяется после паузы
+    async def call(self, method, *args, rate_limited=True, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            if rate_limited:
+                await self.bucket.acquire()
+            async with self.semaphore:
+                try:
+                    return await method(*args, **kwargs)
+                except RetryAfter as e:
+                    if attempt == self.max_retries:
+                        raise
+                    sender_retries.inc(method.__name__)
+                    self.bucket.pause(e.timeout)
+                    delay = e.timeout
+            if not rate_limited:
+                await asyncio.sleep(delay)
+
+    async def _send_parts(self, chat_id, parts, reply_markup, **kwargs):
+        bot = Bot.get_current()
+        result = None
+        for i, part in enumerate(parts):
+            last = i == len(parts) - 1
+            result = await self.call(bot.send_message, chat_id, part,
+                                     reply_markup=reply_markup if last else None, **kwargs)
+        sender_parts.inc(amount=max(0, len(parts) - 1))
+        return result
+
+    async def send_message(self, chat_id: int, text: str, reply_markup=None, **kwargs) -> types.Message:
+        async with self._chat(chat_id):
+            return await self._send_parts(chat_id, split_text(text), reply_markup, **kwargs)
+
+    # Первая часть заменяет текст сообщения, остальные досылаются новыми сообщениями;
+    # клавиатура остаётся у последней части
+    async def edit_text(self, message: types.Message, text: str, reply_markup=None, **kwargs):
+        parts = split_text(text)
+        async with self._chat(message.chat.id):
+            try:
+                result = await self.call(message.edit_text, parts[0],
+                                         reply_markup=reply_markup if len(parts) == 1 else None, **kwargs)
+            except MessageNotModified:
+                result = message
+            if len(parts) > 1:
+                result = await self._send_parts(message.chat.id, parts[1:], reply_markup, **kwargs)
+            return result
+
+    async def edit_reply_markup(self, message: types.Message, reply_markup=None):
+        async with self._chat(message.chat.id):
+            try:
+                return await self.call(message.edit_reply_markup, reply_markup=reply_markup)
+            except MessageNotModified:
+                return message
+
+    async def answer_callback(self, call: types.CallbackQuery, text: str = None, **kwargs):
+        return await self.call(call.answer, text, rate_limited=False, **kwargs)
+
+    async def answer_inline(self, query: types.InlineQuery, results: list, **kwargs):
+        return await self.call(query.answer, results, rate_limited=False, **kwargs)
+
+
+sender = Sender(SENDER_RATE, SENDER_CONCURRENCY, SENDER_MAX_RETRIES)
+
+
+async def answer(message: types.Message, text: str, reply_markup=None, **kwargs):
+    return await sender.send_message(message.chat.id, text, reply_markup=reply_markup, **kwargs)
+
+
+edit_text = sender.edit_text
+edit_reply_markup = sender.edit_reply_markup
+answer_callback = sender.answer_callback
+answer_inline = sender.answer_inline
@@ -1,15 +1,109 @@
 # settings.py
 import os
 
-from aiogram import Bot, Dispatcher
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 
 API_TOKEN = os.getenv('BOT_TOKEN')
-DB_NAME = "db/cashback_bot.db"
+# Свой адрес Bot API: локальный сервер telegram-bot-api или заглушка fake_api.py
+TELEGRAM_API_SERVER = os.getenv('TELEGRAM_API_SERVER')
+DB_NAME = os.getenv('DB_NAME', "db/cashback_bot.db")
+DB_READ_POOL_SIZE = int(os.getenv('DB_READ_POOL_SIZE', 4))
+SUMMARY_CACHE_SIZE = int(os.getenv('SUMMARY_CACHE_SIZE', 10000))
+# Строк за транзакцию при переносе кешбеков в компактные таблицы (миграция 8)
+MIGRATION_BATCH = int(os.getenv('MIGRATION_BATCH', 5000))
+# Пакетная запись (batcher.py): максимум изменений в одной транзакции
+# и сколько секунд ждать следующую пачку после полной (при малой нагрузке - не ждём)
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', 200))
+WRITE_BATCH_DELAY = float(os.getenv('WRITE_BATCH_DELAY', 0.002))
 
-bot = Bot(token=API_TOKEN, parse_mode='HTML')
-storage = MemoryStorage()
-dp = Dispatcher(bot, storage=storage)
+# FSM: размер кеша в памяти, период сброса в базу (сек) и время жизни брошенных состояний (сек)
+FSM_CACHE_SIZE = int(os.getenv('FSM_CACHE_SIZE', 10000))
+FSM_FLUSH_INTERVAL = float(os.getenv('FSM_FLUSH_INTERVAL', 1.0))
+FSM_TTL = float(os.getenv('FSM_TTL', 24 * 60 * 60))
+
+# Импорт кешбеков: максимум строк за раз и размер загружаемого файла (байт)
+IMPORT_MAX_ROWS = int(os.getenv('IMPORT_MAX_ROWS', 1000))
+IMPORT_MAX_BYTES = int(os.getenv('IMPORT_MAX_BYTES', 1024 * 1024))
+
+# Архивация старых периодов (retention.py): сколько прошедших месяцев остаются
+# активными, как часто запускать (сек, 0 - отключено), размер пачки,
+# пауза между пачками (сек) и число страниц на шаг incremental_vacuum
+RETENTION_KEEP_MONTHS = int(os.getenv('RETENTION_KEEP_MONTHS', 2))
+RETENTION_INTERVAL = float(os.getenv('RETENTION_INTERVAL', 60 * 60))
+RETENTION_BATCH = int(os.getenv('RETENTION_BATCH', 500))
+RETENTION_PAUSE = float(os.getenv('RETENTION_PAUSE', 0.05))
+RETENTION_VACUUM_PAGES = int(os.getenv('RETENTION_VACUUM_PAGES', 256))
+
+# Напоминания о новом месяце (reminder.py): период проверки (сек, 0 - отключено),
+# сколько первых дней месяца можно начинать рассылку, лимит рассылки (сообщений/сек),
+# минимальный интервал на чат (сек), параллельность и размер страницы получателей.
+# Рассылка делит SENDER_RATE с ответами хендлеров и идёт как раз в начале месяца,
+# когда кешбеки вносят чаще всего: по умолчанию ей треть (10 из 30), ответам -
+# не меньше 20 сообщений/сек. REMINDER_RATE должен быть заметно меньше SENDER_RATE.
+REMINDER_CHECK_INTERVAL = float(os.getenv('REMINDER_CHECK_INTERVAL', 5 * 60))
+REMINDER_WINDOW_DAYS = int(os.getenv('REMINDER_WINDOW_DAYS', 3))
+REMINDER_RATE = float(os.getenv('REMINDER_RATE', 10))
+REMINDER_CHAT_INTERVAL = float(os.getenv('REMINDER_CHAT_INTERVAL', 1.0))
+REMINDER_CONCURRENCY = int(os.getenv('REMINDER_CONCURRENCY', 10))
+REMINDER_PAGE_SIZE = int(os.getenv('REMINDER_PAGE_SIZE', 200))
+
+# Inline-режим (inline.py, включается у @BotFather): сколько секунд Telegram хранит
+# персональный ответ, размер кеша ответов в памяти и максимум результатов
+INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', 30))
+INLINE_CACHE_SIZE = int(os.getenv('INLINE_CACHE_SIZE', 10000))
+INLINE_MAX_RESULTS = int(os.getenv('INLINE_MAX_RESULTS', 20))
+
+# Ограничение апдейтов на пользователя (middlewares.py): апдейтов в секунду, запас на всплеск
+# и окно (сек), в котором повторное нажатие той же кнопки отбрасывается
+THROTTLE_RATE = float(os.getenv('THROTTLE_RATE', 2))
+THROTTLE_BURST = float(os.getenv('THROTTLE_BURST', 5))
+CALLBACK_COALESCE_WINDOW = float(os.getenv('CALLBACK_COALESCE_WINDOW', 1.0))
+
+# Исходящие сообщения (sender.py): запросов в секунду на всех, одновременных запросов
+# и повторов после 429
+SENDER_RATE = float(os.getenv('SENDER_RATE', 30))
+SENDER_CONCURRENCY = int(os.getenv('SENDER_CONCURRENCY', 20))
+SENDER_MAX_RETRIES = int(os.getenv('SENDER_MAX_RETRIES', 3))
+
+# Обработка апдейтов (executor.py): число воркеров и сколько апдейтов может ждать
+# в очередях чатов, прежде чем приём новых приостановится. Прежние имена
+# WEBHOOK_WORKERS / WEBHOOK_QUEUE_SIZE тоже понимаются.
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', os.getenv('WEBHOOK_WORKERS', 16)))
+UPDATE_MAX_PENDING = int(os.getenv('UPDATE_MAX_PENDING', os.getenv('WEBHOOK_QUEUE_SIZE', 1000)))
+
+# Шардирование по пользователям (shards.py): пользователь user_id живёт в шарде
+# user_id % SHARD_COUNT. Базы шардов - SHARD_DB_TEMPLATE (DB_NAME процесса-шарда),
+# справочники и группы - в общей SHARED_DB_NAME. Шарды слушают вебхук на
+# SHARD_BASE_PORT + номер. Изменения справочников из других процессов замечаются
+# не позже чем через SHARED_CHECK_INTERVAL сек. SHARD_COUNT=1 - всё в DB_NAME, как раньше.
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 1))
+SHARD_INDEX = int(os.getenv('SHARD_INDEX', 0))
+SHARD_DB_TEMPLATE = os.getenv('SHARD_DB_TEMPLATE', 'db/shard_{}.db')
+SHARED_DB_NAME = os.getenv('SHARED_DB_NAME', 'db/shared.db')
+SHARD_BASE_PORT = int(os.getenv('SHARD_BASE_PORT', 8100))
+SHARED_CHECK_INTERVAL = float(os.getenv('SHARED_CHECK_INTERVAL', 5))
+
+# Режим получения обновлений: polling (по умолчанию, для разработки) или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # публичный адрес; без него setWebhook не вызывается
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBAPP_HOST = os.getenv('WEBAPP_HOST', '0.0.0.0')
+WEBAPP_PORT = int(os.getenv('WEBAPP_PORT', 8080))
+
+# Эндпоинт /metrics для Prometheus; METRICS_PORT=0 отключает сервер
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9100))
+
+# storage импортирует database, которому нужны настройки выше
+from storage import SQLiteStorage  # noqa: E402
+from metrics import MetricsBot  # noqa: E402
+from executor import OrderedDispatcher  # noqa: E402
+
+bot = MetricsBot(token=API_TOKEN, parse_mode='HTML',
+                 server=TelegramAPIServer.from_base(TELEGRAM_API_SERVER) if TELEGRAM_API_SERVER else TELEGRAM_PRODUCTION)
+storage = SQLiteStorage(cache_size=FSM_CACHE_SIZE, flush_interval=FSM_FLUSH_INTERVAL, ttl=FSM_TTL)
+dp = OrderedDispatcher(bot, storage=storage, workers=UPDATE_WORKERS, max_pending=UPDATE_MAX_PENDING)
 
 
 
@@ -0,0 +1,337 @@
+# Шардирование по пользователям: SHARD_COUNT процессов-шардов, каждый со своей
+# базой (SHARD_DB_TEMPLATE) для пользователей user_id % SHARD_COUNT == номер шарда.
+# Справочники и группы - в общей базе SHARED_DB_NAME (см. database.py).
+#
+# Фронт получает обновления от Telegram (polling или вебхук, как run.py),
+# определяет пользователя и пересылает обновление вебхуку его шарда на
+# 127.0.0.1:SHARD_BASE_PORT + номер. У каждого шарда своя очередь и одна задача
+# пересылки, так что порядок обновлений пользователя сохраняется. Шарды
+# запускаются фронтом как дочерние процессы run.py и перезапускаются при падении.
+#   SHARD_COUNT=4 python shards.py run
+#
+# Разделить существующую базу на шарды (бот остановлен):
+#   python shards.py reshard --source db/cashback_bot.db --shards 4
+import argparse
+import asyncio
+import logging
+import os
+import secrets
+import signal
+import sys
+
+import aiohttp
+import aiosqlite
+from aiohttp import web
+
+from database import shard_of
+from metrics import registry, start_metrics_server
+from migrations import migrate, migrate_shared, copy_legacy_batch
+from settings import bot, BOT_MODE, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBAPP_HOST, WEBAPP_PORT, \
+    METRICS_HOST, METRICS_PORT, SHARD_COUNT, SHARD_DB_TEMPLATE, SHARED_DB_NAME, SHARD_BASE_PORT, \
+    MIGRATION_BATCH, SENDER_RATE, REMINDER_RATE, UPDATE_MAX_PENDING
+from webhook import SECRET_HEADER, check_webhook_secret
+
+log = logging.getLogger(__name__)
+
+SHARD_PATH = "/shard"
+RESTART_DELAY = 1.0
+FORWARD_MAX_DELAY = 5.0
+
+forwarded = registry.counter("bot_shard_forwarded_total", "Обновления, пересланные шардам", ("shard", "status"))
+_routers = []  # для метрики очередей
+registry.callback("bot_shard_queue_depth", "Обновления в очередях пересылки шардам",
+                  lambda: sum(queue.qsize() for router in _routers for queue in router.queues))
+
+# Поля обновления, в которых есть отправитель
+UPDATE_FIELDS = ("message", "edited_message", "callback_query", "inline_query", "chosen_inline_result",
+                 "shipping_query", "pre_checkout_query", "poll_answer", "my_chat_member", "chat_member",
+                 "chat_join_request", "channel_post", "edited_channel_post")
+
+
+# Пользователь, которому принадлежит обновление; None - пользователя нет (опросы и т.п.)
+def update_user_id(update: dict):
+    for field in UPDATE_FIELDS:
+        payload = update.get(field)
+        if not payload:
+            continue
+        user = payload.get("from") or payload.get("user")
+        if user:
+            return user["id"]
+        chat = payload.get("chat")
+        if chat:
+            return chat["id"]
+    return None
+
+
+class ShardRouter:
+    def __init__(self, urls: list, secret: str, queue_size: int = 1000):
+        self.urls = urls
+        self.secret = secret
+        self.queues = [asyncio.Queue(queue_size) for _ in urls]
+        self._tasks = []
+        self._session = None
+        _routers.append(self)
+
+    # Когда очередь шарда заполнена, приём ждёт пересылки (backpressure)
+    async def route(self, update: dict):
+        user_id = update_user_id(update)
+        shard = shard_of(user_id, len(self.urls)) if user_id is not None else 0
+        await self.queues[shard].put(update)
+
+    async def _forward(self, shard: int):
+        queue, url = self.queues[shard], self.urls[shard]
+        headers = {SECRET_HEADER: self.secret}
+        while True:
+            update = await queue.get()
+            delay = 0.1
+            # Шард может перезапускаться - повторяем, пока не примет, иначе нарушится порядок
+            while True:
+                try:
+                    async with self._session.post(url, json=update, headers=headers) as response:
+                        status = response.status
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    status = type(e).__name__
+                if status == 200:
+                    forwarded.inc(str(shard), "ok")
+                    break
+                if isinstance(status, int) and status < 500:
+                    forwarded.inc(str(shard), "rejected")
+                    log.error("shard_update_rejected shard=%s status=%s update_id=%s",
+                              shard, status, update.get("update_id"))
+                    break
+                forwarded.inc(str(shard), "retry")
+                log.warning("shard_forward_retry shard=%s error=%s", shard, status)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, FORWARD_MAX_DELAY)
+            queue.task_done()
+
+    def start(self):
+        self._session = aiohttp.ClientSession()
+        self._tasks = [asyncio.create_task(self._forward(shard)) for shard in range(len(self.urls))]
+
+    # Дождаться пересылки принятого и остановиться
+    async def close(self, timeout: float = 10.0):
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self.queues)), timeout)
+        except asyncio.TimeoutError:
+            log.warning("shard_router_close_timeout pending=%s", sum(queue.qsize() for queue in self.queues))
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self._session.close()
+
+
+# Процессы-шарды: run.py в режиме вебхука на локальном порту, без setWebhook.
+# Общие лимиты Bot API делятся между шардами поровну.
+class ShardSupervisor:
+    def __init__(self, count: int, secret: str):
+        self.count = count
+        self.secret = secret
+        self._processes = {}
+        self._tasks = []
+
+    def _env(self, index: int) -> dict:
+        env = dict(os.environ)
+        env.pop("WEBHOOK_URL", None)
+        env.update(
+            BOT_MODE="webhook", WEBAPP_HOST="127.0.0.1", WEBAPP_PORT=str(SHARD_BASE_PORT + index),
+            WEBHOOK_PATH=SHARD_PATH, WEBHOOK_SECRET=self.secret,
+            SHARD_COUNT=str(self.count), SHARD_INDEX=str(index), DB_NAME=SHARD_DB_TEMPLATE.format(index),
+            METRICS_PORT=str(METRICS_PORT + 1 + index) if METRICS_PORT else "0",
+            SENDER_RATE=str(SENDER_RATE / self.count), REMINDER_RATE=str(REMINDER_RATE / self.count),
+        )
+        return env
+
+    async def _supervise(self, index: int):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "run.py")
+        while True:
+            process = await asyncio.create_subprocess_exec(sys.executable, script, env=self._env(index))
+            self._processes[index] = process
+            log.info("shard_started shard=%s pid=%s", index, process.pid)
+            code = await process.wait()
+            log.error("shard_exited shard=%s code=%s", index, code)
+            await asyncio.sleep(RESTART_DELAY)
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._supervise(index)) for index in range(self.count)]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        for process in self._processes.values():
+            if process.returncode is None:
+                process.terminate()
+        for process in self._processes.values():
+            await process.wait()
+
+
+async def _poll(router: ShardRouter):
+    await bot.delete_webhook()
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=20)
+        except Exception:
+            log.exception("get_updates_failed")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            await router.route(update.to_python())
+            offset = update.update_id + 1
+
+
+async def _serve_webhook(router: ShardRouter):
+    async def handle(request: web.Request):
+        if WEBHOOK_SECRET and request.headers.get(SECRET_HEADER) != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        await router.route(update)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+    try:
+        if WEBHOOK_URL:
+            await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+        log.info("front_webhook_started host=%s port=%s path=%s", WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_PATH)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def run_front(count: int):
+    if BOT_MODE == "webhook":
+        check_webhook_secret(WEBAPP_HOST, WEBHOOK_URL, WEBHOOK_SECRET)
+    secret = secrets.token_urlsafe(24)
+    supervisor = ShardSupervisor(count, secret)
+    router = ShardRouter([f"http://127.0.0.1:{SHARD_BASE_PORT + index}{SHARD_PATH}" for index in range(count)],
+                         secret, queue_size=UPDATE_MAX_PENDING)
+    metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+    supervisor.start()
+    router.start()
+    log.info("front_started mode=%s shards=%s", BOT_MODE, count)
+    # SIGTERM (docker stop) и Ctrl+C: дослать принятое и остановить шарды
+    stop = asyncio.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+    receiver = asyncio.create_task(_serve_webhook(router) if BOT_MODE == "webhook" else _poll(router))
+    stopping = asyncio.create_task(stop.wait())
+    try:
+        await asyncio.wait((receiver, stopping), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in (receiver, stopping):
+            task.cancel()
+        await asyncio.gather(receiver, stopping, return_exceptions=True)
+        if receiver.done() and not receiver.cancelled() and receiver.exception():
+            log.error("front_receiver_failed", exc_info=receiver.exception())
+        await router.close()
+        await supervisor.close()
+        log.info("front_stopped")
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await (await bot.get_session()).close()
+
+
+# Таблицы баз шардов: (таблица, колонки, делится ли по user_id).
+# Журнал запусков рассылок копируется во все шарды.
+SHARD_TABLES = (
+    ("users", "user_id, name", True),
+    ("cashback", "user_id, period, bank_id, category_id, percent", True),
+    ("cashback_archive", "user_id, period, bank_id, category_id, percent, archived_at", True),
+    ("fsm_state", "chat_id, user_id, state, data, bucket, updated_at", True),
+    ("reminder_log", "period, user_id, status, sent_at", True),
+    ("reminder_runs", "period, started_at, finished_at, sent, failed", False),
+)
+SHARED_TABLES = (
+    ("banks", "id, name"),
+    ("categories", "id, name"),
+    ("sharing_groups", "id, owner_id"),
+    ("group_members", "user_id, group_id"),
+    ("group_invites", "member_id, inviter_id, created_at"),
+)
+
+
+async def _open(path):
+    db = await aiosqlite.connect(path)
+    await db.execute_fetchall("PRAGMA auto_vacuum = INCREMENTAL")  # см. database.open_db
+    await db.execute_fetchall("PRAGMA journal_mode = WAL")
+    return db
+
+
+# Разложить одну базу по шардам. Исходная база сначала доводится до текущей
+# схемы, как при запуске бота, и дальше не меняется. Существующие базы
+# шардов не перезаписываются.
+async def reshard(source: str, count: int):
+    targets = [SHARED_DB_NAME] + [SHARD_DB_TEMPLATE.format(index) for index in range(count)]
+    existing = [path for path in targets if os.path.exists(path)]
+    if existing:
+        raise SystemExit(f"Базы уже существуют: {', '.join(existing)}")
+    if not os.path.exists(source):
+        raise SystemExit(f"Нет исходной базы {source}")
+
+    db = await _open(source)
+    try:
+        await migrate(db)
+        while await copy_legacy_batch(db, MIGRATION_BATCH):
+            pass
+    finally:
+        await db.close()
+
+    db = await _open(SHARED_DB_NAME)
+    try:
+        await migrate_shared(db, seed=False)
+        await db.execute("ATTACH DATABASE ? AS source", (source,))
+        await db.execute("BEGIN")
+        for table, columns in SHARED_TABLES:
+            await db.execute(f"INSERT INTO {table} ({columns}) SELECT {columns} FROM source.{table}")
+        await db.commit()
+        await db.execute("DETACH DATABASE source")
+    finally:
+        await db.close()
+    log.info("reshard_shared_done path=%s", SHARED_DB_NAME)
+
+    for index in range(count):
+        path = SHARD_DB_TEMPLATE.format(index)
+        db = await _open(path)
+        try:
+            await migrate(db)
+            await db.execute("ATTACH DATABASE ? AS source", (source,))
+            await db.execute("BEGIN")
+            for table, columns, by_user in SHARD_TABLES:
+                where = "WHERE user_id % ? = ?" if by_user else ""
+                await db.execute(f"INSERT INTO {table} ({columns}) SELECT {columns} FROM source.{table} {where}",
+                                 (count, index) if by_user else ())
+            await db.commit()
+            await db.execute("DETACH DATABASE source")
+            users = await db.execute_fetchall("SELECT COUNT(*) FROM users")
+            cashbacks = await db.execute_fetchall("SELECT COUNT(*) FROM cashback")
+        finally:
+            await db.close()
+        log.info("reshard_shard_done shard=%s path=%s users=%s cashback=%s", index, path, users[0][0],
+                 cashbacks[0][0])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Запуск бота шардами и разделение базы на шарды")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("run", help="фронт и процессы-шарды (SHARD_COUNT)")
+    reshard_parser = commands.add_parser("reshard", help="разложить одну базу по шардам")
+    reshard_parser.add_argument("--source", default="db/cashback_bot.db")
+    reshard_parser.add_argument("--shards", type=int, default=SHARD_COUNT)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s level=%(levelname)s logger=%(name)s %(message)s")
+    if args.command == "run":
+        if SHARD_COUNT < 2:
+            raise SystemExit("Задайте SHARD_COUNT >= 2")
+        asyncio.run(run_front(SHARD_COUNT))
+    else:
+        if args.shards < 2:
+            raise SystemExit("Нужно не меньше двух шардов (--shards)")
+        asyncio.run(reshard(args.source, args.shards))
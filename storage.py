@@ -0,0 +1,231 @@
+# FSM-хранилище aiogram поверх SQLite-базы бота.
+# Чтение и запись идут через LRU-кеш в памяти, изменения сбрасываются
+# в базу пачками раз в flush_interval секунд. Состояния, которые не
+# менялись дольше ttl секунд, считаются брошенными и удаляются.
+import asyncio
+import copy
+import json
+import logging
+import time
+import typing
+from collections import OrderedDict
+
+from aiogram.dispatcher.storage import BaseStorage
+
+# Модулем, а не отдельными функциями: settings импортирует storage,
+# пока database ещё не до конца загружен
+import database
+
+log = logging.getLogger(__name__)
+
+
+# Множества в данных FSM (например, выбранные записи в меню удаления)
+# сохраняются в JSON как {"__set__": [...]} и при чтении восстанавливаются
+def _json_default(value):
+    if isinstance(value, (set, frozenset)):
+        return {'__set__': list(value)}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _json_object_hook(obj):
+    if len(obj) == 1 and '__set__' in obj:
+        return set(obj['__set__'])
+    return obj
+
+
+def _dumps(value):
+    return json.dumps(value, default=_json_default)
+
+
+def _loads(text):
+    return json.loads(text, object_hook=_json_object_hook)
+
+
+class SQLiteStorage(BaseStorage):
+    def __init__(self, cache_size: int = 10000, flush_interval: float = 1.0, ttl: float = 86400,
+                 cleanup_interval: float = 600):
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.cleanup_interval = cleanup_interval
+        # (chat, user) -> {'state': ..., 'data': {...}, 'bucket': {...}, 'updated_at': ...}
+        self._cache = OrderedDict()
+        self._dirty = set()
+        self._flushing = set()
+        self._flush_task = None
+        self._last_cleanup = time.time()
+
+    @staticmethod
+    def _empty_record(updated_at=0.0):
+        return {'state': None, 'data': {}, 'bucket': {}, 'updated_at': updated_at}
+
+    @staticmethod
+    def _is_empty(record):
+        return record['state'] is None and not record['data'] and not record['bucket']
+
+    def _expired(self, record, now):
+        return not self._is_empty(record) and record['updated_at'] + self.ttl < now
+
+    async def _get_record(self, chat, user) -> dict:
+        chat, user = map(int, self.check_address(chat=chat, user=user))
+        key = (chat, user)
+        record = self._cache.get(key)
+        if record is None:
+            row = await database.get_fsm_record(chat, user)
+            if row is None:
+                loaded = self._empty_record()
+            else:
+                state, data, bucket, updated_at = row
+                loaded = {'state': state, 'data': _loads(data), 'bucket': _loads(bucket),
+                          'updated_at': updated_at}
+            # Пока читали из базы, запись могла появиться в кеше - она свежее
+            record = self._cache.setdefault(key, loaded)
+        now = time.time()
+        if self._expired(record, now):
+            record = self._cache[key] = self._empty_record(now)
+            self._dirty.add(key)
+        self._cache.move_to_end(key)
+        return record
+
+    def _touch(self, chat, user):
+        key = tuple(map(int, self.check_address(chat=chat, user=user)))
+        self._cache[key]['updated_at'] = time.time()
+        self._dirty.add(key)
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+        self._evict()
+
+    # Вытесняются только уже сохранённые записи
+    def _evict(self):
+        excess = len(self._cache) - self.cache_size
+        if excess <= 0:
+            return
+        for key in list(self._cache):
+            if excess <= 0:
+                break
+            if key not in self._dirty and key not in self._flushing:
+                del self._cache[key]
+                excess -= 1
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        keys, self._dirty = self._dirty, set()
+        upserts, deletes = [], []
+        for key in keys:
+            record = self._cache[key]
+            if self._is_empty(record):
+                deletes.append(key)
+            else:
+                upserts.append((*key, record['state'], _dumps(record['data']),
+                                _dumps(record['bucket']), record['updated_at']))
+        self._flushing = keys
+        try:
+            await database.save_fsm_records(upserts, deletes)
+        except BaseException:
+            # Не удалось записать или запись отменили (close()) - ключи возвращаются,
+            # следующий flush запишет их снова
+            self._dirty |= keys
+            raise
+        finally:
+            self._flushing = set()
+        self._evict()
+
+    async def cleanup(self):
+        now = time.time()
+        for key, record in list(self._cache.items()):
+            if key not in self._dirty and key not in self._flushing and self._expired(record, now):
+                del self._cache[key]
+        removed = await database.delete_fsm_records_before(now - self.ttl)
+        if removed:
+            log.info("fsm_cleanup removed=%s", removed)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.time() - self._last_cleanup >= self.cleanup_interval:
+                    self._last_cleanup = time.time()
+                    await self.cleanup()
+            except Exception:
+                log.exception("fsm_flush_failed")
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            # Дождаться, пока прерванный flush вернёт свои ключи в _dirty
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        record = await self._get_record(chat, user)
+        state = record['state']
+        return state if state is not None else self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        record = await self._get_record(chat, user)
+        return copy.deepcopy(record['data'])
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.AnyStr = None):
+        record = await self._get_record(chat, user)
+        record['state'] = self.resolve_state(state)
+        self._touch(chat, user)
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        record = await self._get_record(chat, user)
+        record['data'] = copy.deepcopy(data or {})
+        self._touch(chat, user)
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs):
+        record = await self._get_record(chat, user)
+        record['data'].update(copy.deepcopy(data or {}), **copy.deepcopy(kwargs))
+        self._touch(chat, user)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         default: typing.Optional[dict] = None) -> typing.Dict:
+        record = await self._get_record(chat, user)
+        return copy.deepcopy(record['bucket'])
+
+    async def set_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        record = await self._get_record(chat, user)
+        record['bucket'] = copy.deepcopy(bucket or {})
+        self._touch(chat, user)
+
+    async def update_bucket(self, *,
+                            chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None, **kwargs):
+        record = await self._get_record(chat, user)
+        record['bucket'].update(copy.deepcopy(bucket or {}), **copy.deepcopy(kwargs))
+        self._touch(chat, user)
@@ -0,0 +1,205 @@
+# Импорт и экспорт кешбеков файлом или многострочным сообщением.
+# Поддерживаются CSV (разделитель ; , или табуляция, заголовок необязателен),
+# JSON-массив объектов и JSON Lines. Поля: bank, category, percent, period
+# (period необязателен - по умолчанию текущий месяц).
+#   Т-банк; Аптеки; 5
+#   ВТБ; Заправки; 3,5; 2026-11
+import csv
+import io
+import json
+
+from database import import_cashbacks, iter_user_cashbacks
+from matcher import get_matchers
+from units import PERIOD_RE, parse_period, period_text, to_basis_points, from_basis_points
+
+FIELDS = ("bank", "category", "percent", "period")
+HEADER_ALIASES = {
+    "bank": "bank", "банк": "bank",
+    "category": "category", "категория": "category",
+    "percent": "percent", "процент": "percent", "%": "percent",
+    "period": "period", "период": "period", "месяц": "period",
+}
+MAX_ERRORS_SHOWN = 10
+
+
+class ImportResult:
+    def __init__(self):
+        self.rows = []
+        self.errors = []  # (номер строки, текст ошибки)
+        self.truncated = False
+
+    def summary(self, saved: int) -> str:
+        lines = [f"Импортировано записей: {saved}."]
+        if self.truncated:
+            lines.append(f"Файл обрезан: обработаны первые {len(self.rows) + len(self.errors)} строк.")
+        if self.errors:
+            lines.append(f"Пропущено строк с ошибками: {len(self.errors)}")
+            lines += [f"  строка {line_no}: {error}" for line_no, error in self.errors[:MAX_ERRORS_SHOWN]]
+            if len(self.errors) > MAX_ERRORS_SHOWN:
+                lines.append("  ...")
+        return "\n".join(lines)
+
+
+def _detect_delimiter(line: str) -> str:
+    for delimiter in (";", "\t", ","):
+        if delimiter in line:
+            return delimiter
+    return ";"
+
+
+# Записи из потока строк: (номер строки, dict с полями или None, если строку не разобрать)
+def iter_records(lines):
+    lines = iter(lines)
+    line_no = 0
+    for line_no, first in enumerate(lines, 1):
+        if first.strip():
+            break
+    else:
+        return
+
+    stripped = first.lstrip("\ufeff").strip()
+    if stripped.startswith("["):
+        # JSON-массив разбирается целиком, размер ограничен при загрузке файла
+        try:
+            items = json.loads("".join([stripped, *lines]))
+        except ValueError:
+            yield line_no, None
+            return
+        for index, item in enumerate(items if isinstance(items, list) else [items], 1):
+            yield index, item if isinstance(item, dict) else None
+        return
+
+    if stripped.startswith("{"):
+        for line_no, line in enumerate(_chain(stripped, lines), line_no):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError:
+                item = None
+            yield line_no, item if isinstance(item, dict) else None
+        return
+
+    delimiter = _detect_delimiter(stripped)
+    reader = csv.reader(_chain(stripped, lines), delimiter=delimiter, skipinitialspace=True)
+    header = None
+    for index, values in enumerate(reader):
+        values = [value.strip() for value in values]
+        if not any(values):
+            continue
+        if index == 0 and any(value.casefold() in HEADER_ALIASES for value in values):
+            header = [HEADER_ALIASES.get(value.casefold()) for value in values]
+            continue
+        fields = header or FIELDS
+        yield line_no + index, {field: value for field, value in zip(fields, values) if field}
+
+
+def _chain(first, rest):
+    yield first
+    yield from rest
+
+
+# Процент из ввода пользователя -> базисные пункты
+def parse_percent(value) -> int:
+    if isinstance(value, (int, float)):
+        percent = float(value)
+    else:
+        percent = float(str(value).replace("%", "").replace(",", ".").strip())
+    if not 0 < percent <= 100:
+        raise ValueError
+    return to_basis_points(percent)
+
+
+def _match(matcher, name):
+    found = matcher.match(str(name or ""))
+    return found[0] if found else None
+
+
+# Разбор и проверка записей по справочникам (названия ищутся нечётко, см. matcher.py).
+# Возвращает ImportResult с кортежами (bank_id, category_id, percent, period),
+# готовыми для import_cashbacks.
+async def parse_import(lines, default_period: int, max_rows: int) -> ImportResult:
+    banks, categories = await get_matchers()
+    result = ImportResult()
+
+    for line_no, record in iter_records(lines):
+        if len(result.rows) + len(result.errors) >= max_rows:
+            result.truncated = True
+            break
+        if record is None:
+            result.errors.append((line_no, "не удалось разобрать"))
+            continue
+        bank_id = _match(banks, record.get("bank"))
+        category_id = _match(categories, record.get("category"))
+        period = record.get("period")
+        if bank_id is None:
+            result.errors.append((line_no, f"неизвестный банк {record.get('bank')!r}"))
+            continue
+        if category_id is None:
+            result.errors.append((line_no, f"неизвестная категория {record.get('category')!r}"))
+            continue
+        try:
+            percent = parse_percent(record.get("percent"))
+        except (TypeError, ValueError):
+            result.errors.append((line_no, f"неверный процент {record.get('percent')!r}"))
+            continue
+        try:
+            period = parse_period(str(period)) if period else default_period
+        except ValueError:
+            result.errors.append((line_no, f"неверный период {period!r}, нужен ГГГГ-ММ"))
+            continue
+        result.rows.append((bank_id, category_id, percent, period))
+    return result
+
+
+# Одна запись строкой "<банк> <категория> <процент> [ГГГГ-ММ]", как в "/add тбанк апт 5".
+# Банк и категория могут быть из нескольких слов, поэтому перебираются все разбиения
+# и берётся с наименьшим штрафом. Возвращает (bank_id, category_id, percent, period или None)
+# или None, если разобрать не удалось.
+async def parse_quick_add(text: str):
+    words = text.split()
+    period = None
+    if words and PERIOD_RE.match(words[-1]):
+        period = parse_period(words.pop())
+    if len(words) < 3:
+        return None
+    try:
+        percent = parse_percent(words[-1])
+    except ValueError:
+        return None
+    words = words[:-1]
+    banks, categories = await get_matchers()
+    best = None
+    for split in range(1, len(words)):
+        bank = banks.match(" ".join(words[:split]))
+        category = categories.match(" ".join(words[split:]))
+        if bank is None or category is None:
+            continue
+        score = bank[1] + category[1]
+        if best is None or score < best[0]:
+            best = (score, bank[0], category[0])
+    if best is None:
+        return None
+    return best[1], best[2], percent, period
+
+
+async def import_lines(user_id: int, lines, default_period: int, max_rows: int) -> str:
+    result = await parse_import(lines, default_period, max_rows)
+    saved = await import_cashbacks(user_id, result.rows)
+    return result.summary(saved)
+
+
+# CSV со всей историей пользователя в формате, который понимает импорт.
+# Строки читаются из базы порциями и сразу пишутся в буфер.
+async def export_csv(user_id: int) -> io.BytesIO:
+    buffer = io.BytesIO()
+    text = io.TextIOWrapper(buffer, encoding="utf-8-sig", newline="")
+    writer = csv.writer(text, delimiter=";")
+    writer.writerow(("period", "bank", "category", "percent"))
+    async for rows in iter_user_cashbacks(user_id):
+        writer.writerows((period_text(period), bank, category, f"{from_basis_points(percent):g}")
+                         for period, bank, category, percent in rows)
+    text.flush()
+    text.detach()
+    buffer.seek(0)
+    return buffer
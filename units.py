@@ -0,0 +1,49 @@
+# Компактное представление данных кешбеков в базе и в памяти:
+# период - номер месяца year * 12 + month - 1 (2026-11 -> 24322),
+# процент - целые базисные пункты (3.5% -> 350).
+# Текст "ГГГГ-ММ" и проценты с дробью остаются только на входе и выходе.
+import re
+from datetime import datetime
+
+PERIOD_RE = re.compile(r"^(\d{4})-(0[1-9]|1[0-2])$")
+
+
+def make_period(year: int, month: int) -> int:
+    return year * 12 + month - 1
+
+
+def current_period() -> int:
+    now = datetime.now()
+    return make_period(now.year, now.month)
+
+
+# "2026-11" -> 24322; ValueError, если формат не ГГГГ-ММ
+def parse_period(text: str) -> int:
+    match = PERIOD_RE.match(text.strip())
+    if match is None:
+        raise ValueError(f"bad period {text!r}")
+    return make_period(int(match[1]), int(match[2]))
+
+
+def period_year(period: int) -> int:
+    return period // 12
+
+
+def period_month(period: int) -> int:
+    return period % 12 + 1
+
+
+def period_text(period: int) -> str:
+    return f"{period // 12:04d}-{period % 12 + 1:02d}"
+
+
+def to_basis_points(percent: float) -> int:
+    return round(percent * 100)
+
+
+def from_basis_points(bp: int) -> float:
+    return bp / 100
+
+
+def format_percent(bp: int) -> str:
+    return f"{bp // 100}%" if bp % 100 == 0 else f"{bp / 100:.1f}%"
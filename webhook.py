@@ -0,0 +1,85 @@
+# Режим вебхука: aiohttp-сервер принимает обновления от Telegram,
+# проверяет секретный токен, ставит обновление в очередь его чата
+# (executor.UpdateExecutor) и сразу отвечает 200. Telegram не ждёт обработки
+# и не шлёт повторы; если очереди переполнены, ответ задерживается.
+#
+# Локально без Telegram (WEBHOOK_URL не задан, setWebhook не вызывается):
+#   curl -X POST localhost:8080/webhook -H 'X-Telegram-Bot-Api-Secret-Token: <WEBHOOK_SECRET>' \
+#        -H 'Content-Type: application/json' -d @update.json
+import asyncio
+import ipaddress
+import logging
+
+from aiohttp import web
+from aiogram import types
+
+from executor import OrderedDispatcher
+
+log = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+# Без секрета любой, кто достучится до порта, может прислать поддельное обновление
+# от имени любого пользователя. Разрешено только при прослушивании loopback без WEBHOOK_URL.
+def check_webhook_secret(host: str, url: str = None, secret: str = None):
+    if secret:
+        return
+    try:
+        loopback = host == "localhost" or ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        loopback = False
+    if url or not loopback:
+        raise SystemExit("WEBHOOK_SECRET обязателен, если задан WEBHOOK_URL или сервер слушает не только loopback")
+
+
+def _log_failure(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is not None:
+        log.error("webhook_update_failed", exc_info=future.exception())
+
+
+class WebhookServer:
+    def __init__(self, dp: OrderedDispatcher, path: str, secret: str = None):
+        self.dp = dp
+        self.path = path
+        self.secret = secret
+
+    async def handle(self, request: web.Request):
+        if self.secret and request.headers.get(SECRET_HEADER) != self.secret:
+            return web.Response(status=403)
+        try:
+            update = types.Update(**await request.json())
+        except (ValueError, TypeError):
+            return web.Response(status=400)
+        # Когда очереди заполнены, приём новых обновлений ждёт воркеров
+        future = await self.dp.executor.submit(update)
+        future.add_done_callback(_log_failure)
+        return web.Response()
+
+    async def _on_startup(self, app):
+        self.dp.executor.start()
+
+    async def _on_shutdown(self, app):
+        await self.dp.executor.close()
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        app.on_startup.append(self._on_startup)
+        app.on_shutdown.append(self._on_shutdown)
+        return app
+
+
+async def run_webhook(dp: OrderedDispatcher, host: str, port: int, path: str, url: str = None, secret: str = None):
+    check_webhook_secret(host, url, secret)
+    server = WebhookServer(dp, path, secret=secret)
+    runner = web.AppRunner(server.make_app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    try:
+        if url:
+            await dp.bot.set_webhook(url, secret_token=secret)
+        log.info("webhook_started host=%s port=%s path=%s", host, port, path)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()